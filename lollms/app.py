@@ -1,8 +1,8 @@
 from lollms.main_config import LOLLMSConfig
 from lollms.paths import LollmsPaths
-from lollms.personality import PersonalityBuilder, AIPersonality
+from lollms.personality import PersonalityBuilder, AIPersonality, LazyPersonality
 from lollms.binding import LLMBinding, BindingBuilder, ModelBuilder, BindingType
-from lollms.databases.discussions_database import Message
+from lollms.databases.discussions_database import Message, fit_to_token_budget, get_tokenizer_id
 from lollms.config import InstallOption
 from lollms.helpers import ASCIIColors, trace_exception
 from lollms.com import NotificationType, NotificationDisplayType, LoLLMsCom
@@ -11,10 +11,15 @@ from lollms.types import MSG_OPERATION_TYPE, SENDER_TYPES
 from lollms.utilities import convert_language_name, process_ai_output
 from lollms.client_session import Client, Session
 from lollms.databases.skills_database import SkillsLibrary
+from lollms.databases.personalities_catalog import PersonalitiesCatalog
+from lollms.databases.function_calls_catalog import FunctionCallsCatalog
 from lollms.tasks import TasksLibrary
 from lollms.prompting import LollmsLLMTemplate, LollmsContextDetails
+from lollms.scheduler import GenerationScheduler
 from lollms.types import MSG_OPERATION_TYPE, MSG_TYPE
-from lollms.function_call import FunctionType, FunctionCall
+from lollms.function_call import FunctionType, FunctionCall, FunctionCallsRegistry
+from lollms.ingestion import IngestionQueue
+from lollms.retrieval import FederatedRetriever, RetrievalSource
 from safe_store import SafeStore
 import importlib
 import asyncio
@@ -36,7 +41,11 @@ import time
 from lollms.utilities import run_with_current_interpreter
 import socket
 import json
+import hashlib
 import pipmaster as pm
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
 
 import importlib.util
 class LollmsApplication(LoLLMsCom):
@@ -109,6 +118,21 @@ class LollmsApplication(LoLLMsCom):
 
         self.current_generation_task = None
 
+        # Tokenized discussion messages reused by prepare_query across turns
+        self.message_tokens_cache:OrderedDict = OrderedDict()
+        self.message_tokens_cache_size = 4096
+        self.message_tokens_cache_lock = threading.Lock()
+
+        # Admission queue in front of the binding generation
+        self.scheduler = GenerationScheduler(self.config.generation_queue_max_size, self.config.generation_max_parallel)
+
+        # Indexes of the personalities and function calls zoos used by the listing endpoints
+        self.personalities_catalog = PersonalitiesCatalog(self.lollms_paths, self.lollms_paths.personal_data_path / "personalities_catalog.db")
+        self.function_calls_catalog = FunctionCallsCatalog(self.lollms_paths, self.lollms_paths.personal_data_path / "function_calls_catalog.db")
+        # Loaded function calls modules and their per client instances
+        self.function_calls_registry = FunctionCallsRegistry(self)
+        # Background parsing and vectorization of the files added to the discussions
+        self.ingestion_queue = IngestionQueue(self, self.lollms_paths.personal_data_path / "ingestion_cache.db", self.config.ingestion_parse_workers)
 
 
 
@@ -149,6 +173,7 @@ class LollmsApplication(LoLLMsCom):
                         subprocess.run(["git", "-C", self.lollms_paths.functions_zoo_path, "pull"])            
                     ASCIIColors.blue("Function calling zoo found in your personal space.")
                     ASCIIColors.execute_with_animation("Pulling last Function calling zoo", check_lollms_function_calling_zoo)
+                    self.function_calls_catalog.invalidate()
 
                     # Pull the repository if it already exists
                     def check_lollms_services_zoo():
@@ -243,31 +268,12 @@ class LollmsApplication(LoLLMsCom):
 
 
     def load_function_call(self, fc, client):
-        dr = Path(fc["dir"])
+        """
+        Returns the configuration of a mounted function call with its instance for the client in "class".
+        Modules and instances are cached by the function calls registry, so this is cheap to call every turn.
+        """
         try:
-            with open(dr/"config.yaml", "r") as f:
-                fc_dict = yaml.safe_load(f.read())
-                # let us check static settings from fc_dict
-                # Step 1: Construct the full path to the function.py module
-                module_path = dr / "function.py"
-                module_name = "function"  # Name for the loaded module
-
-                # Step 2: Use importlib.util to load the module from the file path
-                spec = importlib.util.spec_from_file_location(module_name, module_path)
-                if spec is None:
-                    raise ImportError(f"Could not load module from {module_path}")
-                
-                module = importlib.util.module_from_spec(spec)
-                sys.modules[module_name] = module  # Add the module to sys.modules
-                spec.loader.exec_module(module)    # Execute the module
-
-                # Step 3: Retrieve the class from the module using the class name
-                class_name = fc_dict["class_name"]
-                class_ = getattr(module, class_name)
-                
-                # Step 4: Create an instance of the class and store it in fc_dict["class"]
-                fc_dict["class"] = class_(self, client)
-                return fc_dict
+            return self.function_calls_registry.get(fc["dir"], client)
         except Exception as ex:
             self.error("Couldn't add function call to context")
             trace_exception(ex)
@@ -497,7 +503,7 @@ class LollmsApplication(LoLLMsCom):
 
     def _generate_text(self, prompt):
         max_tokens = min(self.config.ctx_size - self.model.count_tokens(prompt),self.config.max_n_predict if self.config.max_n_predict else self.config.ctx_size- self.model.count_tokens(prompt))
-        generated_text = self.model.generate(prompt, max_tokens)
+        generated_text = self.scheduler.run(self.model.generate, prompt, max_tokens)
         return generated_text.strip()
     
     def _generate_code(self, prompt, template, language):
@@ -530,6 +536,27 @@ class LollmsApplication(LoLLMsCom):
                     except Exception as ex:
                         trace_exception(ex)
                         ASCIIColors.error(f"Couldn't load {db_path} consider revectorizing it")
+    def get_rag_sources(self, client:Client) -> List[RetrievalSource]:
+        """
+        Returns the vector stores to query for the client: mounted datalakes, persona data and discussion documents.
+        """
+        def store_query(store, vectorizer_name):
+            return lambda text, top_k: store.query(text, vectorizer_name, top_k=top_k)
+
+        sources = []
+        for db in self.active_datalakes:
+            if db['mounted'] and db["type"]=="safe_store":
+                sources.append(RetrievalSource(f"datalake {db['alias']}", store_query(db["binding"], db["vectorizer_name"])))
+        if self.personality.persona_data_vectorizer is not None:
+            if self.personality.persona_data_ready.is_set():
+                sources.append(RetrievalSource("persona data", store_query(self.personality.persona_data_vectorizer, self.config.rag_vectorizer)))
+            else:
+                ASCIIColors.info("Persona data is still being vectorized, skipping it")
+        discussion = client.discussion
+        if discussion is not None and len(discussion.text_files) > 0 and discussion.vectorizer is not None:
+            sources.append(RetrievalSource("discussion documents", store_query(discussion.vectorizer, self.config.rag_vectorizer)))
+        return sources
+
     def load_service_from_folder(self, folder_path, target_name):
         # Convert folder_path to a Path object
         folder_path = Path(folder_path)
@@ -965,6 +992,7 @@ class LollmsApplication(LoLLMsCom):
                 new_ui=ui,
                 started_generating_at=client.discussion.current_message.started_generating_at,
                 nb_tokens=client.discussion.current_message.nb_tokens,
+                commit=False
             )
 
     async def update_message_content(
@@ -1014,6 +1042,7 @@ class LollmsApplication(LoLLMsCom):
             client.generated_text,
             started_generating_at=client.discussion.current_message.started_generating_at,
             nb_tokens=client.discussion.current_message.nb_tokens,
+            commit=False
         )
 
     async def update_message_step(
@@ -1092,7 +1121,8 @@ class LollmsApplication(LoLLMsCom):
     async def close_message(self, client_id, fix_content= False):
         client = self.session.get_client(client_id)
         for msg in client.discussion.messages:
-            if msg.steps is not None:
+            # Steps that were never loaded are not displayed, no need to read them
+            if msg.is_loaded("steps") and msg.steps is not None:
                 for step in msg.steps:
                     step["done"] = True
         if not client.discussion:
@@ -1113,7 +1143,10 @@ class LollmsApplication(LoLLMsCom):
                 client.discussion.current_message.nb_tokens = self.model.count_tokens(client.generated_text)
             except:
                 client.discussion.current_message.nb_tokens = None
-            # client.discussion.current_message.update()
+            client.discussion.update_message_content(
+                client.generated_text,
+                nb_tokens=client.discussion.current_message.nb_tokens
+            )
             await self.sio.emit(
                 "close_message",
                 {
@@ -1132,7 +1165,7 @@ class LollmsApplication(LoLLMsCom):
                 to=client_id,
             )
         else:
-            # client.discussion.current_message.update_db()
+            client.discussion.flush_message()
             await self.sio.emit(
                 "close_message",
                 {
@@ -1551,7 +1584,8 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
                 and len(client.discussion.image_files) > 0
             ):
                 if self.config["override_personality_model_parameters"]:
-                    output = self.model.generate_with_images(
+                    output = self.scheduler.run(
+                        self.model.generate_with_images,
                         prompt,
                         client.discussion.image_files,
                         callback=callback,
@@ -1579,7 +1613,8 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
                             prompt,
                         ]
                     )
-                    output = self.model.generate_with_images(
+                    output = self.scheduler.run(
+                        self.model.generate_with_images,
                         prompt,
                         client.discussion.image_files,
                         callback=callback,
@@ -1608,7 +1643,8 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
                         ASCIIColors.error(str(ex))
             else:
                 if self.config["override_personality_model_parameters"]:
-                    output = self.model.generate(
+                    output = self.scheduler.run(
+                        self.model.generate,
                         prompt,
                         callback=callback,
                         n_predict=n_predict,
@@ -1621,7 +1657,8 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
                         n_threads=int(self.config["n_threads"]),
                     )
                 else:
-                    output = self.model.generate(
+                    output = self.scheduler.run(
+                        self.model.generate,
                         prompt,
                         callback=callback,
                         n_predict=n_predict,
@@ -1755,7 +1792,7 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
 
                     client.generation_routine = self.loop.run_in_executor(
                         None, # Use default ThreadPoolExecutor
-                        partial(self.generate, # The potentially blocking function
+                        partial(self.scheduler.in_request(self.generate, "socket", client_id), # The potentially blocking function, one generation slot for the whole turn
                         context_details,
                         message_id=message_id,
                         client_id=client_id,
@@ -1898,11 +1935,12 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
         discussion_messages +f"\n{self.user_custom_header('user')}Your response should only contain the title without any comments or thoughts.\n"
         discussion_messages += discussion_title
         title = [""]
+        matcher = self.personality.stop_sequence_matcher()
 
         def receive(chunk: str, message_type: MSG_OPERATION_TYPE):
             if chunk:
                 title[0] += chunk
-            antiprompt = self.personality.detect_antiprompt(title[0])
+            antiprompt = matcher.scan(title[0])
             if antiprompt:
                 ASCIIColors.warning(f"\n{antiprompt} detected. Stopping generation")
                 title[0] = self.remove_text_from_string(title[0], antiprompt)
@@ -1914,7 +1952,97 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
         title[0] = self.personality.remove_thinking_blocks(title[0])
         ASCIIColors.info(f"TITLE:{title[0]}")
         return title[0]
+    def build_mounted_personality(self, personality_path:str):
+        """
+        Builds a configured personality, reinstalling it if it fails to load.
+
+        Returns:
+            tuple: (personality, failed). When even the reinstall fails, the default personality is returned and failed is True.
+        """
+        try:
+            personality = AIPersonality(
+                personality_path,
+                self.lollms_paths,
+                self.config,
+                model=self.model,
+                app=self,
+                selected_language=self.config.current_language,
+                run_scripts=True,
+            )
+            if self.config.auto_read and len(personality.audio_samples) > 0:
+                pass # self.tts
+            return personality, False
+        except Exception as ex:
+            trace_exception(ex)
+            ASCIIColors.error(
+                f"Personality file not found or is corrupted ({personality_path}).\nReturned the following exception:{ex}\nPlease verify that the personality you have selected exists or select another personality. Some updates may lead to change in personality name or category, so check the personality selection in settings to be sure."
+            )
+            ASCIIColors.info("Trying to force reinstall")
+            if self.config["debug"]:
+                print(ex)
+        try:
+            personality = AIPersonality(
+                personality_path,
+                self.lollms_paths,
+                self.config,
+                self.model,
+                app=self,
+                run_scripts=True,
+                selected_language=self.config.current_language,
+                installation_option=InstallOption.FORCE_INSTALL,
+            )
+            if personality.processor:
+                personality.processor.mounted()
+            return personality, False
+        except Exception as ex:
+            ASCIIColors.error(
+                f"Couldn't load personality at {personality_path}"
+            )
+            trace_exception(ex)
+            ASCIIColors.info(f"Unmounting personality")
+        personality = AIPersonality(
+            None,
+            self.lollms_paths,
+            self.config,
+            self.model,
+            app=self,
+            run_scripts=True,
+            installation_option=InstallOption.FORCE_INSTALL,
+        )
+        if personality.processor:
+            personality.processor.mounted()
+        ASCIIColors.info("Reverted to default personality")
+        return personality, True
+
+    def get_mounted_personality(self, id:int) -> AIPersonality:
+        """
+        Returns a mounted personality, building it first if it was mounted lazily.
+        A lazily mounted personality that can't be built is unmounted and None is returned.
+        """
+        personality = self.mounted_personalities[id]
+        if isinstance(personality, LazyPersonality):
+            lazy_personality = personality
+            personality = lazy_personality.load()
+            if lazy_personality.failed:
+                del self.mounted_personalities[id]
+                personality_path = self.config["personalities"].pop(id)
+                if self.config["active_personality_id"]>id:
+                    self.config["active_personality_id"]-=1
+                if self.config["active_personality_id"]>=len(self.config["personalities"]):
+                    self.config["active_personality_id"] = 0
+                ASCIIColors.info(f"removed personality {personality_path}")
+                return None
+            self.mounted_personalities[id] = personality
+        return personality
+
     def rebuild_personalities(self, reload_all=False):
+        """
+        Mounts the personalities listed in the configuration, reusing the ones already mounted.
+
+        The personalities to build are built concurrently. When lazy_personalities_mounting is set, only the
+        active personality is built and the others are mounted as LazyPersonality proxies that are built
+        the first time they are used (when selected for example).
+        """
         if reload_all:
             self.mounted_personalities = []
 
@@ -1927,6 +2055,8 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
         ASCIIColors.success(f" ║           Building mounted Personalities         ║ ")
         ASCIIColors.success(f" ╚══════════════════════════════════════════════════╝ ")
         to_remove = []
+        to_build = {}
+        lazy = self.config.get("lazy_personalities_mounting", True)
         for i, personality in enumerate(self.config["personalities"]):
             if i == self.config["active_personality_id"]:
                 ASCIIColors.red("*", end="")
@@ -1935,70 +2065,36 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
                 ASCIIColors.yellow(f" {personality}")
             if personality in loaded_names:
                 mounted_personalities.append(loaded[loaded_names.index(personality)])
+            elif lazy and i != self.config["active_personality_id"]:
+                mounted_personalities.append(LazyPersonality(personality, self.build_mounted_personality))
             else:
-                personality_path = f"{personality}"
-                try:
-                    personality = AIPersonality(
-                        personality_path,
-                        self.lollms_paths,
-                        self.config,
-                        model=self.model,
-                        app=self,
-                        selected_language=self.config.current_language,
-                        run_scripts=True,
-                    )
-
-                    mounted_personalities.append(personality)
-                    if self.config.auto_read and len(personality.audio_samples) > 0:
-                        pass # self.tts
-                except Exception as ex:
-                    trace_exception(ex)
-                    ASCIIColors.error(
-                        f"Personality file not found or is corrupted ({personality_path}).\nReturned the following exception:{ex}\nPlease verify that the personality you have selected exists or select another personality. Some updates may lead to change in personality name or category, so check the personality selection in settings to be sure."
-                    )
-                    ASCIIColors.info("Trying to force reinstall")
-                    if self.config["debug"]:
-                        print(ex)
-                    try:
-                        personality = AIPersonality(
-                            personality_path,
-                            self.lollms_paths,
-                            self.config,
-                            self.model,
-                            app=self,
-                            run_scripts=True,
-                            selected_language=self.config.current_language,
-                            installation_option=InstallOption.FORCE_INSTALL,
-                        )
-                        mounted_personalities.append(personality)
-                        if personality.processor:
-                            personality.processor.mounted()
-                    except Exception as ex:
-                        ASCIIColors.error(
-                            f"Couldn't load personality at {personality_path}"
-                        )
-                        trace_exception(ex)
-                        ASCIIColors.info(f"Unmounting personality")
+                mounted_personalities.append(None)
+                to_build[i] = personality
+
+        def build(personality_path):
+            start = time.perf_counter()
+            personality, failed = self.build_mounted_personality(personality_path)
+            return personality, failed, time.perf_counter() - start
+
+        if len(to_build) > 0:
+            with ThreadPoolExecutor(max_workers=max(1, min(len(to_build), self.config.get("personalities_mount_workers", 4)))) as executor:
+                futures = {i: executor.submit(build, personality_path) for i, personality_path in to_build.items()}
+                for i, future in futures.items():
+                    personality, failed, load_time = future.result()
+                    mounted_personalities[i] = personality
+                    if failed:
                         to_remove.append(i)
-                        personality = AIPersonality(
-                            None,
-                            self.lollms_paths,
-                            self.config,
-                            self.model,
-                            app=self,
-                            run_scripts=True,
-                            installation_option=InstallOption.FORCE_INSTALL,
-                        )
-                        mounted_personalities.append(personality)
-                        if personality.processor:
-                            personality.processor.mounted()
-
-                        ASCIIColors.info("Reverted to default personality")
-        if self.config["active_personality_id"] >= 0 and self.config[
-            "active_personality_id"
-        ] < len(self.config["personalities"]):
+                    ASCIIColors.info(f"{to_build[i]} loaded in {load_time:.2f}s")
+
+        active_id = self.config["active_personality_id"]
+        if active_id >= 0 and active_id < len(self.config["personalities"]):
+            if isinstance(mounted_personalities[active_id], LazyPersonality):
+                lazy_personality = mounted_personalities[active_id]
+                mounted_personalities[active_id] = lazy_personality.load()
+                if lazy_personality.failed:
+                    to_remove.append(active_id)
             ASCIIColors.success(
-                f'selected model : {self.config["personalities"][self.config["active_personality_id"]]}'
+                f'selected model : {self.config["personalities"][active_id]}'
             )
         else:
             ASCIIColors.warning(
@@ -2023,7 +2119,7 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
         for index in to_remove:
             if 0 <= index < len(mounted_personalities):
                 mounted_personalities.pop(index)
-                self.config["personalities"].pop(index)
+                personality_path = self.config["personalities"].pop(index)
                 ASCIIColors.info(f"removed personality {personality_path}")
 
         if self.config["active_personality_id"] >= len(self.config["personalities"]):
@@ -2210,8 +2306,9 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
             if data:
                 client.generated_text += data
 
-            # Detect antiprompt (sync - assuming detect_antiprompt is sync)
-            antiprompt = current_personality.detect_antiprompt(client.generated_text)
+            # Detect antiprompt (sync, only the new part of the text is scanned)
+            client.stop_sequence_matcher = current_personality.stop_sequence_matcher(client.stop_sequence_matcher)
+            antiprompt = client.stop_sequence_matcher.scan(client.generated_text)
             if antiprompt:
                 ASCIIColors.warning(f"\n{antiprompt} detected. Stopping generation")
                 # Modify text (sync)
@@ -2285,8 +2382,10 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
 
             # Set content (sync)
             client.generated_text = data
-            # Detect antiprompt (sync)
-            antiprompt = current_personality.detect_antiprompt(client.generated_text)
+            # Detect antiprompt (sync, the content is replaced so the detector restarts)
+            client.stop_sequence_matcher = current_personality.stop_sequence_matcher(client.stop_sequence_matcher)
+            client.stop_sequence_matcher.reset()
+            antiprompt = client.stop_sequence_matcher.scan(client.generated_text)
             if antiprompt:
                 ASCIIColors.warning(f"\n{antiprompt} detected. Stopping generation")
                 client.generated_text = self.remove_text_from_string(
@@ -2385,7 +2484,8 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
         sys.stdout.flush()
         if chunk:
             generation_infos["generated_text"] += chunk
-        antiprompt = self.personality.detect_antiprompt(generation_infos["generated_text"])
+        generation_infos["stop_sequence_matcher"] = self.personality.stop_sequence_matcher(generation_infos.get("stop_sequence_matcher"))
+        antiprompt = generation_infos["stop_sequence_matcher"].scan(generation_infos["generated_text"])
         if antiprompt:
             ASCIIColors.warning(f"\n{antiprompt} detected. Stopping generation")
             generation_infos["generated_text"] = self.remove_text_from_string(generation_infos["generated_text"],antiprompt)
@@ -2520,8 +2620,12 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
 
     def select_personality(self, id:int):
         if id<len(self.config.personalities):
+            personality = self.get_mounted_personality(id)
+            if personality is None:
+                self.config.save_config()
+                return False
             self.config.active_personality_id = id
-            self.personality = self.mounted_personalities[id]
+            self.personality = personality
             self.config.save_config()
             return True
         else:
@@ -2622,6 +2726,36 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
             discussion += "\n" + self.config.discussion_prompt_separator + msg.sender + ": " + msg.content.strip()
         return discussion
     # -------------------------------------- Prompt preparing
+    def tokenize_message(self, message_id:int, text:str) -> list:
+        """
+        Tokenizes a formatted discussion message, reusing the tokens computed during previous turns.
+
+        Entries are keyed by message id and are only reused if the formatted text (content and template)
+        and the model are unchanged, so edits, template changes and model switches are transparently handled.
+
+        Args:
+            message_id (int): The id of the message.
+            text (str): The formatted message text (headers + content + separator).
+
+        Returns:
+            list: The tokens of the text.
+        """
+        model_key = (self.config.binding_name, self.config.model_name)
+        text_hash = hashlib.sha1(text.encode("utf-8", errors="ignore")).hexdigest()
+        # prepare_query runs in the generation threads of several clients
+        with self.message_tokens_cache_lock:
+            entry = self.message_tokens_cache.get(message_id)
+            if entry is not None and entry[0] == model_key and entry[1] == text_hash:
+                self.message_tokens_cache.move_to_end(message_id)
+                return entry[2]
+        tokens = self.model.tokenize(text)
+        with self.message_tokens_cache_lock:
+            self.message_tokens_cache[message_id] = (model_key, text_hash, tokens)
+            self.message_tokens_cache.move_to_end(message_id)
+            while len(self.message_tokens_cache) > self.message_tokens_cache_size:
+                self.message_tokens_cache.popitem(last=False)
+        return tokens
+
     def prepare_query(self, client_id: str, message_id: int = -1, is_continue: bool = False, n_tokens: int = 0, generation_type = None, force_using_internet=False, previous_chunk="") -> LollmsContextDetails:
         """
         Prepares the query for the model.
@@ -2644,7 +2778,8 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
         # Get the list of messages
         client = self.session.get_client(client_id)
         discussion = client.discussion
-        messages = discussion.get_messages()
+        # Only the light columns are read here, contents are fetched for the messages that fit in the context
+        messages = discussion.get_messages(lazy=True)
 
         # Find the index of the message with the specified message_id
         message_index = -1
@@ -2665,9 +2800,9 @@ Don't forget encapsulate the code inside a markdown code tag. This is mandatory.
             for fc in self.config.mounted_function_calls:
                 if fc["selected"]:
                     fci = self.load_function_call(fc, client)
-                    if "block_rag" in fci and fci["block_rag"]:
-                        block_rag = True
                     if fci:
+                        if "block_rag" in fci and fci["block_rag"]:
+                            block_rag = True
                         function_calls.append(fci)
                         
         # Check if there are document files to add to the prompt
@@ -2759,61 +2894,41 @@ Answer directly with the reformulation of the last prompt.
                     # Inform the user    
                     self.personality.step_start("Querying the RAG datalake")
 
-                    # RAGs
-                    # if len(self.active_datalakes) > 0:
-                    #     recovered_ids=[[] for _ in range(len(self.active_datalakes))]
-                    #     for i,db in enumerate(self.active_datalakes):
-                    #         if db['mounted']:
-                    #             try:
-                    #                 if db["type"]=="safe_store":
-                                        
-                    #                     ss:SafeStore = db["binding"]
-                    #                     vectorizer_name:str = db["vectorizer_name"]
-                    #                     r=ss.query(query, vectorizer_name, top_k= self.config.rag_n_chunks)
-                    #                     recovered_ids[i]+=[rg.chunk_id for rg in r]
-                    #                     if self.config.rag_activate_multi_hops:
-                    #                         r = [rg for rg in r if self.personality.verify_rag_entry(query, rg.text)]
-                    #                     documentation += "\n".join(["## chunk" + research_result[]  for research_result in r])+"\n"
-                    #             except Exception as ex:
-                    #                 trace_exception(ex)
-                    #                 self.personality.error(f"Couldn't recover information from Datalake {db['alias']}")
-
-                    # TODO : upgrade to safe_store
-                    # if self.personality.persona_data_vectorizer:
-                    #     chunks:List[Chunk] = self.personality.persona_data_vectorizer.search(query, int(self.config.rag_n_chunks))
-                    #     for chunk in chunks:
-                    #         if self.config.rag_put_chunk_informations_into_context:
-                    #             documentation += f"{self.system_custom_header('document chunk')}\n## document title: {chunk.doc.title}\n## chunk content:\n{chunk.text}\n"
-                    #         else:
-                    #             documentation += f"{self.system_custom_header('chunk')}\n{chunk.text}\n"
-
-                    if (len(client.discussion.text_files) > 0) and client.discussion.vectorizer is not None:
-                        chunks = client.discussion.vectorizer.query(query, self.config.rag_vectorizer)
-                        for chunk in chunks:
-                            if self.config.rag_put_chunk_informations_into_context:
-                                documentation += f"{self.system_custom_header('document chunk')}\n## document title: {chunk.doc['metadata']}\n## chunk content:\n{chunk['chunk_text']}\n"
-                            else:
-                                documentation += f"{self.start_header_id_template}chunk{self.end_header_id_template}\n{chunk['chunk_text']}\n"                    
+                    # RAGs: datalakes, persona data and discussion documents are queried at the same time
+                    retriever = FederatedRetriever(
+                                                    self.model.count_tokens,
+                                                    timeout=float(self.config.get("rag_source_timeout", 2)),
+                                                    min_similarity=self.config.rag_min_correspondance
+                                                )
+                    max_documentation_tokens = int(self.config.get("rag_max_documentation_tokens", 0)) or self.config.ctx_size//4
+                    chunks = retriever.retrieve(self.get_rag_sources(client), query, int(self.config.rag_n_chunks), max_documentation_tokens)
+                    if self.config.rag_activate_multi_hops and len(chunks) > 0:
+                        relevant = self.personality.verify_rag_entries(query, [chunk["chunk_text"] for chunk in chunks])
+                        chunks = [chunks[i] for i in relevant]
+                    for chunk in chunks:
+                        if self.config.rag_put_chunk_informations_into_context:
+                            documentation += f"{self.system_custom_header('document chunk')}\n## document title: {chunk['title']}\n## chunk content:\n{chunk['chunk_text']}\n"
+                        else:
+                            documentation += f"{self.start_header_id_template}chunk{self.end_header_id_template}\n{chunk['chunk_text']}\n"
                     # Check if there is discussion knowledge to add to the prompt
-                    # if self.config.activate_skills_lib:
-                    #     try:
-                    #         # skills = self.skills_library.query_entry(query)
-                    #         self.personality.step_start("Adding skills")
-                    #         if self.config.debug:
-                    #             ASCIIColors.info(f"Query : {query}")
-                    #         skill_titles, skills, similarities = self.skills_library.query_vector_db(query, top_k=3, min_similarity=self.config.rag_min_correspondance)#query_entry_fts(query)
-                    #         skills_detials=[{"title": title, "content":content, "similarity":similarity} for title, content, similarity in zip(skill_titles, skills, similarities)]
-
-                    #         if len(skills)>0:
-                    #             if documentation=="":
-                    #                 documentation=f"{self.system_custom_header('skills library knowledges')}\n"
-                    #             for i,skill in enumerate(skills_detials):
-                    #                 documentation += "---\n"+ self.system_custom_header(f"knowledge {i}") +f"\ntitle:\n{skill['title']}\ncontent:\n{skill['content']}\n---\n"
-                    #         self.personality.step_end("Adding skills")
-                    #     except Exception as ex:
-                    #         trace_exception(ex)
-                    #         self.warning("Couldn't add long term memory information to the context. Please verify the vector database")        # Add information about the user
-                    #         self.personality.step_end("Adding skills")
+                    if self.config.activate_skills_lib:
+                        try:
+                            self.personality.step_start("Adding skills")
+                            if self.config.debug:
+                                ASCIIColors.info(f"Query : {query}")
+                            # keyword and vector search in a single hybrid query
+                            skills_detials = self.skills_library.query(query, top_k=3, min_similarity=self.config.rag_min_correspondance)
+
+                            if len(skills_detials)>0:
+                                if documentation=="":
+                                    documentation=f"{self.system_custom_header('skills library knowledges')}\n"
+                                for i,skill in enumerate(skills_detials):
+                                    documentation += "---\n"+ self.system_custom_header(f"knowledge {i}") +f"\ntitle:\n{skill['title']}\ncontent:\n{skill['content']}\n---\n"
+                            self.personality.step_end("Adding skills")
+                        except Exception as ex:
+                            trace_exception(ex)
+                            self.warning("Couldn't add long term memory information to the context. Please verify the vector database")        # Add information about the user
+                            self.personality.step_end("Adding skills")
 
                     # Inform the user    
                     self.personality.step_end("Querying the RAG datalake")
@@ -2862,16 +2977,16 @@ Answer directly with the reformulation of the last prompt.
                     internet_search_results=f"{self.system_full_header}Use the web search results data to answer {self.config.user_name}. Try to extract information from the web search and use it to perform the requested task or answer the question. Do not come up with information that is not in the websearch results. Try to stick to the websearch results and clarify if your answer was based on the resuts or on your own culture. If you don't know how to perform the task, then tell the user politely that you need more data inputs.{self.separator_template}{self.start_header_id_template}Web search results{self.end_header_id_template}\n"
 
 
-                    chunks:List[Chunk] = self.personality.internet_search_with_vectorization(query, self.config.internet_quick_search, asses_using_llm=self.config.activate_internet_pages_judgement)
+                    chunks = self.personality.internet_search_with_vectorization(query, self.config.internet_quick_search, asses_using_llm=self.config.activate_internet_pages_judgement)
                     
                     if len(chunks)>0:
                         for chunk in chunks:
                             internet_search_infos.append({
-                                "title":chunk.doc.title,
-                                "url":chunk.doc.path,
-                                "brief":chunk.text
+                                "title":chunk["title"],
+                                "url":chunk["url"],
+                                "brief":chunk["chunk_text"]
                             })
-                            internet_search_results += self.system_custom_header("search result chunk")+f"\nchunk_infos:{chunk.doc.path}\nchunk_title:{chunk.doc.title}\ncontent:{chunk.text}\n"
+                            internet_search_results += self.system_custom_header("search result chunk")+f"\nchunk_infos:{chunk['url']}\nchunk_title:{chunk['title']}\ncontent:{chunk['chunk_text']}\n"
                     else:
                         internet_search_results += "The search response was empty!\nFailed to recover useful information from the search engine.\n"
                     internet_search_results += self.system_custom_header("information") + "Use the search results to answer the user question."
@@ -2950,110 +3065,84 @@ Answer directly with the reformulation of the last prompt.
             self.InfoMessage(f"Not enough space in context!!\nVerify that your vectorization settings for documents or internet search are realistic compared to your context size.\nYou are {available_space} short of context!")
             raise Exception("Not enough space in context!!")
 
-        # Accumulate messages until the cumulative number of tokens exceeds available_space
-        tokens_accumulated = 0
+        def message_content(message):
+            if self.config.keep_thoughts:
+                return message.content.strip()
+            else:
+                return self.personality.remove_thinking_blocks(message.content).strip()
 
+        def message_header(message):
+            if message.sender_type == SENDER_TYPES.SENDER_TYPES_AI.value:
+                if self.config.use_assistant_name_in_discussion:
+                    if self.config.use_model_name_in_discussions:
+                        return self.ai_custom_header(message.sender+f"({message.model})")
+                    else:
+                        return self.ai_full_header
+                else:
+                    if self.config.use_model_name_in_discussions:
+                        return self.ai_custom_header("assistant"+f"({message.model})")
+                    else:
+                        return self.ai_custom_header("assistant")
+            else:
+                if self.config.use_user_name_in_discussions:
+                    return self.user_full_header
+                else:
+                    return self.user_custom_header("user")
 
-        # Initialize a list to store the full messages
-        full_message_list = []
+        def is_visible(message):
+            # Check if the message content is not empty and visible to the AI
+            return message.content != '' and (
+                    message.message_type <= MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_SET_CONTENT_INVISIBLE_TO_USER.value and message.message_type != MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_SET_CONTENT_INVISIBLE_TO_AI.value)
+
+        # Accumulate messages until the cumulative number of tokens exceeds available_space
+        tokens_accumulated = 0
+        # Texts of the kept messages in chronological order
+        full_message_texts = []
         # If this is not a continue request, we add the AI prompt
         if not is_continue:
-            message_tokenized = self.model.tokenize(
-                self.personality.ai_message_prefix.strip()
-            )
-            full_message_list.append(message_tokenized)
-            # Update the cumulative number of tokens
-            tokens_accumulated += len(message_tokenized)
-
+            tokens_accumulated += len(self.model.tokenize(self.personality.ai_message_prefix.strip()))
 
         if generation_type != "simple_question":
-            # Accumulate messages starting from message_index
-            for i in range(message_index, -1, -1):
-                message = messages[i]
-
-                # Check if the message content is not empty and visible to the AI
-                if message.content != '' and (
-                        message.message_type <= MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_SET_CONTENT_INVISIBLE_TO_USER.value and message.message_type != MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_SET_CONTENT_INVISIBLE_TO_AI.value):
-
-                    if self.config.keep_thoughts:
-                        content = message.content
-                    else:
-                        content = self.personality.remove_thinking_blocks(message.content)
-                        
-                    if message.sender_type == SENDER_TYPES.SENDER_TYPES_AI.value:
-                        if self.config.use_assistant_name_in_discussion:
-                            if self.config.use_model_name_in_discussions:
-                                msg = self.ai_custom_header(message.sender+f"({message.model})") + content.strip()
-                            else:
-                                msg = self.ai_full_header + content.strip()
-                        else:
-                            if self.config.use_model_name_in_discussions:
-                                msg = self.ai_custom_header("assistant"+f"({message.model})") + content.strip()
-                            else:
-                                msg = self.ai_custom_header("assistant") + content.strip()
-                    else:
-                        if self.config.use_user_name_in_discussions:
-                            msg = self.user_full_header + content.strip()
-                        else:
-                            msg = self.user_custom_header("user") + content.strip()
-                    msg += self.separator_template
-                    message_tokenized = self.model.tokenize(msg)
-
-                    # Check if adding the message will exceed the available space
-                    if tokens_accumulated + len(message_tokenized) > available_space:
-                        # Update the cumulative number of tokens
-                        msg = message_tokenized[-(available_space-tokens_accumulated):]
-                        tokens_accumulated += available_space-tokens_accumulated
-                        full_message_list.insert(0, msg)
-                        break
-
-                    # Add the tokenized message to the full_message_list
-                    full_message_list.insert(0, message_tokenized)
-
-                    # Update the cumulative number of tokens
-                    tokens_accumulated += len(message_tokenized)
+            # Messages are loaded and formatted lazily from message_index backwards.
+            # The budget uses the token counts stored with the messages, only messages without a usable count
+            # and the boundary message are tokenized (and cached between turns)
+            tokenizer_id = get_tokenizer_id(self)
+            headers_tokens = {}
+            counted_messages = []
+            def entries():
+                for message in (discussion.iter_messages_reversed(message_index, messages) if message_index>=0 else []):
+                    if not is_visible(message):
+                        continue
+                    header = message_header(message)
+                    content = message_content(message)
+                    n_tokens = None
+                    if content == message.content.strip(): # the stored count does not apply once thinking blocks are removed
+                        if message.content_tokens is None or message.tokenizer != tokenizer_id:
+                            counted_messages.extend(discussion.update_tokens_counts([message], save=False))
+                        if message.content_tokens is not None:
+                            if header not in headers_tokens:
+                                headers_tokens[header] = self.model.count_tokens(header + self.separator_template)
+                            n_tokens = message.content_tokens + headers_tokens[header]
+                    yield (message.id, header + content + self.separator_template, n_tokens)
+
+            full_message_texts, tokens_accumulated = fit_to_token_budget(
+                                                                            entries(),
+                                                                            available_space,
+                                                                            self.tokenize_message,
+                                                                            self.model.detokenize,
+                                                                            tokens_accumulated
+                                                                        )
+            discussion.save_tokens_counts(counted_messages)
         else:
             message = messages[message_index]
+            if is_visible(message):
+                msg = message_header(message) + message_content(message)
+                tokens_accumulated += len(self.tokenize_message(message.id, msg))
+                full_message_texts.append(msg)
 
-            # Check if the message content is not empty and visible to the AI
-            if message.content != '' and (
-                    message.message_type <= MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_SET_CONTENT_INVISIBLE_TO_USER.value and message.message_type != MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_SET_CONTENT_INVISIBLE_TO_AI.value):
-                if self.config.keep_thoughts:
-                    content = message.content
-                else:
-                    content = self.personality.remove_thinking_blocks(message.content)
-
-                if message.sender_type == SENDER_TYPES.SENDER_TYPES_AI.value:
-                    if self.config.use_assistant_name_in_discussion:
-                        if self.config.use_model_name_in_discussions:
-                            msg = self.ai_custom_header(message.sender+f"({message.model})") + content.strip()
-                        else:
-                            msg = self.ai_full_header + content.strip()
-                    else:
-                        if self.config.use_model_name_in_discussions:
-                            msg = self.ai_custom_header("assistant"+f"({message.model})") + content.strip()
-                        else:
-                            msg = self.ai_custom_header("assistant") + content.strip()
-                else:
-                    if self.config.use_user_name_in_discussions:
-                        msg = self.user_full_header + content.strip()
-                    else:
-                        msg = self.user_custom_header("user") + content.strip()
-                message_tokenized = self.model.tokenize(msg)
-
-                # Add the tokenized message to the full_message_list
-                full_message_list.insert(0, message_tokenized)
+        discussion_messages = "".join(full_message_texts)
 
-                # Update the cumulative number of tokens
-                tokens_accumulated += len(message_tokenized)
-
-        # Build the final discussion messages by detokenizing the full_message_list
-        discussion_messages = ""
-        for i in range(len(full_message_list)-1 if not is_continue else len(full_message_list)):
-            message_tokens = full_message_list[i]
-            discussion_messages += self.model.detokenize(message_tokens)
-        
-        if len(full_message_list)>0:
+        if not is_continue or len(full_message_texts)>0:
             ai_prefix = self.personality.ai_message_prefix
         else:
             ai_prefix = ""
@@ -41,14 +41,128 @@ from huggingface_hub import hf_hub_download, snapshot_download
 from huggingface_hub.utils import HfHubHTTPError, RepositoryNotFoundError, RevisionNotFoundError, EntryNotFoundError
 from tqdm import tqdm
 from lollms.databases.models_database import ModelsDB
+from lollms.downloader import ChunkedDownloader, DownloadError, DownloadIntegrityError
 import sys
 import re
+import hashlib
+from collections import OrderedDict
 __author__ = "parisneo"
 __github__ = "https://github.com/ParisNeo/lollms_bindings_zoo"
 __copyright__ = "Copyright 2023, "
 __license__ = "Apache 2.0"
 
 
+class TokenizationCache:
+    """
+    Bounded LRU cache of tokenization results shared by all the callers of a binding.
+
+    Entries are keyed by the model identity and the content (the sha1 of the text, or the tokens themselves
+    for detokenization). A None model identity (no model loaded yet) bypasses the cache. The cache is bounded by the total number of tokens it holds rather than by its number
+    of entries, so a few long documents evict each other instead of pushing out every small header.
+    """
+    def __init__(self, max_tokens:int=1000000):
+        """
+        Args:
+            max_tokens (int, optional): Maximum number of tokens held by the cache. 0 disables the cache. Defaults to 1000000.
+        """
+        self.max_tokens = max_tokens
+        self._entries:OrderedDict = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _text_key(text:str) -> bytes:
+        return hashlib.sha1(text.encode("utf-8", errors="ignore")).digest()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _put(self, key, value, size:int):
+        if size > self.max_tokens:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_tokens:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def tokenize(self, model_key, text:str, tokenize:Callable):
+        """
+        Returns tokenize(text), from the cache when possible.
+        """
+        if self.max_tokens <= 0 or model_key is None or not isinstance(text, str):
+            return tokenize(text)
+        key = (model_key, "tokenize", self._text_key(text))
+        tokens = self._get(key)
+        if tokens is None:
+            tokens = tokenize(text)
+            self._put(key, tokens, max(1, len(tokens)))
+        # callers are free to modify the list they get
+        return list(tokens) if isinstance(tokens, list) else tokens
+
+    def detokenize(self, model_key, tokens_list, detokenize:Callable):
+        """
+        Returns detokenize(tokens_list), from the cache when possible.
+        """
+        if self.max_tokens <= 0 or model_key is None or not isinstance(tokens_list, (list, tuple)):
+            return detokenize(tokens_list)
+        key = (model_key, "detokenize", tuple(tokens_list))
+        text = self._get(key)
+        if text is None:
+            text = detokenize(tokens_list)
+            self._put(key, text, max(1, len(tokens_list)))
+        return text
+
+    def count_tokens(self, model_key, text:str, count_tokens:Callable) -> int:
+        """
+        Returns count_tokens(text), from the cache when possible.
+        """
+        if self.max_tokens <= 0 or model_key is None or not isinstance(text, str):
+            return count_tokens(text)
+        key = (model_key, "count_tokens", self._text_key(text))
+        n_tokens = self._get(key)
+        if n_tokens is None:
+            n_tokens = count_tokens(text)
+            self._put(key, n_tokens, 1)
+        return n_tokens
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def get_stats(self) -> dict:
+        """
+        Returns the size of the cache and its hit/miss counters.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "max_tokens": self.max_tokens,
+                "size": self._size,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits/lookups if lookups > 0 else 0.0
+            }
+
+
 class LLMBinding:
     
     def __init__(
@@ -76,6 +190,10 @@ class LLMBinding:
 
         self.download_infos={}
 
+        self.tokenization_cache = TokenizationCache(config.get("tokenization_cache_max_tokens", 1000000))
+        self._model_builds      = 0 # incremented around each build_model, part of the tokenization cache key
+        self._install_tokenization_cache()
+
         self.add_default_configurations(binding_config)
 
         self.interrogatorStorer = None
@@ -213,6 +331,42 @@ class LLMBinding:
         """
         return len(self.tokenize(prompt))
 
+    def get_tokenizer_key(self):
+        """
+        Returns the identity of the tokenizer used to key the tokenization cache,
+        None while no model was built (the results of the fallback tokenizer are not cached).
+        """
+        if self._model_builds == 0:
+            return None
+        return (self.binding_folder_name, getattr(self, "model_name", None) or self.config.model_name, self._model_builds)
+
+    def _install_tokenization_cache(self):
+        """
+        Routes tokenize, detokenize and count_tokens through the tokenization cache.
+        The methods are wrapped on the instance so that the implementations of the bindings are cached too.
+        """
+        cache = self.tokenization_cache
+        tokenize = self.tokenize
+        detokenize = self.detokenize
+        self.tokenize = lambda prompt: cache.tokenize(self.get_tokenizer_key(), prompt, tokenize)
+        self.detokenize = lambda tokens_list: cache.detokenize(self.get_tokenizer_key(), tokens_list, detokenize)
+        if type(self).count_tokens is not LLMBinding.count_tokens:
+            # the binding has its own counting (a remote count endpoint for example)
+            count_tokens = self.count_tokens
+            self.count_tokens = lambda prompt: cache.count_tokens(self.get_tokenizer_key(), prompt, count_tokens)
+
+        build_model = self.build_model
+        def build_model_with_new_tokenizer(*args, **kwargs):
+            # The tokenizer may change with the model: the key changes before the build starts and once it is done,
+            # so nothing computed with the previous tokenizer (or during the build) is served afterwards
+            self._model_builds += 1
+            try:
+                return build_model(*args, **kwargs)
+            finally:
+                self._model_builds += 1
+                cache.clear()
+        self.build_model = build_model_with_new_tokenizer
+
     def searchModelFolder(self, model_name:str):
         for mn in self.models_folders:
             if mn.name in model_name.lower():
@@ -307,35 +461,37 @@ class LLMBinding:
         binding_config.config.file_path = self.configuration_file_path
 
 
-    def download_file(self, url, installation_path, callback=None):
+    def get_downloader(self, headers=None) -> ChunkedDownloader:
+        """
+        Returns a download engine configured with the download settings (connections and bandwidth limit).
+        """
+        return ChunkedDownloader(
+                                    connections=int(self.config.get("download_connections", 4)),
+                                    max_bytes_per_second=float(self.config.get("download_max_bandwidth", 0))*1024*1024,
+                                    headers=headers
+                                )
+
+    def download_file(self, url, installation_path, callback=None, expected_sha256=None):
         """
         Downloads a file from a URL, reports the download progress using a callback function, and displays a progress bar.
+        The file is downloaded with parallel range requests, interrupted downloads are resumed and the sha256 is verified
+        when it is known (expected_sha256 or announced by the server).
 
         Args:
             url (str): The URL of the file to download.
             installation_path (str): The path where the file should be saved.
             callback (function, optional): A callback function to be called during the download
-                with the progress percentage as an argument. Defaults to None.
+                with the downloaded size and the total size as arguments. Defaults to None.
+            expected_sha256 (str, optional): The sha256 the downloaded file must have.
         """
         try:
-            response = requests.get(url, stream=True)
-
-            # Get the file size from the response headers
-            total_size = int(response.headers.get('content-length', 0))
-
-            with open(installation_path, 'wb') as file:
-                downloaded_size = 0
-                with tqdm(total=total_size, unit='B', unit_scale=True, ncols=80) as progress_bar:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            file.write(chunk)
-                            downloaded_size += len(chunk)
-                            if callback is not None:
-                                callback(downloaded_size, total_size)
-                            progress_bar.update(len(chunk))
-
-            if callback is not None:
-                callback(total_size, total_size)
+            with tqdm(total=0, unit='B', unit_scale=True, ncols=80) as progress_bar:
+                def report(downloaded_size, total_size):
+                    progress_bar.total = total_size
+                    progress_bar.update(downloaded_size - progress_bar.n)
+                    if callback is not None:
+                        callback(downloaded_size, total_size)
+                self.get_downloader().download(url, installation_path, expected_sha256, report)
 
             print("File downloaded successfully")
         except Exception as e:
@@ -445,8 +601,31 @@ class LLMBinding:
                 # SINGLE FILE DOWNLOAD using hf_hub_download
                 ASCIIColors.info(f"Downloading single file: {filename} from {repo_id} to {target_path.parent}")
 
+                loop = asyncio.get_running_loop()
+                def report_progress(downloaded_size, total_size):
+                    # called from the download threads at most every progress_interval seconds
+                    elapsed = time.time() - start_time
+                    asyncio.run_coroutine_threadsafe(self.lollmsCom.notify_model_install(
+                        installation_path=installation_path_str, model_name=model_name, binding_folder=binding_folder,
+                        model_url=model_url, start_time=start_time, total_size=total_size, downloaded_size=downloaded_size,
+                        progress=100*downloaded_size/total_size if total_size > 0 else 0.0,
+                        speed=downloaded_size/elapsed if elapsed > 0 else 0.0, client_id=client_id, status=True, error=""
+                    ), loop)
+
                 # Define the blocking download function
                 def _download_file():
+                    # Parallel range requests with resume, the sha256 announced by the hub is verified
+                    try:
+                        try:
+                            from huggingface_hub.utils import build_hf_headers
+                            headers = build_hf_headers()
+                        except Exception:
+                            headers = None
+                        return str(self.get_downloader(headers).download(model_url, target_path, progress_callback=report_progress))
+                    except DownloadIntegrityError:
+                        raise
+                    except DownloadError as ex:
+                        ASCIIColors.warning(f"Parallel download failed ({ex}), falling back to the hub client")
                     # Download directly into the target PARENT folder
                     downloaded_path_str = hf_hub_download(
                         repo_id=repo_id,
@@ -18,6 +18,7 @@ class Client:
 
         self.rag_databases = []
         self.generated_text = ""
+        self.stop_sequence_matcher = None # incremental antiprompt detection over generated_text
         self.cancel_generation = False
         self.generation_routine:Thread = None
         self.processing = False
@@ -86,6 +86,7 @@ class ConfigTemplate:
             "max": entry_max,
             "help": entry_help
         })
+        self._revision += 1
 
     def __getitem__(self, key):
         """
@@ -122,7 +123,7 @@ class ConfigTemplate:
         """
         if key == "exceptional_keys":
             return super().__getattribute__(key)
-        if key in  ["template"] or key.startswith("__"):
+        if key in  ["template", "_revision"] or key.startswith("__"):
             return super().__getattribute__(key)
         else:
             if self.template is None:
@@ -145,7 +146,10 @@ class ConfigTemplate:
         """
         if key == "exceptional_keys":
             return super().__setattr__(key, value)
-        if key in ["template"] or key.startswith("__"):
+        if key == "template":
+            # a new template: the indexes built on the previous one are stale
+            super().__setattr__("_revision", self.__dict__.get("_revision", 0) + 1)
+        if key in ["template", "_revision"] or key.startswith("__"):
             super().__setattr__(key, value)
         else:
             if self.template is None:
@@ -226,6 +230,10 @@ class BaseConfig:
             Saves the configuration to a YAML file.
     """
 
+    # Attributes stored on the object itself instead of the configuration dictionary.
+    # Extended with the exceptional keys when they are set, so that attribute access is a single set lookup.
+    _own_keys = frozenset(["exceptional_keys", "config", "file_path", "copy", "_own_keys"])
+
     def __init__(self, exceptional_keys: list = [], config: dict = None, file_path:Path|str=None):
         """
         Initializes a new instance of the `BaseConfig` class.
@@ -314,14 +322,12 @@ class BaseConfig:
             ValueError: If no configuration is loaded.
             AttributeError: If the specified key is not found in the configuration.
         """
-        if key == "exceptional_keys":
+        if key in self._own_keys or key.startswith("__"):
             return super().__getattribute__(key)
-        if key in self.exceptional_keys + ["config","file_path","copy"] or key.startswith("__"):
-            return super().__getattribute__(key)
-        else:
-            if self.config is None:
-                raise ValueError("No configuration loaded.")
-            return self.config[key]
+        config = self.config
+        if config is None:
+            raise ValueError("No configuration loaded.")
+        return config[key]
 
     def __setattr__(self, key, value):
         """
@@ -335,8 +341,9 @@ class BaseConfig:
             ValueError: If no configuration is loaded.
         """
         if key == "exceptional_keys":
+            super().__setattr__("_own_keys", BaseConfig._own_keys.union(value))
             return super().__setattr__(key, value)
-        if key in self.exceptional_keys + ["config","file_path","copy"] or key.startswith("__"):
+        if key in self._own_keys or key.startswith("__"):
             super().__setattr__(key, value)
         else:
             if self.config is None:
@@ -451,8 +458,27 @@ class TypedConfig:
     """
     This type of configuration contains a template of descriptions for the fields of the configuration.
     Field types: int, float, str.
+
+    The template entries are indexed by name, so writing a single field only converts and syncs that field.
     """
 
+    _own_keys = frozenset(["config", "config_template", "_entries", "_entries_source"])
+
+    # Conversion applied to the values of each field type
+    _converters = {
+        "int": int,
+        "float": float,
+        "str": str,
+        "text": str,
+        "string": str,
+        "btn": str,
+        "file": str,
+        "folder": str,
+        "bool": bool,
+        "list": list,
+        "dict": eval
+    }
+
     def __init__(self, config_template: ConfigTemplate, config: BaseConfig=None):
         """
         Initializes a new instance of the `TypedConfig` class.
@@ -465,17 +491,38 @@ class TypedConfig:
             config = BaseConfig(config={})
         self.config = config
         self.config_template = config_template
+        self._entries = {}
+        self._entries_source = None
 
         # Fill the template values from the config values
         self.sync()
         
     def addConfigs(self, cfg_template:list):
         self.config_template.template += cfg_template
+        self.invalidate_entries()
         self.sync()
 
     def update_template(self, new_template):
         self.config_template.template = new_template
         self.config = BaseConfig.from_template(self.config_template,self.config.exceptional_keys, self.config.file_path)
+        self.invalidate_entries()
+
+    def _get_entries(self) -> dict:
+        """
+        Returns the template entries indexed by name, rebuilding the index if the template changed.
+        """
+        template = self.config_template.template
+        source = (self.config_template._revision, id(template), len(template))
+        if self._entries_source != source:
+            self._entries = {entry["name"]: entry for entry in template}
+            self._entries_source = source
+        return self._entries
+
+    def invalidate_entries(self):
+        """
+        Forces the index of the template entries to be rebuilt (to call after replacing template entries in place).
+        """
+        self._entries_source = None
 
     def get(self, key, default_value=None):
         if self.config is None:
@@ -499,12 +546,12 @@ class TypedConfig:
         Raises:
             ValueError: If no configuration is loaded.
         """
-        if key in  ["config","config_template"] or key.startswith("__"):
+        if key in self._own_keys or key.startswith("__"):
             return super().__getattribute__(key)
-        else:
-            if self.config is None:
-                raise ValueError("No configuration loaded.")
-            return self.config[key]
+        config = self.config
+        if config is None:
+            raise ValueError("No configuration loaded.")
+        return config[key]
         
     def __setattr__(self, key, value):
         """
@@ -519,13 +566,13 @@ class TypedConfig:
         Raises:
             ValueError: If no configuration is loaded.
         """
-        if key in ["config","config_template"] or key.startswith("__"):
+        if key in self._own_keys or key.startswith("__"):
             super().__setattr__(key, value)
         else:
             if self.config is None:
                 raise ValueError("No configuration loaded.")
             self.config[key] = value
-            self.sync()
+            self.sync([key])
             
 
     def __getitem__(self, key):
@@ -561,38 +608,37 @@ class TypedConfig:
         if self.config is None:
             raise ValueError("No configuration loaded.")
         self.config[key] = value   
-        self.sync()
+        self.sync([key])
 
-    def sync(self):
+    def sync(self, keys:list=None):
         """
         Fills the template values from the config values.
+
+        Args:
+            keys (list, optional): Only sync these entries (the ones that were just written). Defaults to all the entries.
         """
         if self.config_template is None:
             raise ValueError("No configuration template loaded.")
         if self.config is None:
             raise ValueError("No configuration loaded.")
 
-        for entry in self.config_template.template:
+        if keys is None:
+            entries = self.config_template.template
+        else:
+            index = self._get_entries()
+            entries = [index[key] for key in keys if key in index]
+
+        for entry in entries:
             entry_name = entry["name"]
             if entry_name in self.config:
                 entry_value = self.config[entry_name]
                 entry_type = entry["type"]
 
                 # Validate and convert the entry value based on its type
-                if entry_type == "int":
-                    entry_value = int(entry_value)
-                elif entry_type == "float":
-                    entry_value = float(entry_value)
-                elif entry_type == "str" or entry_type == "text" or entry_type == "string" or entry_type == "btn" or entry_type == "file" or entry_type == "folder":
-                    entry_value = str(entry_value)                   
-                elif entry_type == "bool":
-                    entry_value = bool(entry_value)
-                elif entry_type == "list":
-                    entry_value = list(entry_value)
-                elif entry_type == "dict":
-                    entry_value = eval(entry_value)
-                else:
+                converter = self._converters.get(entry_type)
+                if converter is None:
                     raise ValueError(f"Invalid field type '{entry_type}' for entry '{entry_name}'.")
+                entry_value = converter(entry_value)
 
                 # Skip checking min and max if the entry type is not numeric
                 if entry_type == "int" or entry_type == "float":
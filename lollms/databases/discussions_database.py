@@ -14,8 +14,14 @@ import gc
 import json
 import shutil
 from lollms.tasks import TasksLibrary
+from lollms.ingestion import file_sha256
 import json
-from typing import Dict, Any, List
+import time
+import atexit
+import weakref
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, List, Callable, Iterable
 
 __author__ = "parisneo"
 __github__ = "https://github.com/ParisNeo/lollms-webui"
@@ -23,10 +29,98 @@ __copyright__ = "Copyright 2023, "
 __license__ = "Apache 2.0"
 
 
+def get_tokenizer_id(lollms) -> str:
+    """
+    Returns the identity of the active tokenizer (binding and model) used to tag the stored token counts.
+    """
+    config = getattr(lollms, "config", None)
+    if config is None or getattr(lollms, "model", None) is None:
+        return None
+    return f"{config.binding_name}/{config.model_name}"
+
 # =================================== Database ==================================================================
+class DBConnectionManager:
+    """
+    Keeps one sqlite connection per thread for a database file.
+
+    Connections are opened in WAL mode so that readers (UI listing, context building)
+    do not block the writer (message streaming), and are kept open so that sqlite's
+    prepared statement cache is reused across calls instead of being rebuilt on every query.
+    """
+    def __init__(self, db_file_path, busy_timeout:float=30, cached_statements:int=256):
+        self.db_file_path = db_file_path
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections:Dict[int, sqlite3.Connection] = {}
+        self._generation = 0
+
+    def _open(self):
+        conn = sqlite3.connect(
+                                    self.db_file_path,
+                                    timeout=self.busy_timeout,
+                                    cached_statements=self.cached_statements,
+                                    check_same_thread=False
+                                )
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout*1000)}")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def _prune_dead_threads(self):
+        # Connections belonging to threads that no longer exist can never be reused
+        alive = {t.ident for t in threading.enumerate()}
+        for ident in [i for i in self._connections if i not in alive]:
+            try:
+                self._connections.pop(ident).close()
+            except Exception as ex:
+                trace_exception(ex)
+
+    def get_connection(self) -> sqlite3.Connection:
+        """
+        Returns the connection of the calling thread, opening it if needed.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "generation", -1) != self._generation:
+            conn = self._open()
+            with self._lock:
+                self._prune_dead_threads()
+                self._connections[threading.get_ident()] = conn
+                self._local.conn = conn
+                self._local.generation = self._generation
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Yields the thread connection, commits on success and rolls back on error.
+        """
+        conn = self.get_connection()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def close(self):
+        """
+        Closes every pooled connection. Threads transparently reopen one on their next call.
+        """
+        with self._lock:
+            self._generation += 1
+            for conn in self._connections.values():
+                try:
+                    conn.close()
+                except Exception as ex:
+                    trace_exception(ex)
+            self._connections.clear()
+
+
 class DiscussionsDB:
     
-    def __init__(self, lollms:LoLLMsCom, lollms_paths:LollmsPaths, discussion_db_name="default"):
+    def __init__(self, lollms:LoLLMsCom, lollms_paths:LollmsPaths, discussion_db_name="default", busy_timeout:float=30):
         self.lollms = lollms
         self.lollms_paths = lollms_paths
         
@@ -35,10 +129,67 @@ class DiscussionsDB:
 
         self.discussion_db_path.mkdir(exist_ok=True, parents= True)
         self.discussion_db_file_path = self.discussion_db_path/"database.db"
+        self.connections = DBConnectionManager(self.discussion_db_file_path, busy_timeout)
+
+        # Write-behind settings for messages being streamed
+        config = getattr(lollms, "config", None)
+        self.flush_interval = config.get("discussion_db_flush_interval", 1.0) if config is not None else 1.0
+        self.flush_tokens   = config.get("discussion_db_flush_tokens", 64) if config is not None else 64
+        self.pending_messages:set = set()
+        self.pending_lock = threading.Lock()
+        atexit.register(DiscussionsDB._flush_at_exit, weakref.ref(self))
+        # Locks of the discussions vector stores, shared by every Discussion object of the same discussion
+        self.vectorizer_locks:dict = {}
+        # Buffered updates of a stalled stream are written by a background flusher
+        self._closed = threading.Event()
+        threading.Thread(target=DiscussionsDB._flush_periodically, args=(weakref.ref(self), self._closed, self.flush_interval), name="discussions_db_flusher", daemon=True).start()
+
+    @staticmethod
+    def _flush_at_exit(db_ref):
+        db = db_ref()
+        if db is not None:
+            db.flush_pending()
+
+    @staticmethod
+    def _flush_periodically(db_ref, closed:threading.Event, interval:float):
+        # only holds a weak reference, so the database can be released while the thread waits
+        while not closed.wait(max(interval, 0.05)):
+            db = db_ref()
+            if db is None:
+                return
+            db.flush_pending()
+            del db
+
+    def get_vectorizer_lock(self, discussion_id) -> threading.RLock:
+        """
+        Returns the lock that serializes the writes to the vector store of a discussion.
+        """
+        with self.pending_lock:
+            return self.vectorizer_locks.setdefault(discussion_id, threading.RLock())
+
+    def flush_pending(self):
+        """
+        Writes every buffered message update to the database.
+        """
+        with self.pending_lock:
+            messages = list(self.pending_messages)
+        for message in messages:
+            try:
+                message.flush()
+            except Exception as ex:
+                trace_exception(ex)
+
+    def close(self):
+        """
+        Flushes buffered message updates and releases all the connections held on the database file.
+        """
+        self._closed.set()
+        self.flush_pending()
+        self.connections.close()
 
     def create_tables(self):
         db_version = 14
-        with sqlite3.connect(self.discussion_db_file_path) as conn:
+        with self.connections.transaction() as conn:
             cursor = conn.cursor()
 
             cursor.execute("""
@@ -73,6 +224,8 @@ class DiscussionsDB:
                     started_generating_at TIMESTAMP,
                     finished_generating_at TIMESTAMP,
                     nb_tokens INT,                    
+                    content_tokens INT, -- kept before the heavy columns so that light reads never touch them
+                    tokenizer TEXT,
                     discussion_id INTEGER NOT NULL,
                     steps TEXT,
                     metadata TEXT,
@@ -81,6 +234,8 @@ class DiscussionsDB:
                     FOREIGN KEY (parent_message_id) REFERENCES message(id)
                 )
             """)
+            # Messages are always read per discussion
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_message_discussion_id ON message (discussion_id, id)")
 
             cursor.execute("SELECT * FROM schema_version")
             row = cursor.fetchone()
@@ -93,7 +248,7 @@ class DiscussionsDB:
             conn.commit()
 
     def add_missing_columns(self):
-        with sqlite3.connect(self.discussion_db_file_path) as conn:
+        with self.connections.transaction() as conn:
             cursor = conn.cursor()
 
             table_columns = {
@@ -121,6 +276,8 @@ class DiscussionsDB:
                     'started_generating_at',
                     'finished_generating_at',
                     'nb_tokens',                    
+                    'content_tokens',
+                    'tokenizer',
                     'discussion_id'
                 ]
             }
@@ -145,6 +302,8 @@ class DiscussionsDB:
                             cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} INT DEFAULT 0")
                         elif column=='parent_message_id':
                             cursor.execute(f"ALTER TABLE {table} RENAME COLUMN parent TO {column}")
+                        elif column=='content_tokens':
+                            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} INT")
                         else:
                             cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT")
                         ASCIIColors.yellow(f"Added column :{column}")
@@ -155,32 +314,34 @@ class DiscussionsDB:
         """
         Execute the specified SQL select query on the database,
         with optional parameters.
-        Returns the cursor object for further processing.
+        Returns the fetched rows (or the first row if fetch_all is False).
         """
-        with sqlite3.connect(self.discussion_db_file_path) as conn:
-            if params is None:
-                cursor = conn.execute(query)
-            else:
-                cursor = conn.execute(query, params)
+        conn = self.connections.get_connection()
+        if params is None:
+            cursor = conn.execute(query)
+        else:
+            cursor = conn.execute(query, params)
+        try:
             if fetch_all:
                 return cursor.fetchall()
             else:
                 return cursor.fetchone()
-            
+        finally:
+            cursor.close()
+            # Ends the implicit read transaction so WAL checkpoints are not held back
+            if conn.in_transaction:
+                conn.commit()
 
     def delete(self, query, params=None):
         """
         Execute the specified SQL delete query on the database,
         with optional parameters.
-        Returns the cursor object for further processing.
         """
-        with sqlite3.connect(self.discussion_db_file_path) as conn:
-            cursor = conn.cursor()
+        with self.connections.transaction() as conn:
             if params is None:
-                cursor.execute(query)
+                conn.execute(query)
             else:
-                cursor.execute(query, params)
-            conn.commit()
+                conn.execute(query, params)
    
     def insert(self, query, params=None):
         """
@@ -188,24 +349,25 @@ class DiscussionsDB:
         with optional parameters.
         Returns the ID of the newly inserted row.
         """
-        
-        with sqlite3.connect(self.discussion_db_file_path) as conn:
+        with self.connections.transaction() as conn:
             cursor = conn.execute(query, params)
             rowid = cursor.lastrowid
-            conn.commit()
-        self.conn = None
         return rowid
 
     def update(self, query, params:tuple=None):
         """
         Execute the specified Update SQL query on the database,
         with optional parameters.
-        Returns the ID of the newly inserted row.
         """
-        
-        with sqlite3.connect(self.discussion_db_file_path) as conn:
+        with self.connections.transaction() as conn:
             conn.execute(query, params)
-            conn.commit()
+
+    def update_many(self, query, params_list:List[tuple]):
+        """
+        Execute the specified Update SQL query once per parameters tuple, in a single transaction.
+        """
+        with self.connections.transaction() as conn:
+            conn.executemany(query, params_list)
     
     def load_last_discussion(self):
         last_discussion_id = self.select("SELECT id FROM discussion ORDER BY id DESC LIMIT 1", fetch_all=False)
@@ -243,8 +405,18 @@ class DiscussionsDB:
         return Discussion(self.lollms, discussion_id, self)
 
     def get_discussions(self):
-        rows = self.select("SELECT * FROM discussion")         
-        return [{"id": row[0], "title": row[1], "created_at": row[3]} for row in rows]
+        """
+        Lists the discussions with their total number of tokens for the current model.
+        nb_tokens is None when some messages were not counted with the current tokenizer yet.
+        """
+        self.flush_pending()
+        rows = self.select("""
+            SELECT d.id, d.title, d.created_at, COALESCE(SUM(m.content_tokens), 0),
+                   SUM(CASE WHEN m.id IS NOT NULL AND (m.content_tokens IS NULL OR m.tokenizer IS NOT ?) THEN 1 ELSE 0 END)
+            FROM discussion d LEFT JOIN message m ON m.discussion_id = d.id
+            GROUP BY d.id ORDER BY d.id
+        """, (get_tokenizer_id(self.lollms),))
+        return [{"id": row[0], "title": row[1], "created_at": row[2], "nb_tokens": row[3] if row[4]==0 else None} for row in rows]
 
     def does_last_discussion_have_messages(self):
         last_discussion_id = self.select("SELECT id FROM discussion ORDER BY id DESC LIMIT 1", fetch_all=False)
@@ -494,6 +666,61 @@ class DiscussionsDB:
         return discussions
 
 
+# =================================== Token budget ==================================================================
+# Tokens reserved for each message budgeted with its stored count. The header and the content are counted
+# separately and tokenizers can merge a few characters across the junction differently in the joined text.
+STORED_COUNT_MARGIN = 2
+
+def fit_to_token_budget(
+                            entries:Iterable[tuple],
+                            max_allowed_tokens:int,
+                            tokenize:Callable,
+                            detokenize:Callable=None,
+                            used_tokens:int=0,
+                            stored_count_margin:int=STORED_COUNT_MARGIN
+                        ):
+    """
+    Selects the newest entries that fit in a token budget in a single linear pass.
+
+    Each entry is tokenized exactly once and the running count is kept, so the cost is linear in the
+    number of entries instead of re-tokenizing the accumulated text at each step.
+
+    Args:
+        entries (Iterable[tuple]): (key, text) or (key, text, n_tokens) tuples ordered from the newest to the oldest.
+            When n_tokens is known (stored token counts), the entry is only tokenized if it reaches the budget limit.
+            Entries are consumed lazily, so a generator stops being formatted once the budget is reached. The key is handed to tokenize so that the caller can cache the tokens (a message id for example).
+        max_allowed_tokens (int): The token budget.
+        tokenize (Callable): tokenize(key, text) -> list of tokens.
+        detokenize (Callable, optional): If provided, the entry that crosses the budget is truncated at
+            token granularity (its end is kept) instead of being dropped.
+        used_tokens (int, optional): Tokens already consumed from the budget. Defaults to 0.
+        stored_count_margin (int, optional): Tokens added to the given n_tokens of an entry, which is a sum of separately
+            tokenized parts and can differ slightly from the count of the joined text. Defaults to STORED_COUNT_MARGIN.
+
+    Returns:
+        tuple: (texts, tokens) where texts are the kept texts in chronological order
+            and tokens is the total number of consumed tokens (used_tokens included).
+    """
+    texts = []
+    for entry in entries:
+        key, text = entry[0], entry[1]
+        n_tokens = entry[2] + stored_count_margin if len(entry) > 2 and entry[2] is not None else None
+        if n_tokens is None or used_tokens + n_tokens > max_allowed_tokens:
+            # Unknown count or boundary entry: use the exact tokens
+            tokens = tokenize(key, text)
+            n_tokens = len(tokens)
+        if used_tokens + n_tokens > max_allowed_tokens:
+            remaining = max_allowed_tokens - used_tokens
+            if detokenize is not None and remaining > 0:
+                texts.append(detokenize(tokens[-remaining:]))
+                used_tokens = max_allowed_tokens
+            break
+        texts.append(text)
+        used_tokens += n_tokens
+    texts.reverse()
+    return texts, used_tokens
+
+
 class Message:
     def __init__(
                     self,
@@ -515,6 +742,8 @@ class Message:
                     started_generating_at   = None,
                     finished_generating_at  = None,
                     nb_tokens     = None,
+                    content_tokens          = None,
+                    tokenizer               = None,
                     id                      = None,
                     insert_into_db          = False
                     ):
@@ -541,16 +770,35 @@ class Message:
         self.started_generating_at  = started_generating_at
         self.finished_generating_at = finished_generating_at
         self.nb_tokens              = nb_tokens
+        self.content_tokens         = content_tokens
+        self.tokenizer              = tokenizer
+
+        # Heavy columns that are read from the database on first access (see from_dict)
+        self._lazy_fields           = set()
+        # Messages list this message was loaded with, its deferred fields are read in batches with its neighbours
+        self._siblings              = None
+        self._sibling_index         = None
+
+        # Write-behind buffer: columns waiting to be written to the database
+        self._pending_columns       = {}
+        self._pending_updates       = 0
+        self._pending_lock          = threading.Lock()
+        # Held from taking the buffered columns to the end of their UPDATE, so that writes land in order
+        self._write_lock            = threading.Lock()
+        self._last_flush_time       = time.monotonic()
 
         if insert_into_db:
             self.id = self.discussions_db.insert(
-                "INSERT INTO message (sender,  message_type,  sender_type,  sender,  content, steps,  metadata, ui,  rank,  parent_message_id,  binding,  model,  personality,  created_at, started_generating_at,  finished_generating_at, nb_tokens,  discussion_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", 
-                (sender, message_type, sender_type, sender, content, str(steps), metadata, ui, rank, parent_message_id, binding, model, personality, created_at, started_generating_at, finished_generating_at, nb_tokens, discussion_id)
+                "INSERT INTO message (sender,  message_type,  sender_type,  sender,  content, steps,  metadata, ui,  rank,  parent_message_id,  binding,  model,  personality,  created_at, started_generating_at,  finished_generating_at, nb_tokens, content_tokens, tokenizer,  discussion_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", 
+                (sender, message_type, sender_type, sender, content, str(steps), metadata, ui, rank, parent_message_id, binding, model, personality, created_at, started_generating_at, finished_generating_at, nb_tokens, content_tokens, tokenizer, discussion_id)
             )
         else:
             self.id = id
 
 
+    # Columns that can be big (long contents, html ui) and that lazy messages only read when needed
+    HEAVY_FIELDS = ["content", "metadata", "steps", "ui"]
+
     @staticmethod
     def get_fields():
         return [
@@ -571,9 +819,88 @@ class Message:
             "started_generating_at",
             "finished_generating_at",
             "nb_tokens",
+            "content_tokens",
+            "tokenizer",
             "discussion_id"
         ]        
 
+    @staticmethod
+    def get_light_fields():
+        """
+        Returns the fields loaded up front for lazy messages (everything but the heavy fields).
+        """
+        return [f for f in Message.get_fields() if f not in Message.HEAVY_FIELDS]
+
+    # Number of neighbour messages on each side whose deferred field is read along with the accessed one
+    LAZY_BATCH_SIZE = 64
+
+    def __getattr__(self, name):
+        # Only called when the attribute does not exist: load the deferred heavy column
+        if name in self.__dict__.get("_lazy_fields", ()):
+            siblings = self.__dict__.get("_siblings")
+            if siblings is not None:
+                # Loops over the messages read the field of a whole batch at once instead of one query per message
+                index = self.__dict__.get("_sibling_index")
+                if index is None or index >= len(siblings) or siblings[index] is not self:
+                    index = next((i for i, m in enumerate(siblings) if m is self), None)
+                if index is not None:
+                    # Neighbours on both sides (whatever the iteration direction), only the unread ones are queried
+                    window = siblings[max(0, index - Message.LAZY_BATCH_SIZE + 1):index + Message.LAZY_BATCH_SIZE]
+                    Message.load_messages_fields(self.discussions_db, window, [name])
+            if not self.is_loaded(name):
+                self.load_fields([name])
+            return self.__dict__[name]
+        raise AttributeError(f"'Message' object has no attribute '{name}'")
+
+    def _set_field(self, name, value):
+        if name == "steps":
+            try:
+                value = value if type(value)==list else json.loads(value)
+            except:
+                value = []
+        self.__dict__[name] = value
+        self._lazy_fields.discard(name)
+
+    def is_loaded(self, name) -> bool:
+        """
+        Returns False if the field is deferred and was not read (nor set) yet.
+        """
+        return name not in self._lazy_fields or name in self.__dict__
+
+    def load_fields(self, fields:List[str]=None):
+        """
+        Reads deferred heavy fields from the database.
+        """
+        fields = [f for f in (fields if fields is not None else Message.HEAVY_FIELDS) if not self.is_loaded(f)]
+        if len(fields)==0:
+            return
+        rows = self.discussions_db.select(f"SELECT {','.join(fields)} FROM message WHERE id=?", (self.id,))
+        for i, field in enumerate(fields):
+            self._set_field(field, rows[0][i] if len(rows)>0 else None)
+
+    @staticmethod
+    def load_messages_fields(discussions_db, messages:List["Message"], fields:List[str]=["content"]):
+        """
+        Reads deferred heavy fields of several messages in a single query.
+        """
+        messages = [m for m in messages if any(not m.is_loaded(f) for f in fields)]
+        if len(messages)==0:
+            return
+        values = {}
+        # Bounded number of sql variables per query
+        for start in range(0, len(messages), 500):
+            batch = messages[start:start+500]
+            rows = discussions_db.select(
+                f"SELECT id,{','.join(fields)} FROM message WHERE id IN ({','.join(['?']*len(batch))})",
+                tuple(m.id for m in batch)
+            )
+            values.update({row[0]:row[1:] for row in rows})
+        for message in messages:
+            row = values.get(message.id)
+            for i, field in enumerate(fields):
+                if not message.is_loaded(field):
+                    message._set_field(field, row[i] if row is not None else None)
+
     @staticmethod
     def from_db(discussions_db, message_id):
         columns = Message.get_fields()
@@ -591,10 +918,22 @@ class Message:
 
     @staticmethod
     def from_dict(discussions_db,data_dict):
+        """
+        Builds a message from a row dictionary.
+        Heavy fields (content, metadata, steps, ui) missing from the dictionary are deferred:
+        they are read from the database the first time they are accessed.
+        """
         data_dict["discussions_db"]=discussions_db
-        return Message(
+        lazy_fields = [f for f in Message.HEAVY_FIELDS if f not in data_dict]
+        if "content" not in data_dict:
+            data_dict["content"] = None
+        message = Message(
             **data_dict
         )
+        for field in lazy_fields:
+            del message.__dict__[field]
+        message._lazy_fields.update(lazy_fields)
+        return message
 
     def insert_into_db(self):
         self.message_id = self.discussions_db.insert(
@@ -608,94 +947,118 @@ class Message:
             (self.sender, self.content, self.metadata, self.ui, self.message_type, self.rank, self.parent_message_id, self.binding, self.model, self.personality, self.created_at, self.started_generating_at, self.finished_generating_at, self.nb_tokens, self.discussion_id)
         )
 
+    def _write(self, columns:dict, commit=True):
+        """
+        Writes columns of this message to the database.
+
+        When commit is False, the columns are only buffered. Successive buffered updates are
+        coalesced and written in a single query once flush_interval seconds elapsed or
+        flush_tokens updates were received since the last write, or when flush() is called.
+        Any committed write also carries the pending columns so that the row never goes back in time.
+        """
+        if "content" in columns and "content_tokens" not in columns:
+            # The stored token count no longer matches the content, it is recomputed when needed
+            columns = {**columns, "content_tokens": None, "tokenizer": None}
+            self.content_tokens = None
+            self.tokenizer = None
+        with self._pending_lock:
+            self._pending_columns.update(columns)
+            self._pending_updates += 1
+            if not commit:
+                if (
+                        self._pending_updates < self.discussions_db.flush_tokens and 
+                        time.monotonic() - self._last_flush_time < self.discussions_db.flush_interval
+                    ):
+                    with self.discussions_db.pending_lock:
+                        self.discussions_db.pending_messages.add(self)
+                    return
+        self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered columns of this message to the database.
+        Flushes of the same message (from the streaming thread and from flush_pending) are serialized,
+        so an older value can't be written after a newer one.
+        """
+        with self._write_lock:
+            with self._pending_lock:
+                columns = self._pending_columns
+                self._pending_columns = {}
+                self._pending_updates = 0
+                self._last_flush_time = time.monotonic()
+            with self.discussions_db.pending_lock:
+                self.discussions_db.pending_messages.discard(self)
+            if len(columns)==0:
+                return
+            try:
+                self.discussions_db.update(
+                    f"UPDATE message SET {', '.join([f'{c} = ?' for c in columns])} WHERE id = ?",
+                    tuple(columns.values())+(self.id,)
+                )
+            except Exception:
+                # Put the columns back so that the next flush retries them
+                with self._pending_lock:
+                    self._pending_columns = {**columns, **self._pending_columns}
+                with self.discussions_db.pending_lock:
+                    self.discussions_db.pending_messages.add(self)
+                raise
+
     def update(self, new_content, new_metadata=None, new_ui=None, started_generating_at=None, nb_tokens=None, commit=True):
         self.finished_generating_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        text = f"UPDATE message SET content = ?"
-        params = [new_content]
+        self.content = new_content
+        columns = {"content": new_content}
         if new_metadata is not None:
-            text+=", metadata = ?"
-            params.append(new_metadata if type(new_metadata)==str else json.dumps(new_metadata) if type(new_metadata)==dict else None)
+            columns["metadata"] = new_metadata if type(new_metadata)==str else json.dumps(new_metadata) if type(new_metadata)==dict else None
             self.metadata=new_metadata
         if new_ui is not None:
-            text+=", ui = ?"
-            params.append(new_ui)
+            columns["ui"] = new_ui
             self.ui=new_ui
 
         if started_generating_at is not None:
-            text+=", started_generating_at = ?"
-            params.append(started_generating_at)
+            columns["started_generating_at"] = started_generating_at
             self.started_generating_at=started_generating_at
 
         if nb_tokens is not None:
-            text+=", nb_tokens = ?"
-            params.append(nb_tokens)
+            columns["nb_tokens"] = nb_tokens
             self.nb_tokens=nb_tokens
 
-
-        text +=", finished_generating_at = ? WHERE id = ?"
-        params.append(self.finished_generating_at)
-        params.append(self.id)
-        self.discussions_db.update(
-            text, tuple(params)
-        )        
+        columns["finished_generating_at"] = self.finished_generating_at
+        self._write(columns, commit)
 
     def update_content(self, new_content, started_generating_at=None, nb_tokens=None, commit=True):
         self.finished_generating_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        text = f"UPDATE message SET content = ?"
-        params = [new_content]
+        self.content = new_content
+        columns = {"content": new_content}
 
         if started_generating_at is not None:
-            text+=", started_generating_at = ?"
-            params.append(started_generating_at)
+            columns["started_generating_at"] = started_generating_at
             self.started_generating_at=started_generating_at
 
         if nb_tokens is not None:
-            text+=", nb_tokens = ?"
-            params.append(nb_tokens)
+            columns["nb_tokens"] = nb_tokens
             self.nb_tokens=nb_tokens
 
-
-        text +=", finished_generating_at = ? WHERE id = ?"
-        params.append(self.finished_generating_at)
-        params.append(self.id)
-        self.discussions_db.update(
-            text, tuple(params)
-        )  
+        columns["finished_generating_at"] = self.finished_generating_at
+        self._write(columns, commit)
 
     def update_steps(self, steps:list):
         self.finished_generating_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        text = f"UPDATE message SET steps = ?"
         self.steps = steps
-        params = [json.dumps(self.steps)]
-
-        text +=" WHERE id = ?"
-        params.append(self.id)
-        self.discussions_db.update(
-            text, tuple(params)
-        )        
-
+        self._write({"steps": json.dumps(self.steps)})
 
     def update_metadata(self, new_metadata):
         self.finished_generating_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        text = f"UPDATE message SET metadata = ?"
-        params = [None if new_metadata is None else new_metadata if type(new_metadata)==str else json.dumps(new_metadata)]
-        text +=", finished_generating_at = ? WHERE id = ?"
-        params.append(self.finished_generating_at)
-        params.append(self.id)
-        self.discussions_db.update(
-            text, tuple(params)
-        )        
+        self._write({
+            "metadata": None if new_metadata is None else new_metadata if type(new_metadata)==str else json.dumps(new_metadata),
+            "finished_generating_at": self.finished_generating_at
+        })
 
     def update_ui(self, new_ui):
         self.finished_generating_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        text = f"UPDATE message SET ui = ?"
-        params = [str(new_ui) if new_ui is not None else None]
-        text +=", finished_generating_at = ? WHERE id = ?"
-        params.append(self.finished_generating_at)
-        params.append(self.id)
-        self.discussions_db.update(
-            text, tuple(params)
-        )        
+        self._write({
+            "ui": str(new_ui) if new_ui is not None else None,
+            "finished_generating_at": self.finished_generating_at
+        })
 
     def add_step(self, step: str, step_type: str, status: bool, done: bool):
         self.finished_generating_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -718,12 +1081,8 @@ class Message:
                 "done": done
             })
 
-        # Prepare the SQL update statement
-        text = "UPDATE message SET steps = ? WHERE id = ?"
-        params = [json.dumps(self.steps), self.id]
-        
         # Update the database
-        self.discussions_db.update(text, tuple(params))
+        self._write({"steps": json.dumps(self.steps)})
 
 
     def to_json(self):
@@ -764,7 +1123,7 @@ class Discussion:
         self.discussion_skills_folder.mkdir(exist_ok=True)
         self.discussion_rag_folder.mkdir(exist_ok=True)
         self.discussion_view_images_folder.mkdir(exist_ok=True)
-        self.messages = self.get_messages()
+        self.messages = self.get_messages(lazy=True)
         
         if len(self.messages)>0:
             self.current_message = self.messages[-1]
@@ -772,6 +1131,8 @@ class Discussion:
         # Initialize the file lists
         self.update_file_lists()
 
+        # The discussion can be loaded in several objects (and the ingestion thread holds one), they share this lock
+        self._vectorizer_lock = self.discussions_db.get_vectorizer_lock(discussion_id)
         if len(self.text_files)>0:
 
             self.vectorizer = SafeStore(
@@ -779,16 +1140,48 @@ class Discussion:
                                         )
             
             if len(self.vectorizer.list_documents())==0 and len(self.text_files)>0:
+                # the discussion may be loaded again while its files are still queued, or after they failed
+                ingestion_queue = getattr(self.lollms, "ingestion_queue", None)
                 for path in self.text_files:
-                    try:
-                        self.vectorizer.add_document(path, self.lollms.config.rag_vectorizer,
-                                        chunk_size=self.lollms.config.rag_chunk_size,
-                                        chunk_overlap=self.lollms.config.rag_overlap)      
-                    except Exception as ex:
-                        trace_exception(ex)
+                    if ingestion_queue is not None and ingestion_queue.is_submitted(self, path):
+                        continue
+                    self.ingest_file(path)
         else:
             self.vectorizer = None
 
+    def get_vectorizer(self):
+        """
+        Returns the vector store of the discussion files, creating it if needed.
+        """
+        with self._vectorizer_lock:
+            if self.vectorizer is None:
+                self.vectorizer = SafeStore(
+                                            self.discussion_rag_folder/"db.sqli"
+                                            )
+            return self.vectorizer
+
+    def ingest_file(self, path, client_id=None, callback=None):
+        """
+        Adds a text or audio file to the vector store of the discussion.
+        The file is ingested in the background by the ingestion queue of the application when there is one.
+        Without a queue, the file is ingested at once and False is returned if it couldn't be.
+        """
+        ingestion_queue = getattr(self.lollms, "ingestion_queue", None)
+        if ingestion_queue is not None:
+            return ingestion_queue.submit(self, path, client_id, callback)
+        try:
+            with self._vectorizer_lock:
+                self.get_vectorizer().add_document(path, self.lollms.config.rag_vectorizer,
+                                chunk_size=self.lollms.config.rag_chunk_size,
+                                chunk_overlap=self.lollms.config.rag_overlap)
+            if callback is not None:
+                callback("File added successfully",MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_INFO)
+            return True
+        except Exception as ex:
+            trace_exception(ex)
+            self.lollms.InfoMessage(f"Unsupported file format or empty file.\n{ex}",client_id=client_id)
+            return False
+
     def update_file_lists(self):
         self.text_files = [Path(file) for file in self.discussion_text_folder.glob('*') if not file.is_dir()]
         self.image_files = [Path(file) for file in self.discussion_images_folder.glob('*') if not file.is_dir()]
@@ -801,8 +1194,13 @@ class Discussion:
             all_files = self.text_files+self.image_files+self.audio_files
             if any(file_name == entry.name for entry in self.text_files):
                 fn = [entry for entry in self.text_files if entry.name == file_name][0]
+                ingestion_queue = getattr(self.lollms, "ingestion_queue", None)
+                if ingestion_queue is not None:
+                    ingestion_queue.cancel(self, fn)
                 try:
-                    self.vectorizer.delete_document_by_path(fn)
+                    # waits for an ingestion of the file that already started writing its chunks
+                    with self._vectorizer_lock:
+                        self.get_vectorizer().delete_document_by_path(fn)
                     if callback is not None:
                         callback("File removed successfully",MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_INFO)
                 except Exception as ex:
@@ -825,6 +1223,9 @@ class Discussion:
             ASCIIColors.warning(f"Couldn't remove the file {file_name}")
 
     def remove_all_files(self):
+        ingestion_queue = getattr(self.lollms, "ingestion_queue", None)
+        if ingestion_queue is not None:
+            ingestion_queue.cancel(self)
         # Iterate over each directory and remove all files
         for path in [self.discussion_images_folder, self.discussion_rag_folder, self.discussion_audio_folder, self.discussion_text_folder]:
             
@@ -852,21 +1253,27 @@ class Discussion:
 
     def add_file(self, path, client, tasks_library:TasksLibrary, callback=None, process=True):
         output = ""
+        client_id = client.client_id if client is not None else None
+        ingestion_queue = getattr(self.lollms, "ingestion_queue", None)
 
         path = Path(path)
         if path.suffix in [".wav",".mp3"]:
             self.audio_files.append(path)
             if process:
-                self.lollms.new_message(client.client_id if client is not None else 0, content = "", message_type = MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_SET_CONTENT)
-                if self.lollms.stt is None:
-                    self.lollms.info("Please select an stt engine in the services settings first")
-                self.lollms.info(f"Transcribing ... ")
-                transcription = self.lollms.stt.transcribe(str(path))
-                transcription_fn = self.discussion_text_folder/(path.stem+".txt")
-                with open(transcription_fn, "w", encoding="utf-8") as f:
-                    f.write(transcription)
-                self.text_files.append(transcription_fn)
-                tasks_library.info(f"Transcription saved to {transcription_fn}")
+                self.lollms.new_message(client_id if client_id is not None else 0, content = "", message_type = MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_SET_CONTENT)
+                if ingestion_queue is not None:
+                    # Transcribed then ingested in the background
+                    self.ingest_file(path, client_id, callback)
+                else:
+                    if self.lollms.stt is None:
+                        self.lollms.info("Please select an stt engine in the services settings first")
+                    self.lollms.info(f"Transcribing ... ")
+                    transcription = self.lollms.stt.transcribe(str(path))
+                    transcription_fn = self.discussion_text_folder/(path.stem+".txt")
+                    with open(transcription_fn, "w", encoding="utf-8") as f:
+                        f.write(transcription)
+                    self.text_files.append(transcription_fn)
+                    tasks_library.info(f"Transcription saved to {transcription_fn}")
 
         elif path.suffix in [".png",".jpg",".jpeg",".gif",".bmp",".svg",".webp"]:
             self.image_files.append(path)
@@ -881,18 +1288,24 @@ class Discussion:
                         self.lollms.personality.new_message("")
                         output = f'<img src="{pth}" width="800">\n\n'
                         self.lollms.personality.set_message_html(output)
-                        self.lollms.close_message(client.client_id if client is not None else 0)
+                        self.lollms.close_message(client_id if client_id is not None else 0)
 
                     if self.lollms.model.binding_type not in [BindingType.TEXT_IMAGE, BindingType.TEXT_IMAGE_VIDEO]:
-                        # self.ShowBlockingMessage("Understanding image (please wait)")
-                        from PIL import Image
-                        img = Image.open(str(view_file))
-                        # Convert the image to RGB mode
-                        img = img.convert("RGB")
-                        output += "## image description :\n"+ self.lollms.model.interrogate_blip([img])[0]
-                        # output += "## image description :\n"+ self.lollms.model.qna_blip([img],"q:Describe this photo with as much details as possible.\na:")[0]
+                        # The description of an image already seen in any discussion is reused
+                        content_hash = file_sha256(path) if ingestion_queue is not None else None
+                        description = ingestion_queue.cache.get(content_hash, "image") if content_hash is not None else None
+                        if description is None:
+                            from PIL import Image
+                            img = Image.open(str(view_file))
+                            # Convert the image to RGB mode
+                            img = img.convert("RGB")
+                            description = self.lollms.model.interrogate_blip([img])[0]
+                            # description = self.lollms.model.qna_blip([img],"q:Describe this photo with as much details as possible.\na:")[0]
+                            if content_hash is not None:
+                                ingestion_queue.cache.put(content_hash, "image", description)
+                        output += "## image description :\n"+ description
                         self.lollms.set_message_content(output)
-                        self.lollms.close_message(client.client_id if client is not None else 0)
+                        self.lollms.close_message(client_id if client_id is not None else 0)
                         self.lollms.HideBlockingMessage("Understanding image (please wait)")
                         if self.lollms.config.debug:
                             ASCIIColors.yellow(output)
@@ -908,25 +1321,15 @@ class Discussion:
             if callback is not None:
                 callback("Image file added successfully", MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_INFO)
         else:
-            try:
-                # self.ShowBlockingMessage("Adding file to vector store.\nPlease stand by")
-                self.text_files.append(path)
-                ASCIIColors.info("Received text compatible file")
-                self.lollms.ShowBlockingMessage("Processing file\nPlease wait ...")
-                if process:
-                    if self.vectorizer is None:
-                        self.vectorizer = SafeStore(
-                                    self.discussion_rag_folder/"db.sqli"
-                                    )
-                    self.vectorizer.add_document(path, chunk_size=self.lollms.config.rag_chunk_size, chunk_overlap=self.lollms.config.rag_overlap)
-                    if callback is not None:
-                        callback("File added successfully",MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_INFO)
-                    self.lollms.HideBlockingMessage(client.client_id)
-                    return True
-            except Exception as e:
-                trace_exception(e)
-                self.lollms.InfoMessage(f"Unsupported file format or empty file.\nSupported formats are {TextDocumentsLoader.get_supported_file_types()}",client_id=client.client_id)
-                return False
+            self.text_files.append(path)
+            ASCIIColors.info("Received text compatible file")
+            if process:
+                if ingestion_queue is not None:
+                    # Parsed and vectorized in the background, the files already indexed stay queryable meanwhile
+                    self.ingest_file(path, client_id, callback)
+                else:
+                    return self.ingest_file(path, client_id, callback)
+            return True
 
     def load_message(self, id):
         """Gets a list of messages information
@@ -934,6 +1337,7 @@ class Discussion:
         Returns:
             list: List of entries in the format {"id":message id, "sender":sender name, "content":message content, "message_type":message type, "rank": message rank}
         """
+        self.discussions_db.flush_pending()
         self.current_message = Message.from_db(self.discussions_db, id)
         return self.current_message
     
@@ -977,6 +1381,10 @@ class Discussion:
         if nb_tokens is None:
             nb_tokens = 0
 
+        # The token count of the content is stored with the message so that context budgeting never needs to tokenize it again
+        tokenizer = get_tokenizer_id(self.lollms)
+        content_tokens = (self.lollms.model.count_tokens(content) if content else 0) if tokenizer is not None else None
+
         self.current_message = Message(
             self.discussion_id,
             self.discussions_db,
@@ -996,6 +1404,8 @@ class Discussion:
             started_generating_at,
             finished_generating_at,
             nb_tokens,
+            content_tokens,
+            tokenizer,
             insert_into_db=True
         )
 
@@ -1094,27 +1504,77 @@ class Discussion:
             f"DELETE FROM discussion WHERE id={self.discussion_id}"
         )
 
-    def get_messages(self)->List[Message]:
+    def get_messages(self, lazy:bool=False)->List[Message]:
         """Gets a list of messages information
 
+        Args:
+            lazy (bool, optional): If True, only the light columns (ids, senders, types, token counts...) are read.
+                The content, metadata, steps and ui of each message are read on first access.
+
         Returns:
             list: List of entries in the format {"id":message id, "sender":sender name, "content":message content, "message_type":message type, "rank": message rank}
         """
-        columns = Message.get_fields()
+        columns = Message.get_fields() if not lazy else Message.get_light_fields()
 
+        self.discussions_db.flush_pending()
         rows = self.discussions_db.select(
             f"SELECT {','.join(columns)} FROM message WHERE discussion_id=?", (self.discussion_id,)
         )
         msg_dict = [{ c:row[i] for i,c in enumerate(columns)} for row in rows]
         self.messages=[]
         for msg in msg_dict:
-            self.messages.append(Message.from_dict(self.discussions_db, msg))
+            message = Message.from_dict(self.discussions_db, msg)
+            if lazy:
+                message._siblings = self.messages
+                message._sibling_index = len(self.messages)
+            self.messages.append(message)
 
         if len(self.messages)>0:
             self.current_message = self.messages[-1]
 
         return self.messages
 
+    def iter_messages_reversed(self, start_index:int=-1, messages:List[Message]=None, batch_size:int=32, fields:List[str]=["content"]):
+        """
+        Yields the messages from start_index back to the first one.
+        The deferred fields of lazy messages are read in batches of batch_size messages, so stopping
+        the iteration early (once the context is full for example) leaves the older messages unread.
+        """
+        messages = messages if messages is not None else self.messages
+        if start_index < 0:
+            start_index += len(messages)
+        for end in range(start_index+1, 0, -batch_size):
+            batch = messages[max(0, end-batch_size):end]
+            Message.load_messages_fields(self.discussions_db, batch, fields)
+            for message in reversed(batch):
+                yield message
+
+    def get_messages_page(self, before_id:int=None, limit:int=50, include_ui:bool=True):
+        """
+        Cursor based paging over the messages, from the newest to the oldest.
+
+        Args:
+            before_id (int, optional): Only messages older than this id are returned. None starts from the newest message.
+            limit (int, optional): The maximum number of messages. Defaults to 50.
+            include_ui (bool, optional): If False, the ui column is not read (ui is None).
+
+        Returns:
+            tuple: (messages in chronological order, cursor of the next page or None if there are no older messages)
+        """
+        columns = [f for f in Message.get_fields() if include_ui or f!="ui"]
+        self.discussions_db.flush_pending()
+        if before_id is None:
+            rows = self.discussions_db.select(
+                f"SELECT {','.join(columns)} FROM message WHERE discussion_id=? ORDER BY id DESC LIMIT ?", (self.discussion_id, limit+1)
+            )
+        else:
+            rows = self.discussions_db.select(
+                f"SELECT {','.join(columns)} FROM message WHERE discussion_id=? AND id<? ORDER BY id DESC LIMIT ?", (self.discussion_id, before_id, limit+1)
+            )
+        has_more = len(rows) > limit
+        messages = [Message.from_dict(self.discussions_db, {**{ c:row[i] for i,c in enumerate(columns)}, **({} if include_ui else {"ui":None})}) for row in reversed(rows[:limit])]
+        return messages, messages[0].id if has_more else None
+
     def get_message(self, message_id):
         for message in self.messages:
             if message.id == int(message_id):
@@ -1130,23 +1590,31 @@ class Discussion:
         else:
             return False 
 
-    def update_message(self, new_content, new_metadata=None, new_ui=None, started_generating_at=None, nb_tokens=None):
+    def update_message(self, new_content, new_metadata=None, new_ui=None, started_generating_at=None, nb_tokens=None, commit=True):
         """Updates the content of a message
 
         Args:
             message_id (int): The id of the message to be changed
             new_content (str): The nex message content
+            commit (bool): If False, the write is buffered until the flush threshold is reached
         """
-        self.current_message.update(new_content, new_metadata, new_ui, started_generating_at, nb_tokens)
+        self.current_message.update(new_content, new_metadata, new_ui, started_generating_at, nb_tokens, commit)
 
-    def update_message_content(self, new_content, started_generating_at=None, nb_tokens=None):
+    def update_message_content(self, new_content, started_generating_at=None, nb_tokens=None, commit=True):
         """Updates the content of a message
 
         Args:
             message_id (int): The id of the message to be changed
             new_content (str): The nex message content
+            commit (bool): If False, the write is buffered until the flush threshold is reached
+        """
+        self.current_message.update_content(new_content, started_generating_at, nb_tokens, commit)
+
+    def flush_message(self):
+        """Writes the buffered updates of the current message to the database
         """
-        self.current_message.update_content(new_content, started_generating_at, nb_tokens)
+        if self.current_message is not None:
+            self.current_message.flush()
 
     def update_message_steps(self, steps):
         """Updates the content of a message
@@ -1187,6 +1655,7 @@ class Discussion:
         msg = self.get_message(message_id)
         if msg:
             msg.update(new_content, new_metadata, new_ui)
+            self.update_tokens_counts([msg])
             return True
         else:
             return False
@@ -1233,10 +1702,93 @@ class Discussion:
         # Retrieve current rank value for message_id
         self.discussions_db.delete("DELETE FROM message WHERE id=?", (message_id,))
 
-    def export_for_vectorization(self):
+    # ----------------------------------- Token counts -----------------------------------------
+    def update_tokens_counts(self, messages:List[Message]=None, save:bool=True) -> List[Message]:
+        """
+        Counts the tokens of the messages whose stored count is missing (new content) or was computed
+        with another tokenizer (model change). Up to date counts are left untouched.
+
+        Args:
+            messages (List[Message], optional): The messages to check. If None, the stale messages of the
+                whole discussion are found with a single query.
+            save (bool, optional): Save the new counts in the database. Defaults to True.
+
+        Returns:
+            List[Message]: The loaded messages whose count was updated.
+        """
+        tokenizer = get_tokenizer_id(self.lollms)
+        if tokenizer is None:
+            return []
+        if messages is None:
+            self.discussions_db.flush_pending()
+            rows = self.discussions_db.select(
+                "SELECT id, content FROM message WHERE discussion_id=? AND (content_tokens IS NULL OR tokenizer IS NOT ?)", (self.discussion_id, tokenizer)
+            )
+            counts = {row[0]:self.lollms.model.count_tokens(row[1] or "") for row in rows}
+            if save and len(counts) > 0:
+                self.discussions_db.update_many(
+                    "UPDATE message SET content_tokens=?, tokenizer=? WHERE id=?",
+                    [(count, tokenizer, id) for id, count in counts.items()]
+                )
+            updated = [m for m in self.messages if m.id in counts]
+            for message in updated:
+                message.content_tokens = counts[message.id]
+                message.tokenizer = tokenizer
+            return updated
+        stale = [m for m in messages if m.content_tokens is None or m.tokenizer != tokenizer]
+        if len(stale) == 0:
+            return []
+        Message.load_messages_fields(self.discussions_db, stale, ["content"])
+        for message in stale:
+            message.content_tokens = self.lollms.model.count_tokens(message.content or "")
+            message.tokenizer = tokenizer
+        if save:
+            self.save_tokens_counts(stale)
+        return stale
+
+    def save_tokens_counts(self, messages:List[Message]):
+        """
+        Saves the token counts of the messages in a single transaction.
+        """
+        if len(messages) > 0:
+            self.discussions_db.update_many(
+                "UPDATE message SET content_tokens=?, tokenizer=? WHERE id=?",
+                [(m.content_tokens, m.tokenizer, m.id) for m in messages]
+            )
+
+    def get_context_window_start(self, max_allowed_tokens:int, last_message_id:int=None, per_message_overhead:int=0):
+        """
+        Finds, with a single SQL aggregate over the stored token counts, the oldest message such that
+        it and all the following messages (up to last_message_id) fit in max_allowed_tokens.
+
+        Args:
+            max_allowed_tokens (int): The token budget.
+            last_message_id (int, optional): The newest message to include. Defaults to the last message.
+            per_message_overhead (int, optional): Tokens added to each message (headers, separators).
+
+        Returns:
+            int: The id of the oldest message of the window, None if not even the last message fits.
+        """
+        self.update_tokens_counts()
+        row = self.discussions_db.select(
+            """
+            SELECT id FROM (
+                SELECT id, SUM(content_tokens + ?) OVER (ORDER BY id DESC ROWS UNBOUNDED PRECEDING) AS cumulated
+                FROM message WHERE discussion_id=? AND id<=?
+            ) WHERE cumulated <= ? ORDER BY id ASC LIMIT 1
+            """,
+            (per_message_overhead, self.discussion_id, last_message_id if last_message_id is not None else 2**62, max_allowed_tokens),
+            fetch_all=False
+        )
+        return row[0] if row is not None else None
+
+    def export_for_vectorization(self, max_allowed_tokens:int=None):
         """
         Export all discussions and their messages from the database to a Markdown list format.
 
+        Args:
+            max_allowed_tokens (int, optional): If set, only the newest messages fitting in this number of tokens are exported.
+
         Returns:
             list: A list of lists representing discussions and their messages in a Markdown format.
                 Each inner list contains the discussion title and a string representing all
@@ -1244,25 +1796,65 @@ class Discussion:
         """        
         # Extract the title
         title = self.title()
-        messages = ""
-        # Iterate through messages in the discussion
-        for message in self.messages:
-            sender = message.sender
-            content = message.content
-            # Append the sender and content in a Markdown format
-            messages += f'{sender}: {content}\n'
-        return title, messages
+        # Iterate through messages in the discussion, the contents of lazy messages are read at once
+        Message.load_messages_fields(self.discussions_db, self.messages, ["content"])
+        texts = [f'{message.sender}: {message.content}\n' for message in self.messages]
+        if max_allowed_tokens is not None:
+            texts, _ = fit_to_token_budget(
+                                            [(None, text) for text in reversed(texts)],
+                                            max_allowed_tokens,
+                                            lambda key, text: self.lollms.model.tokenize(text)
+                                        )
+        return title, "".join(texts)
  
-    def format_discussion(self, max_allowed_tokens, splitter_text=None):
+    def format_discussion(self, max_allowed_tokens, splitter_text=None, truncate_boundary_message=False):
+        """
+        Formats the newest messages of the discussion that fit in max_allowed_tokens.
+
+        Args:
+            max_allowed_tokens (int): The token budget.
+            splitter_text (str, optional): The separator placed before each message. Defaults to the configured discussion_prompt_separator.
+            truncate_boundary_message (bool, optional): If True, the message crossing the budget is truncated instead of dropped.
+
+        Returns:
+            str: The formatted discussion.
+        """
         if not splitter_text:
             splitter_text = self.lollms.config.discussion_prompt_separator
-        formatted_text = ""
-        for message in reversed(self.messages):  # Start from the newest message
-            formatted_message = f"{splitter_text}{message.sender.replace(':','').replace(splitter_text,'')}:\n{message.content}\n"
-            tokenized_message = self.lollms.model.tokenize(formatted_message)
-            if len(tokenized_message) + len(self.lollms.model.tokenize(formatted_text)) <= max_allowed_tokens:
-                formatted_text = formatted_message + formatted_text
-            else:
-                break  # Stop if adding the next message would exceed the limit
-        return formatted_text   
+        def header(sender):
+            return f"{splitter_text}{sender.replace(':','').replace(splitter_text,'')}:\n"
+
+        if get_tokenizer_id(self.lollms) is None:
+            # No stored counts without a model: tokenize the messages from the newest one
+            texts, _ = fit_to_token_budget(
+                                            ((m.id, f"{header(m.sender)}{m.content}\n") for m in self.iter_messages_reversed()),
+                                            max_allowed_tokens,
+                                            lambda key, text: self.lollms.model.tokenize(text),
+                                            self.lollms.model.detokenize if truncate_boundary_message else None
+                                        )
+            return "".join(texts)
+
+        # The window is found with a single aggregate over the stored counts, then only its messages are read.
+        # Every message is budgeted with the longest header of the discussion plus the stored count margin.
+        self.discussions_db.flush_pending()
+        senders = [row[0] for row in self.discussions_db.select("SELECT DISTINCT sender FROM message WHERE discussion_id=?", (self.discussion_id,))]
+        overhead = max([self.lollms.model.count_tokens(header(sender or "")+"\n") for sender in senders], default=0) + STORED_COUNT_MARGIN
+        start_id = self.get_context_window_start(max_allowed_tokens, per_message_overhead=overhead)
+        rows = self.discussions_db.select(
+            "SELECT id, sender, content, content_tokens FROM message WHERE discussion_id=? AND id>=? ORDER BY id",
+            (self.discussion_id, start_id if start_id is not None else 2**62)
+        )
+        texts = [f"{header(sender or '')}{content or ''}\n" for _, sender, content, _ in rows]
+        used_tokens = sum((content_tokens or 0) + overhead for _, _, _, content_tokens in rows)
+
+        remaining = max_allowed_tokens - used_tokens
+        if truncate_boundary_message and remaining > 0:
+            boundary = self.discussions_db.select(
+                "SELECT sender, content FROM message WHERE discussion_id=? AND id<? ORDER BY id DESC LIMIT 1",
+                (self.discussion_id, start_id if start_id is not None else 2**62), fetch_all=False
+            )
+            if boundary is not None:
+                tokens = self.lollms.model.tokenize(f"{header(boundary[0] or '')}{boundary[1] or ''}\n")
+                texts.insert(0, self.lollms.model.detokenize(tokens[-remaining:]))
+        return "".join(texts)
 # ========================================================================================================================
@@ -0,0 +1,132 @@
+"""
+project: lollms
+file: function_calls_catalog.py
+author: ParisNeo
+description:
+    Persistent, read only index of the function calls zoo.
+    The parsed config.yaml of every function is stored in a sqlite file and served from memory.
+    A function folder is parsed again only when its modification times changed, and the zoo is never written to.
+"""
+from ascii_colors import ASCIIColors
+from lollms.databases.mtime_catalog import MtimeCatalog, _mtime
+from datetime import datetime
+from pathlib import Path
+import os
+import yaml
+
+
+def read_function_call_infos(function_folder:Path, category:str) -> dict:
+    """
+    Reads the listing informations of a function call from its folder.
+    Returns None if the folder does not contain a function call.
+    Missing dates are taken from the modification time of config.yaml (the file is not modified).
+    """
+    config_path = function_folder / "config.yaml"
+    if not config_path.exists() or not (function_folder / "function.py").exists():
+        return None
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f) or {}
+    file_date = datetime.fromtimestamp(_mtime(config_path)).isoformat()
+    return {
+        "name": config.get("function_name", function_folder.name),
+        # name used by mounted_function_calls entries
+        "mount_name": config.get("name", function_folder.name),
+        "description": config.get("description", ""),
+        "parameters": config.get("parameters", {}),
+        "returns": config.get("returns", {}),
+        "examples": config.get("examples", []),
+        "author": config.get("author", "Unknown"),
+        "version": config.get("version", "1.0.0"),
+        "category": category,
+        "creation_date_time": str(config.get("creation_date_time", file_date)),
+        "last_update_date_time": str(config.get("last_update_date_time", file_date)),
+    }
+
+
+class FunctionCallsCatalog(MtimeCatalog):
+    """
+    Index of the function calls of the zoo and of the custom function calls folder ("custom" category).
+
+    Each function is stored with a signature made of the modification times of its folder, config.yaml and
+    function.py (see MtimeCatalog).
+    """
+    entries_table   = "functions"
+    signature_files = ["config.yaml", "function.py"]
+    sort_folders    = True
+
+    def _category_folders(self):
+        """
+        Returns the (category name, folder) pairs, zoo categories first then custom function calls.
+        """
+        folders = []
+        try:
+            with os.scandir(self.lollms_paths.functions_zoo_path) as entries:
+                for entry in entries:
+                    if entry.is_dir() and not entry.name.startswith("."):
+                        folders.append((entry.name, Path(entry.path)))
+        except OSError as ex:
+            ASCIIColors.error(f"Couldn't list the functions zoo ({ex})")
+        if self.lollms_paths.custom_function_calls_path.is_dir():
+            folders.append(("custom", self.lollms_paths.custom_function_calls_path))
+        return folders
+
+    def _read_infos(self, entry_folder:Path, category_name:str, category_path:Path) -> dict:
+        return read_function_call_infos(entry_folder, category_name)
+
+    # ---------------------------------------- Queries ----------------------------------------
+    def get_all(self) -> list:
+        """
+        Returns the infos of every function call, in zoo order.
+        The returned list is shared until the catalog changes, it must not be modified.
+        """
+        self.refresh()
+        with self._lock:
+            if self._listing is None:
+                listing = []
+                for category in self._categories.values():
+                    for folder in category["folders"]:
+                        function = self._entries.get(str(Path(category["path"]) / folder))
+                        if function is not None and function["infos"] is not None:
+                            listing.append(function["infos"])
+                self._listing = listing
+            return self._listing
+
+    def query(self, mounted_function_calls:list, category:str=None, search:str=None, mounted:bool=None, offset:int=0, limit:int=None) -> dict:
+        """
+        Filters and pages the function calls.
+
+        Args:
+            mounted_function_calls (list): The mounted_function_calls entries of the configuration.
+            category (str, optional): Only return the functions of this category.
+            search (str, optional): Only return the functions whose name or description contains this text (case insensitive).
+            mounted (bool, optional): Only return the mounted (True) or not mounted (False) functions.
+            offset (int): Index of the first function to return.
+            limit (int, optional): Maximum number of functions to return.
+
+        Returns:
+            dict: {"function_calls": the page, "total": the number of functions matching the filters}
+        """
+        mounts = {}
+        for entry in mounted_function_calls or []:
+            mounts.setdefault(entry["name"], entry)
+        search = search.lower() if search else None
+
+        results = []
+        for infos in self.get_all():
+            if category is not None and infos["category"] != category:
+                continue
+            if search is not None and search not in str(infos["name"]).lower() and search not in str(infos["description"]).lower():
+                continue
+            mount = mounts.get(infos["mount_name"])
+            if mounted is not None and (mount is not None) != mounted:
+                continue
+            results.append((infos, mount))
+
+        page = results[offset:offset+limit if limit is not None else None]
+        function_calls = []
+        for infos, mount in page:
+            function_info = {k:v for k, v in infos.items() if k != "mount_name"}
+            function_info["mounted"] = mount is not None
+            function_info["selected"] = mount.get("selected", False) if mount is not None else False
+            function_calls.append(function_info)
+        return {"function_calls": function_calls, "total": len(results)}
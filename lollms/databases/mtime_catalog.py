@@ -0,0 +1,210 @@
+"""
+project: lollms
+file: mtime_catalog.py
+author: ParisNeo
+description:
+    Base of the persistent indexes of the zoos (personalities, function calls).
+    A zoo is a set of category folders, each holding one folder per entry. The parsed entries are stored in a sqlite
+    file and served from memory, and the zoo is only read again where directory or file modification times changed.
+"""
+from ascii_colors import ASCIIColors, trace_exception
+from pathlib import Path
+import threading
+import sqlite3
+import json
+import time
+import uuid
+import os
+
+
+def _mtime(path) -> float:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0.0
+
+
+class MtimeCatalog:
+    """
+    Index of the entries of a zoo, kept up to date with modification times.
+
+    Each entry is stored with a signature made of the modification times of its folder and of the signature_files
+    it contains. A refresh lists a category folder only if its own modification time changed, and reads an entry
+    again only if its signature changed. Refreshes are done at most every check_interval seconds, unless forced
+    with invalidate().
+
+    Subclasses give the name of the entries table and the signature files, and implement _category_folders and
+    _read_infos.
+    """
+    # Table of the entries in the catalog database, also used in the log messages
+    entries_table   = "entries"
+    # Files (relative to the entry folder) whose modification times make the signature of an entry
+    signature_files = ["config.yaml"]
+    # Sort the entry folders of each category by name (otherwise the listing order is kept)
+    sort_folders    = False
+
+    def __init__(self, lollms_paths, db_path:Path, check_interval:float=5):
+        self.lollms_paths = lollms_paths
+        self.db_path = Path(db_path)
+        self.check_interval = check_interval
+
+        self._lock = threading.RLock()
+        self._categories = {}       # name -> {"path", "mtime", "folders"}
+        self._entries = {}          # path -> {"category", "folder", "signature", "infos"}
+        self._checked_at = None
+        self._listing = None
+        self.revision = uuid.uuid4().hex
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._initialize_db()
+        self._load()
+
+    # ---------------------------------------- To implement ----------------------------------------
+    def _category_folders(self) -> list:
+        """
+        Returns the (category name, folder) pairs, in listing order.
+        """
+        raise NotImplementedError()
+
+    def _read_infos(self, entry_folder:Path, category_name:str, category_path:Path) -> dict:
+        """
+        Reads the listing informations of an entry from its folder.
+        Returns None if the folder does not contain an entry.
+        """
+        raise NotImplementedError()
+
+    def _scan_extra(self) -> bool:
+        """
+        Updates the state that does not come from the category folders during a refresh.
+        Returns True if it changed.
+        """
+        return False
+
+    # ---------------------------------------- Persistence ----------------------------------------
+    def _initialize_db(self):
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS categories (
+                name TEXT PRIMARY KEY,
+                path TEXT,
+                mtime REAL,
+                position INTEGER,
+                folders TEXT
+            )
+        """)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.entries_table} (
+                path TEXT PRIMARY KEY,
+                category TEXT,
+                folder TEXT,
+                signature TEXT,
+                infos TEXT
+            )
+        """)
+        self.conn.commit()
+
+    def _load(self):
+        try:
+            cursor = self.conn.cursor()
+            for name, path, mtime, position, folders in cursor.execute("SELECT name, path, mtime, position, folders FROM categories ORDER BY position"):
+                self._categories[name] = {"path":path, "mtime":mtime, "folders":json.loads(folders)}
+            for path, category, folder, signature, infos in cursor.execute(f"SELECT path, category, folder, signature, infos FROM {self.entries_table}"):
+                self._entries[path] = {"category":category, "folder":folder, "signature":signature, "infos":json.loads(infos) if infos else None}
+        except Exception as ex:
+            ASCIIColors.warning(f"Couldn't load the {self.entries_table} catalog, rebuilding it ({ex})")
+            self._categories = {}
+            self._entries = {}
+
+    def _save(self, removed_categories, removed_entries, changed_entries):
+        try:
+            cursor = self.conn.cursor()
+            cursor.executemany("DELETE FROM categories WHERE name=?", [(name,) for name in removed_categories])
+            cursor.executemany(
+                "INSERT OR REPLACE INTO categories (name, path, mtime, position, folders) VALUES (?, ?, ?, ?, ?)",
+                [(name, category["path"], category["mtime"], position, json.dumps(category["folders"])) for position, (name, category) in enumerate(self._categories.items())]
+            )
+            cursor.executemany(f"DELETE FROM {self.entries_table} WHERE path=?", [(path,) for path in removed_entries])
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO {self.entries_table} (path, category, folder, signature, infos) VALUES (?, ?, ?, ?, ?)",
+                [(path, e["category"], e["folder"], e["signature"], json.dumps(e["infos"]) if e["infos"] is not None else None) for path, e in changed_entries.items()]
+            )
+            self.conn.commit()
+        except Exception as ex:
+            ASCIIColors.warning(f"Couldn't save the {self.entries_table} catalog ({ex})")
+            trace_exception(ex)
+
+    # ---------------------------------------- Scanning ----------------------------------------
+    def _signature(self, entry_folder:Path) -> str:
+        return ",".join(str(_mtime(entry_folder / name)) for name in [""]+self.signature_files)
+
+    def refresh(self, force:bool=False) -> bool:
+        """
+        Brings the catalog up to date with the zoo.
+
+        Returns:
+            bool: True if the catalog changed.
+        """
+        with self._lock:
+            if not force and self._checked_at is not None and time.monotonic() - self._checked_at < self.check_interval:
+                return False
+            changed_categories = False
+            categories = {}
+            for name, folder in self._category_folders():
+                mtime = _mtime(folder)
+                known = self._categories.get(name)
+                if known is not None and known["mtime"] == mtime and known["path"] == str(folder):
+                    categories[name] = known
+                    continue
+                try:
+                    with os.scandir(folder) as entries:
+                        folders = [entry.name for entry in entries if entry.is_dir() and not entry.name.startswith(".")]
+                except OSError:
+                    folders = []
+                if self.sort_folders:
+                    folders.sort()
+                categories[name] = {"path":str(folder), "mtime":mtime, "folders":folders}
+                changed_categories = True
+
+            entries = {}
+            changed_entries = {}
+            for name, category in categories.items():
+                for folder in category["folders"]:
+                    entry_folder = Path(category["path"]) / folder
+                    path = str(entry_folder)
+                    signature = self._signature(entry_folder)
+                    known = self._entries.get(path)
+                    if known is not None and known["signature"] == signature and known["category"] == name:
+                        entries[path] = known
+                        continue
+                    try:
+                        infos = self._read_infos(entry_folder, name, Path(category["path"]))
+                    except Exception as ex:
+                        ASCIIColors.warning(f"Couldn't read {entry_folder} [{ex}]")
+                        trace_exception(ex)
+                        infos = None
+                    entries[path] = {"category":name, "folder":folder, "signature":signature, "infos":infos}
+                    changed_entries[path] = entries[path]
+
+            removed_categories = [name for name in self._categories if name not in categories]
+            removed_entries = [path for path in self._entries if path not in entries]
+            order_changed = list(categories.keys()) != list(self._categories.keys())
+            extra_changed = self._scan_extra()
+
+            self._checked_at = time.monotonic()
+            if not (changed_categories or changed_entries or removed_categories or removed_entries or order_changed or extra_changed):
+                return False
+
+            self._categories = categories
+            self._entries = entries
+            self._listing = None
+            self.revision = uuid.uuid4().hex
+            self._save(removed_categories, removed_entries, changed_entries)
+            return True
+
+    def invalidate(self):
+        """
+        Forces the next access to check the zoo (to be called after adding, installing or editing an entry).
+        """
+        with self._lock:
+            self._checked_at = None
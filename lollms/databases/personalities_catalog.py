@@ -0,0 +1,168 @@
+"""
+project: lollms
+file: personalities_catalog.py
+author: ParisNeo
+description:
+    Persistent index of the personalities zoo.
+    The parsed metadata and resolved avatars of every personality are stored in a sqlite file and served from memory.
+    The zoo is only rescanned where directory or file modification times changed, so listing a zoo of hundreds
+    of personalities (possibly on network storage) costs a few stat calls instead of parsing every config.yaml.
+"""
+from ascii_colors import ASCIIColors
+from lollms.databases.mtime_catalog import MtimeCatalog
+from pathlib import Path
+import os
+import yaml
+
+# Logo files in order of preference
+LOGO_EXTENSIONS = [".gif", ".webp", ".png", ".jpg", ".jpeg", ".svg", ".bmp"]
+
+
+def get_avatar(real_assets_path:Path, assets_path:Path):
+    """
+    Finds the logo of a personality with a single listing of its assets folder.
+
+    Args:
+        real_assets_path (Path): The assets folder on disk.
+        assets_path (Path): The assets path as served to the ui.
+
+    Returns:
+        tuple: (avatar url or "", has_logo)
+    """
+    try:
+        files = set(os.listdir(real_assets_path))
+    except OSError:
+        return "", False
+    avatar = ""
+    for extension in LOGO_EXTENSIONS:
+        if "logo"+extension in files:
+            avatar = str(assets_path / ("logo"+extension)).replace("\\","/")
+            break
+    return avatar, "logo.png" in files or "logo.gif" in files
+
+
+def read_personality_infos(personality_folder:Path, category:str) -> dict:
+    """
+    Reads the listing informations of a personality from its folder.
+    Returns None if the folder does not contain a personality.
+    """
+    config_path = personality_folder / 'config.yaml'
+    if not config_path.exists():
+        return None
+    personality_info = {"folder":personality_folder.stem}
+    personality_info['has_scripts'] = (personality_folder / 'scripts').exists()
+    with open(config_path, "r", encoding="utf8") as config_file:
+        config_data = yaml.load(config_file, Loader=yaml.FullLoader)
+    personality_info['name'] = config_data.get('name',"No Name")
+    personality_info['description'] = config_data.get('personality_description',"")
+    personality_info['disclaimer'] = config_data.get('disclaimer',"")
+    personality_info['author'] = config_data.get('author', 'ParisNeo')
+    personality_info['language'] = config_data.get('language', 'english')
+    personality_info['version'] = config_data.get('version', '1.0.0')
+    personality_info['creation_date'] = config_data.get("creation_date",None)
+    personality_info['last_update_date'] = config_data.get("last_update_date",None)
+    personality_info['help'] = config_data.get('help', '')
+    personality_info['commands'] = config_data.get('commands', '')
+    personality_info['prompts_list'] = config_data.get('prompts_list', [])
+
+    try:
+        help_path = personality_folder / 'README.md'
+        if help_path.exists():
+            personality_info['help']=help_path.read_text()
+    except:
+        pass
+
+    languages_path = personality_folder / 'languages'
+    if languages_path.exists():
+        personality_info['languages']= [""]+[f.stem for f in languages_path.iterdir() if f.suffix==".yaml"]
+    else:
+        personality_info['languages']=None
+
+    assets_path = Path("personalities") / category / personality_folder.stem / 'assets'
+    personality_info['avatar'], personality_info['has_logo'] = get_avatar(personality_folder / 'assets', assets_path)
+    return personality_info
+
+
+class PersonalitiesCatalog(MtimeCatalog):
+    """
+    Index of the personalities of the zoo and of the custom personalities folder.
+
+    Each personality is stored with a signature made of the modification times of its folder, config.yaml,
+    README.md, assets and languages folders (see MtimeCatalog). The installed personalities are read from the
+    personal configuration folder at each refresh.
+    """
+    entries_table   = "personalities"
+    signature_files = ["config.yaml", "README.md", "assets", "languages"]
+
+    def __init__(self, lollms_paths, db_path:Path, check_interval:float=5):
+        self._installed = set()
+        super().__init__(lollms_paths, db_path, check_interval)
+
+    def _category_folders(self):
+        """
+        Returns the (category name, folder) pairs, custom personalities first.
+        """
+        folders = []
+        if self.lollms_paths.custom_personalities_path.is_dir():
+            folders.append(("custom_personalities", self.lollms_paths.custom_personalities_path))
+        try:
+            with os.scandir(self.lollms_paths.personalities_zoo_path) as entries:
+                for entry in entries:
+                    if entry.is_dir() and not entry.name.startswith("."):
+                        folders.append((Path(entry.name).stem, Path(entry.path)))
+        except OSError as ex:
+            ASCIIColors.error(f"Couldn't list the personalities zoo ({ex})")
+        return folders
+
+    def _read_infos(self, entry_folder:Path, category_name:str, category_path:Path) -> dict:
+        # assets urls use the folder name of the category
+        return read_personality_infos(entry_folder, category_path.stem)
+
+    def _scan_extra(self) -> bool:
+        try:
+            with os.scandir(self.lollms_paths.personal_configuration_path) as entries:
+                installed = {entry.name[len("personality_"):-len(".yaml")] for entry in entries if entry.name.startswith("personality_") and entry.name.endswith(".yaml")}
+        except OSError:
+            installed = set()
+        changed = installed != self._installed
+        self._installed = installed
+        return changed
+
+    # ---------------------------------------- Queries ----------------------------------------
+    def get_categories(self) -> list:
+        """
+        Returns the categories names, custom personalities first.
+        """
+        self.refresh()
+        with self._lock:
+            return ["custom_personalities"]+[name for name in self._categories if name != "custom_personalities"]
+
+    def get_folders(self, category:str) -> list:
+        """
+        Returns the folders of a category.
+        """
+        self.refresh()
+        with self._lock:
+            category = self._categories.get(category)
+            return list(category["folders"]) if category else []
+
+    def get_all(self) -> dict:
+        """
+        Returns the personalities infos grouped by category.
+        The returned dictionary is shared until the catalog changes, it must not be modified.
+        """
+        self.refresh()
+        with self._lock:
+            if self._listing is None:
+                listing = {}
+                for name, category in self._categories.items():
+                    listing[name] = []
+                    for folder in category["folders"]:
+                        personality = self._entries.get(str(Path(category["path"]) / folder))
+                        if personality is None or personality["infos"] is None:
+                            continue
+                        infos = dict(personality["infos"])
+                        infos["installed"] = folder in self._installed or infos["has_scripts"]
+                        listing[name].append(infos)
+                self._listing = listing
+            return self._listing
@@ -1,7 +1,16 @@
 import sqlite3
+import re
 from safe_store import SafeStore
 import numpy as np
 from ascii_colors import ASCIIColors, trace_exception
+
+# Words ignored by the keyword search
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "do", "does", "for", "from", "how", "i", "if", "in",
+    "into", "is", "it", "me", "my", "no", "not", "of", "on", "or", "so", "that", "the", "their", "then", "there", "these",
+    "this", "to", "use", "was", "what", "when", "where", "which", "who", "why", "will", "with", "you", "your"
+}
+
 class SkillsLibrary:
         
     def __init__(self, db_path, chunk_size:int=512, overlap:int=0, n_neighbors:int=5, config=None):
@@ -12,20 +21,93 @@ class SkillsLibrary:
                                     db_path
                                     )
         ASCIIColors.green("Vecorizer ready")
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()        
-        cursor.execute("SELECT * FROM skills_library")
-        res = cursor.fetchall()
+        # The vectors are persisted in the same database, only index what changed since last time
         try:
-            for entry in res:
-                self.vectorizer.add_text(entry[3], entry[4], self.config.rag_vectorizer,
-                                chunk_size=self.config.rag_chunk_size,
-                                chunk_overlap=self.config.rag_overlap)                   
-            cursor.close()
-            conn.close()
+            self._sync_vectors()
         except Exception as ex:
             trace_exception(ex)
-                   
+
+    # ----------------------------------- Vector index -----------------------------------------
+    @staticmethod
+    def _vector_id(skill_id):
+        return f"skill_{skill_id}"
+
+    def _index_skill(self, skill_id, category, title, content):
+        """
+        (Re)builds the vectors of a single skill.
+        An empty skill has no vectors (the store refuses empty texts), it can still be found by keywords.
+        """
+        if content is None or content.strip() == "":
+            try:
+                self.vectorizer.delete_document_by_path(SkillsLibrary._vector_id(skill_id))
+            except Exception:
+                pass
+        else:
+            self.vectorizer.add_text(
+                                        SkillsLibrary._vector_id(skill_id),
+                                        content,
+                                        self.config.rag_vectorizer,
+                                        chunk_size=self.config.rag_chunk_size,
+                                        chunk_overlap=self.config.rag_overlap,
+                                        metadata={"skill_id":skill_id, "category":category, "title":title},
+                                        force_reindex=True
+                                    )
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO skills_vectors (skill_id, vectorizer) VALUES (?, ?)", (skill_id, self.config.rag_vectorizer))
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+    def _unindex_skill(self, skill_id):
+        """
+        Removes the vectors of a single skill.
+        """
+        self.vectorizer.delete_document_by_path(SkillsLibrary._vector_id(skill_id))
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM skills_vectors WHERE skill_id = ?", (skill_id,))
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+    def _sync_vectors(self):
+        """
+        Brings the vector index up to date with the skills table.
+        Only skills that were never indexed (or indexed with another vectorizer) are embedded,
+        and vectors of skills removed behind our back are dropped.
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM skills_vectors")
+        first_sync = cursor.fetchone()[0] == 0
+        cursor.execute("""
+            SELECT s.id, s.category, s.title, s.content FROM skills_library s
+            LEFT JOIN skills_vectors v ON s.id = v.skill_id
+            WHERE v.skill_id IS NULL OR v.vectorizer IS NOT ?
+        """, (self.config.rag_vectorizer,))
+        to_index = cursor.fetchall()
+        cursor.execute("SELECT skill_id FROM skills_vectors WHERE skill_id NOT IN (SELECT id FROM skills_library)")
+        orphans = [r[0] for r in cursor.fetchall()]
+        cursor.close()
+        conn.close()
+
+        if first_sync and len(to_index) > 0:
+            # Older versions indexed the skills by title, drop these vectors
+            for doc in self.vectorizer.list_documents():
+                if not str(doc["file_path"]).startswith("skill_"):
+                    self.vectorizer.delete_document_by_path(doc["file_path"])
+
+        if len(to_index) > 0:
+            ASCIIColors.info(f"Indexing {len(to_index)} skills")
+        for skill_id, category, title, content in to_index:
+            try:
+                self._index_skill(skill_id, category, title, content)
+            except Exception as ex:
+                trace_exception(ex)
+        for skill_id in orphans:
+            self._unindex_skill(skill_id)
+
 
     def _initialize_db(self):
         conn = sqlite3.connect(self.db_path)
@@ -44,6 +126,13 @@ class SkillsLibrary:
                 version INTEGER
             )
         """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS skills_vectors (
+                skill_id INTEGER PRIMARY KEY,
+                vectorizer TEXT
+            )
+        """)
+        conn.commit()
         cursor.execute("SELECT version FROM db_info")
         version = cursor.fetchone()
         self._create_fts_table()  # Create FTS table after initializing the database
@@ -58,11 +147,41 @@ class SkillsLibrary:
             self._migrate_db(version[0])
 
     def _create_fts_table(self):
+        """
+        Creates the full text index of the skills.
+        The index reads its content from skills_library and is kept up to date by triggers.
+        Only titles and contents are indexed, categories are filtered with the skills table.
+        Older databases had a standalone fts table that was never filled, it is replaced and rebuilt.
+        """
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
+        cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'skills_library_fts'")
+        existing = cursor.fetchone()
+        rebuild = existing is None or "UNINDEXED" not in existing[0]
+        if existing is not None and rebuild:
+            cursor.execute("DROP TABLE skills_library_fts")
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS skills_library_fts USING fts5(category UNINDEXED, title, content, content='skills_library', content_rowid='id', tokenize='porter unicode61')
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS skills_library_fts_insert AFTER INSERT ON skills_library BEGIN
+                INSERT INTO skills_library_fts (rowid, category, title, content) VALUES (new.id, new.category, new.title, new.content);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS skills_library_fts_delete AFTER DELETE ON skills_library BEGIN
+                INSERT INTO skills_library_fts (skills_library_fts, rowid, category, title, content) VALUES ('delete', old.id, old.category, old.title, old.content);
+            END
+        """)
         cursor.execute("""
-            CREATE VIRTUAL TABLE IF NOT EXISTS skills_library_fts USING fts5(category, title, content)
+            CREATE TRIGGER IF NOT EXISTS skills_library_fts_update AFTER UPDATE ON skills_library BEGIN
+                INSERT INTO skills_library_fts (skills_library_fts, rowid, category, title, content) VALUES ('delete', old.id, old.category, old.title, old.content);
+                INSERT INTO skills_library_fts (rowid, category, title, content) VALUES (new.id, new.category, new.title, new.content);
+            END
         """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS skills_library_category ON skills_library (category)")
+        if rebuild:
+            cursor.execute("INSERT INTO skills_library_fts (skills_library_fts) VALUES ('rebuild')")
         conn.commit()
         cursor.close()
         conn.close()
@@ -102,11 +221,16 @@ class SkillsLibrary:
             INSERT INTO skills_library (version, category, title, content) 
             VALUES (?, ?, ?, ?)
         """, (version, category, title, content))
+        skill_id = cursor.lastrowid
         conn.commit()
         cursor.close()
         conn.close()
-        self.vectorizer.add_document(title, content, "",True)
-        self.vectorizer.build_index()
+        try:
+            self._index_skill(skill_id, category, title, content)
+        except Exception as ex:
+            # The skill is saved, its vectors are rebuilt by the next sync
+            trace_exception(ex)
+        return skill_id
 
     def list_entries(self):
         conn = sqlite3.connect(self.db_path)
@@ -117,13 +241,33 @@ class SkillsLibrary:
         conn.close()
         return res
     
+    @staticmethod
+    def _fts_expression(text:str) -> str:
+        """
+        Converts free text to an fts5 query matching any of its words in the titles or contents.
+        Stop words are dropped, they match most of the skills and make the bm25 ranking slow.
+        Returns None if the text has no searchable word.
+        """
+        words = list(dict.fromkeys(word.lower() for word in re.findall(r"\w+", text)))
+        words = [word for word in words if word not in STOP_WORDS] or words
+        if len(words) == 0:
+            return None
+        return " OR ".join(f'"{word}"' for word in words)
+
     def query_entry(self, text):
+        """
+        Returns the skills rows containing words of text, best matches first.
+        Uses the full text index (the skills table is never scanned).
+        """
+        expression = SkillsLibrary._fts_expression(text)
+        if expression is None:
+            return []
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()        
         cursor.execute("""
-            SELECT * FROM skills_library 
-            WHERE category LIKE ? OR title LIKE ? OR content LIKE ?
-        """, (f'%{text}%', f'%{text}%', f'%{text}%'))
+            SELECT s.* FROM skills_library_fts f JOIN skills_library s ON s.id = f.rowid
+            WHERE skills_library_fts MATCH ? ORDER BY f.rank
+        """, (expression,))
         res= cursor.fetchall()
         cursor.close()
         conn.close()
@@ -141,18 +285,106 @@ class SkillsLibrary:
         conn.close()
         return res
 
+    def _query_fts_ids(self, cursor, text, limit, category=None):
+        """
+        Returns the ids of the skills best matching text with the bm25 ranking of the full text index.
+        """
+        expression = SkillsLibrary._fts_expression(text)
+        if expression is None:
+            return []
+        if category is None:
+            cursor.execute("SELECT rowid FROM skills_library_fts WHERE skills_library_fts MATCH ? ORDER BY rank LIMIT ?", (expression, limit))
+        else:
+            cursor.execute("""
+                SELECT f.rowid FROM skills_library_fts f JOIN skills_library s ON s.id = f.rowid
+                WHERE skills_library_fts MATCH ? AND s.category = ? ORDER BY f.rank LIMIT ?
+            """, (expression, category, limit))
+        return [r[0] for r in cursor.fetchall()]
+
+    def _query_vector_ids(self, text, limit, min_similarity=0, category=None):
+        """
+        Returns the (skill id, similarity) of the skills closest to text, best first.
+        A skill appears once, with the similarity of its best chunk.
+        """
+        # categories are only stored in the chunks metadata, fetch more candidates when filtering on them
+        chunks = self.vectorizer.query(text, self.config.rag_vectorizer, top_k=limit if category is None else 4*limit)
+        results = {}
+        for chunk in chunks:
+            if chunk["similarity"] <= min_similarity:
+                continue
+            metadata = chunk["metadata"] or {}
+            skill_id = metadata.get("skill_id")
+            if skill_id is None or (category is not None and metadata.get("category") != category):
+                continue
+            if skill_id not in results or chunk["similarity"] > results[skill_id]:
+                results[skill_id] = chunk["similarity"]
+        return sorted(results.items(), key=lambda r: r[1], reverse=True)[:limit]
+
+    def query(self, text, top_k=3, min_similarity=0, category=None, rrf_k=60):
+        """
+        Hybrid search of the skills.
+        The full text index (bm25) and the vector index are queried, then their rankings are fused with
+        reciprocal rank fusion: each skill scores sum(1/(rrf_k + rank)) over the rankings it appears in.
+
+        Args:
+            text (str): The query.
+            top_k (int): Number of skills to return.
+            min_similarity (float): Vector matches below this similarity are ignored.
+            category (str, optional): Only search the skills of this category.
+            rrf_k (int): Reciprocal rank fusion constant, higher values flatten the rank differences.
+
+        Returns:
+            list: dictionaries with the id, category, title, content, similarity (None for keyword only matches) and score of the skills, best first.
+        """
+        n_candidates = max(4*top_k, 20)
+        try:
+            vector_hits = self._query_vector_ids(text, n_candidates, min_similarity, category)
+        except Exception as ex:
+            trace_exception(ex)
+            vector_hits = []
+
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            try:
+                fts_ids = self._query_fts_ids(cursor, text, n_candidates, category)
+            except sqlite3.OperationalError as ex:
+                ASCIIColors.warning(f"Full text search failed: {ex}")
+                fts_ids = []
+
+            scores = {}
+            for rank, skill_id in enumerate(fts_ids):
+                scores[skill_id] = scores.get(skill_id, 0) + 1/(rrf_k + rank + 1)
+            for rank, (skill_id, _) in enumerate(vector_hits):
+                scores[skill_id] = scores.get(skill_id, 0) + 1/(rrf_k + rank + 1)
+            best = sorted(scores.items(), key=lambda s: s[1], reverse=True)[:top_k]
+            if len(best) == 0:
+                return []
+
+            ids = [skill_id for skill_id, _ in best]
+            cursor.execute(f"SELECT id, category, title, content FROM skills_library WHERE id IN ({','.join('?'*len(ids))})", ids)
+            rows = {r[0]:r for r in cursor.fetchall()}
+        finally:
+            conn.close()
+
+        similarities = dict(vector_hits)
+        return [
+                    {"id":skill_id, "category":rows[skill_id][1], "title":rows[skill_id][2], "content":rows[skill_id][3], "similarity":similarities.get(skill_id), "score":score}
+                    for skill_id, score in best if skill_id in rows
+                ]
+
     def query_vector_db(self, query_, top_k=3, min_similarity=0):
         # Use direct string concatenation for the MATCH expression.
         # Ensure text is safely escaped to avoid SQL injection.
         skills = []
         similarities = []
         skill_titles = []        
-        chunks = self.vectorizer.search(query_, top_k)
+        chunks = self.vectorizer.query(query_, self.config.rag_vectorizer, top_k=top_k)
         for chunk in chunks:
-            if  1-chunk.distance>min_similarity:
-                skills.append(chunk.text)
-                similarities.append(1-chunk.distance)
-                skill_titles.append(chunk.doc.title)
+            if  chunk["similarity"]>min_similarity:
+                skills.append(chunk["chunk_text"])
+                similarities.append(chunk["similarity"])
+                skill_titles.append((chunk["metadata"] or {}).get("title", chunk["file_path"]))
             
         return skill_titles, skills, similarities
 
@@ -236,11 +468,22 @@ class SkillsLibrary:
         # Use direct string concatenation for the MATCH expression.
         # Ensure text is safely escaped to avoid SQL injection.
         query = "UPDATE skills_library SET category=?, title=?, content=? WHERE id = ?"
-        cursor.execute(query, (category,title,content))
-        res = cursor.fetchall()
+        cursor.execute(query, (category,title,content,id))
+        updated = cursor.rowcount > 0
+        conn.commit()
         cursor.close()
         conn.close()
-        return [{"id":r[0], "category":r[1], "title":r[2], "content":r[3]} for r in res]
+        if updated:
+            try:
+                self._index_skill(id, category, title, content)
+            except Exception as ex:
+                trace_exception(ex)
+                # Drop the outdated vectors, the next sync indexes the skill again
+                try:
+                    self._unindex_skill(id)
+                except Exception as ex:
+                    trace_exception(ex)
+        return self.get_skill(id)
 
 
     def remove_entry(self, id):
@@ -250,7 +493,7 @@ class SkillsLibrary:
         conn.commit()
         cursor.close()
         conn.close()
-        self.vectorizer.remove_document_by_id(id)
+        self._unindex_skill(id)
 
     def export_entries(self, file_path):
         with open(file_path, 'w') as f:
@@ -266,6 +509,10 @@ class SkillsLibrary:
     def fuse_with_another_db(self, other_db_path):
         other_conn = sqlite3.connect(other_db_path)
         other_cursor = other_conn.cursor()
-        other_cursor.execute("SELECT * FROM skills_library")
-        for row in other_cursor.fetchall():
-            self.add_entry(*row[1:])  # skip the id column
+        other_cursor.execute("SELECT version, category, title, content FROM skills_library")
+        rows = other_cursor.fetchall()
+        other_cursor.close()
+        other_conn.close()
+        # Each added entry only embeds its own content
+        for row in rows:
+            self.add_entry(*row)
@@ -0,0 +1,292 @@
+######
+# Project       : lollms
+# File          : downloader.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Download engine for big files (models).
+# The file is split in segments downloaded in parallel with HTTP range requests into a .part file.
+# The progress of each segment is saved next to it so an interrupted download resumes where it stopped.
+# The result can be checked against an expected sha256 before it is moved to its final place.
+######
+from ascii_colors import ASCIIColors, trace_exception
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List
+import threading
+import requests
+import hashlib
+import json
+import time
+import os
+
+
+class DownloadError(Exception):
+    """Raised when a file can't be downloaded."""
+    pass
+
+
+class DownloadIntegrityError(DownloadError):
+    """Raised when the downloaded file doesn't have the expected sha256."""
+    pass
+
+
+class BandwidthLimiter:
+    """
+    Token bucket shared by the download threads to bound the total bandwidth.
+    A limit of 0 (or None) means unlimited.
+    """
+    def __init__(self, max_bytes_per_second:float=None):
+        self.rate = max_bytes_per_second or 0
+        self._lock = threading.Lock()
+        self._allowance = self.rate
+        self._last = time.monotonic()
+
+    def consume(self, n_bytes:int):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= n_bytes
+            wait = -self._allowance / self.rate if self._allowance < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ChunkedDownloader:
+    """
+    Downloads a file with several parallel range requests, with resume and integrity check.
+
+    Args:
+        connections (int, optional): Number of parallel connections. Defaults to 4.
+        segment_size (int, optional): Minimum size of a segment in bytes. Defaults to 16MB.
+        max_bytes_per_second (float, optional): Total bandwidth limit, 0 or None for unlimited.
+        progress_interval (float, optional): Minimum number of seconds between two progress callbacks. Defaults to 0.5.
+        retries (int, optional): Number of retries of a segment after a network error. Defaults to 5.
+        timeout (float, optional): Connection and read timeout of the requests in seconds. Defaults to 30.
+        headers (dict, optional): Extra headers sent with every request (authentication for example).
+    """
+    STATE_SAVE_INTERVAL = 2 # seconds between two saves of the segments progress
+    BUFFER_SIZE = 1024*1024
+
+    def __init__(
+                    self,
+                    connections:int=4,
+                    segment_size:int=16*1024*1024,
+                    max_bytes_per_second:float=None,
+                    progress_interval:float=0.5,
+                    retries:int=5,
+                    timeout:float=30,
+                    headers:Dict[str, str]=None
+                ):
+        self.connections        = max(1, connections)
+        self.segment_size       = max(1, segment_size)
+        self.limiter            = BandwidthLimiter(max_bytes_per_second)
+        self.progress_interval  = progress_interval
+        self.retries            = retries
+        self.timeout            = timeout
+        self.headers            = headers or {}
+
+    # ---------------------------------------- Helpers ----------------------------------------
+    @staticmethod
+    def file_sha256(path:Path) -> str:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(4*1024*1024), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def probe(self, url:str) -> dict:
+        """
+        Returns the size of the file, whether the server accepts range requests, and the sha256 announced by the server
+        (Hugging Face sends it in the X-Linked-Etag header of LFS files).
+        Servers that refuse HEAD requests (presigned GET only urls for example) are probed with a one byte range request.
+        """
+        try:
+            response = requests.head(url, headers=self.headers, allow_redirects=True, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as ex:
+            ASCIIColors.warning(f"HEAD request refused ({ex}), probing with a GET request")
+            return self._probe_with_get(url)
+        size = int(response.headers.get("content-length", 0))
+        sha256 = None
+        for r in response.history + [response]:
+            etag = r.headers.get("x-linked-etag", "").strip('"').replace("W/", "").strip('"')
+            if len(etag) == 64 and all(c in "0123456789abcdef" for c in etag.lower()):
+                sha256 = etag.lower()
+            size = size or int(r.headers.get("x-linked-size", 0))
+        return {
+            "size": size,
+            "ranges": response.headers.get("accept-ranges", "").lower() == "bytes" and size > 0,
+            "sha256": sha256,
+            "etag": response.headers.get("etag", "")
+        }
+
+    def _probe_with_get(self, url:str) -> dict:
+        headers = dict(self.headers, Range="bytes=0-0")
+        with requests.get(url, headers=headers, stream=True, allow_redirects=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            if response.status_code == 206:
+                # Content-Range: bytes 0-0/<size>
+                total = response.headers.get("content-range", "").rpartition("/")[2]
+                size = int(total) if total.isdigit() else 0
+                ranges = size > 0
+            else:
+                size = int(response.headers.get("content-length", 0))
+                ranges = False
+            return {
+                "size": size,
+                "ranges": ranges,
+                "sha256": None,
+                "etag": response.headers.get("etag", "")
+            }
+
+    def _segments(self, size:int) -> List[dict]:
+        n_segments = max(1, min(self.connections, size // self.segment_size))
+        bounds = [size * i // n_segments for i in range(n_segments + 1)]
+        return [{"start":bounds[i], "end":bounds[i+1], "done":0} for i in range(n_segments)]
+
+    # ---------------------------------------- Download ----------------------------------------
+    def download(self, url:str, destination:str|Path, expected_sha256:str=None, progress_callback:Callable[[int, int], None]=None) -> Path:
+        """
+        Downloads url to destination.
+
+        Args:
+            url (str): The url of the file.
+            destination (str|Path): The final path of the file.
+            expected_sha256 (str, optional): The expected sha256 of the file. Defaults to the one announced by the server if any.
+            progress_callback (Callable, optional): progress_callback(downloaded_size, total_size), called at most every progress_interval seconds and once at the end.
+
+        Raises:
+            DownloadError: if the download failed (the .part file is kept so that it can be resumed).
+            DownloadIntegrityError: if the file doesn't have the expected sha256 (the .part file is removed).
+        """
+        destination = Path(destination)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        part_path = destination.with_name(destination.name + ".part")
+        state_path = destination.with_name(destination.name + ".part.json")
+
+        try:
+            infos = self.probe(url)
+        except requests.RequestException as ex:
+            raise DownloadError(f"Couldn't reach {url}: {ex}") from ex
+        expected_sha256 = (expected_sha256 or infos["sha256"] or "").lower() or None
+        total = infos["size"]
+
+        # Resume only a download of the same file
+        state = None
+        if infos["ranges"] and part_path.exists() and state_path.exists():
+            try:
+                state = json.loads(state_path.read_text())
+                if state.get("url") != url or state.get("size") != total or state.get("etag") != infos["etag"] or part_path.stat().st_size != total:
+                    state = None
+            except (OSError, ValueError):
+                state = None
+        if state is None:
+            state = {"url":url, "size":total, "etag":infos["etag"], "segments":self._segments(total) if infos["ranges"] else []}
+            with open(part_path, "wb") as f:
+                if infos["ranges"]:
+                    f.truncate(total)
+        else:
+            ASCIIColors.info(f"Resuming download of {destination.name} ({sum(s['done'] for s in state['segments'])}/{total} bytes)")
+
+        lock = threading.Lock()
+        progress = {"last_report":0.0, "last_save":time.monotonic()}
+
+        def downloaded():
+            return sum(s["done"] for s in state["segments"])
+
+        def save_state(force=False):
+            # must be called with the lock held
+            now = time.monotonic()
+            if force or now - progress["last_save"] >= ChunkedDownloader.STATE_SAVE_INTERVAL:
+                state_path.write_text(json.dumps(state))
+                progress["last_save"] = now
+
+        def report(force=False):
+            # must be called with the lock held
+            now = time.monotonic()
+            if progress_callback is not None and (force or now - progress["last_report"] >= self.progress_interval):
+                progress["last_report"] = now
+                try:
+                    progress_callback(downloaded(), total)
+                except Exception as ex:
+                    trace_exception(ex)
+
+        if infos["ranges"]:
+            def fetch_segment(segment):
+                for attempt in range(self.retries + 1):
+                    start = segment["start"] + segment["done"]
+                    if start >= segment["end"]:
+                        return
+                    try:
+                        headers = dict(self.headers, Range=f"bytes={start}-{segment['end']-1}")
+                        with requests.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                            if response.status_code != 206:
+                                raise DownloadError(f"The server ignored the range request (status {response.status_code})")
+                            with open(part_path, "r+b") as f:
+                                f.seek(start)
+                                for block in response.iter_content(chunk_size=ChunkedDownloader.BUFFER_SIZE):
+                                    block = block[:segment["end"] - segment["start"] - segment["done"]]
+                                    if not block:
+                                        continue
+                                    self.limiter.consume(len(block))
+                                    f.write(block)
+                                    # flushed before being counted, so that the saved progress is always on disk
+                                    f.flush()
+                                    with lock:
+                                        segment["done"] += len(block)
+                                        report()
+                                        save_state()
+                        if segment["start"] + segment["done"] < segment["end"]:
+                            raise DownloadError("Connection closed before the end of the segment")
+                        return
+                    except (requests.RequestException, DownloadError) as ex:
+                        if attempt == self.retries:
+                            raise DownloadError(f"Segment {segment['start']}-{segment['end']} failed: {ex}") from ex
+                        ASCIIColors.warning(f"Download of {destination.name} interrupted ({ex}), retrying")
+                        time.sleep(min(30, 2**attempt))
+
+            try:
+                with ThreadPoolExecutor(max_workers=len(state["segments"]), thread_name_prefix="download") as executor:
+                    for future in [executor.submit(fetch_segment, segment) for segment in state["segments"]]:
+                        future.result()
+            finally:
+                with lock:
+                    save_state(force=True)
+        else:
+            # No range support: a single stream that can't be resumed
+            try:
+                with requests.get(url, headers=self.headers, stream=True, timeout=self.timeout) as response:
+                    response.raise_for_status()
+                    total = total or int(response.headers.get("content-length", 0))
+                    state["segments"] = [{"start":0, "end":total, "done":0}]
+                    with open(part_path, "wb") as f:
+                        for block in response.iter_content(chunk_size=ChunkedDownloader.BUFFER_SIZE):
+                            if block:
+                                self.limiter.consume(len(block))
+                                f.write(block)
+                                with lock:
+                                    state["segments"][0]["done"] += len(block)
+                                    report()
+            except requests.RequestException as ex:
+                raise DownloadError(f"Couldn't download {url}: {ex}") from ex
+            if total > 0 and state["segments"][0]["done"] != total:
+                raise DownloadError(f"Size mismatch, expected {total} bytes, got {state['segments'][0]['done']}")
+            total = state["segments"][0]["done"]
+
+        with lock:
+            report(force=True)
+
+        if expected_sha256 is not None:
+            sha256 = ChunkedDownloader.file_sha256(part_path)
+            if sha256 != expected_sha256:
+                part_path.unlink(missing_ok=True)
+                state_path.unlink(missing_ok=True)
+                raise DownloadIntegrityError(f"sha256 mismatch for {destination.name}: expected {expected_sha256}, got {sha256}")
+
+        os.replace(part_path, destination)
+        state_path.unlink(missing_ok=True)
+        return destination
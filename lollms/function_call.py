@@ -1,6 +1,14 @@
 from functools import partial
 from typing import Dict, Any, List
 from enum import Enum, auto
+from collections import OrderedDict
+from pathlib import Path
+import importlib.util
+import threading
+import hashlib
+import sys
+import os
+import yaml
 from lollms.client_session import Client
 from lollms.com import LoLLMsCom
 from lollms.config import TypedConfig, ConfigTemplate, BaseConfig
@@ -52,4 +60,90 @@ class FunctionCall:
         return constructed_context
         
     def process_output(self, context, llm_output:str):
-        return llm_output
\ No newline at end of file
+        return llm_output
+
+
+class FunctionCallsRegistry:
+    """
+    Loads the function calls modules once and keeps their instances.
+
+    Each function folder (config.yaml + function.py) is imported under its own module name, so two functions
+    defining the same names don't clobber each other, and kept as long as the modification times of its files
+    don't change. Edited functions are reloaded on their next use.
+    Instances are created once per client and function and kept in a bounded LRU.
+    """
+    def __init__(self, app:LoLLMsCom, max_instances:int=256):
+        self.app = app
+        self.max_instances = max_instances
+        self._lock = threading.RLock()
+        self._modules = {}              # dir -> {"signature", "config", "class"}
+        self._instances = OrderedDict() # (dir, client_id) -> (signature, client, instance)
+
+    @staticmethod
+    def module_name(function_dir:Path) -> str:
+        return "lollms_function_"+hashlib.md5(str(function_dir).encode("utf8")).hexdigest()[:16]
+
+    @staticmethod
+    def _signature(function_dir:Path):
+        return tuple(os.stat(function_dir/name).st_mtime_ns for name in ["config.yaml", "function.py"])
+
+    def _load_module(self, function_dir:Path, signature) -> dict:
+        with open(function_dir/"config.yaml", "r") as f:
+            config = yaml.safe_load(f.read())
+        module_path = function_dir / "function.py"
+        module_name = FunctionCallsRegistry.module_name(function_dir)
+        spec = importlib.util.spec_from_file_location(module_name, module_path)
+        if spec is None:
+            raise ImportError(f"Could not load module from {module_path}")
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        try:
+            spec.loader.exec_module(module)
+        except Exception:
+            del sys.modules[module_name]
+            raise
+        return {"signature":signature, "config":config, "class":getattr(module, config["class_name"])}
+
+    def get(self, function_dir:str|Path, client:Client) -> dict:
+        """
+        Returns the configuration of a function call with its instance for the client in "class".
+
+        Raises:
+            Exception: if the function can't be loaded.
+        """
+        function_dir = Path(function_dir)
+        key = str(function_dir)
+        signature = FunctionCallsRegistry._signature(function_dir)
+        client_id = getattr(client, "client_id", None)
+        with self._lock:
+            module = self._modules.get(key)
+            if module is None or module["signature"] != signature:
+                module = self._load_module(function_dir, signature)
+                self._modules[key] = module
+
+            instance_key = (key, client_id)
+            cached = self._instances.get(instance_key)
+            if cached is not None and cached[0] == signature and cached[1] is client:
+                self._instances.move_to_end(instance_key)
+                instance = cached[2]
+            else:
+                instance = module["class"](self.app, client)
+                self._instances[instance_key] = (signature, client, instance)
+                while len(self._instances) > self.max_instances:
+                    self._instances.popitem(last=False)
+        fc_dict = dict(module["config"])
+        fc_dict["class"] = instance
+        return fc_dict
+
+    def invalidate(self, function_dir:str|Path=None):
+        """
+        Drops the instances of a function (or of all functions) so that they are rebuilt on their next use,
+        for example after their settings were changed.
+        """
+        with self._lock:
+            if function_dir is None:
+                self._instances.clear()
+            else:
+                key = str(Path(function_dir))
+                for instance_key in [k for k in self._instances if k[0] == key]:
+                    del self._instances[instance_key]
@@ -1,5 +1,8 @@
 from enum import Enum
-from ascii_colors import ASCIIColors
+from ascii_colors import ASCIIColors, trace_exception
+import asyncio
+import threading
+from typing import List, Optional
 class ROLE_CHANGE_DECISION(Enum):
     """Roles change detection."""
     
@@ -48,3 +51,146 @@ class RECEPTION_MANAGER:
         self.reception_buffer += chunk
         return ROLE_CHANGE_OURTPUT(ROLE_CHANGE_DECISION.MOVE_ON)
 
+
+
+class StopSequenceMatcher:
+    """
+    Incremental, case insensitive, stop sequences (antiprompts) detection for streamed generations.
+
+    The stop sequences are lowered once. Each received chunk is only scanned together with the last
+    characters already received (the length of the longest stop sequence minus one), so the cost
+    of each chunk does not grow with the length of the answer.
+    """
+    def __init__(self, stop_sequences:List[str]):
+        self.stop_sequences = tuple(dict.fromkeys(s.lower() for s in stop_sequences if s))
+        self.lookback       = max([len(s) for s in self.stop_sequences], default=1) - 1
+        self.reset()
+
+    def reset(self):
+        """
+        Starts a new text.
+        """
+        self.length     = 0 # number of characters received
+        self.detected   = None
+        self._tail      = ""
+
+    def feed(self, chunk:str) -> Optional[str]:
+        """
+        Adds a chunk to the text.
+
+        Returns:
+            str: The (lowered) detected stop sequence, None if none was found yet.
+        """
+        if not chunk:
+            return self.detected
+        window = self._tail + chunk.lower()
+        if self.detected is None:
+            for stop_sequence in self.stop_sequences:
+                if stop_sequence in window:
+                    self.detected = stop_sequence
+                    break
+        self._tail = window[-self.lookback:] if self.lookback > 0 else ""
+        self.length += len(chunk)
+        return self.detected
+
+    def scan(self, text:str) -> Optional[str]:
+        """
+        Checks a growing text (the whole answer received so far): only what was added since the previous call is scanned.
+        If text does not continue the previously scanned text, the matcher starts over with it.
+
+        Returns:
+            str: The (lowered) detected stop sequence, None if none was found yet.
+        """
+        if len(text) < self.length or text[max(0, self.length-self.lookback):self.length].lower() != self._tail:
+            self.reset()
+        return self.feed(text[self.length:])
+
+
+class StreamBridge:
+    """
+    Bridges a generation running in a worker thread to an async consumer (a streaming endpoint).
+
+    The worker pushes chunks with put(), which hands them to the event loop through
+    loop.call_soon_threadsafe so the consumer awaits them without polling.
+    At most max_pending chunks can wait in the queue: beyond that put() blocks the worker
+    until the client catches up (backpressure).
+    When the consumer goes away (client disconnected, response cancelled), put() returns False
+    so the binding callback stops the generation, and on_cancel is called if provided.
+    """
+    _END = object()
+
+    def __init__(self, loop:asyncio.AbstractEventLoop=None, max_pending:int=256, on_cancel=None):
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.on_cancel = on_cancel
+        self.queue = asyncio.Queue()
+        self.slots = threading.Semaphore(max_pending)
+        self.cancelled = threading.Event()
+        self.error = None
+
+    def put(self, chunk) -> bool:
+        """
+        Sends a chunk to the consumer. Called from the worker thread.
+
+        Returns:
+            bool: False if the consumer is gone and the generation should stop.
+        """
+        while not self.slots.acquire(timeout=0.1):
+            if self.cancelled.is_set():
+                return False
+        if self.cancelled.is_set():
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, chunk)
+        except RuntimeError:
+            # The event loop is closed
+            self.cancelled.set()
+            return False
+        return True
+
+    def close(self, error:Exception=None):
+        """
+        Signals the end of the stream. Called from the worker thread.
+        """
+        self.error = error
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, StreamBridge._END)
+        except RuntimeError:
+            pass
+
+    def cancel(self):
+        """
+        Stops accepting chunks and unblocks the worker.
+        """
+        self.cancelled.set()
+        if self.on_cancel is not None:
+            self.on_cancel()
+
+    def run_in_thread(self, target, *args, **kwargs) -> threading.Thread:
+        """
+        Runs target in a worker thread and closes the stream when it returns or fails.
+        """
+        def worker():
+            try:
+                target(*args, **kwargs)
+            except Exception as ex:
+                trace_exception(ex)
+                self.close(ex)
+                return
+            self.close()
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        return thread
+
+    async def chunks(self):
+        """
+        Asynchronously yields the chunks until the worker closes the stream.
+        """
+        try:
+            while True:
+                chunk = await self.queue.get()
+                if chunk is StreamBridge._END:
+                    break
+                self.slots.release()
+                yield chunk
+        finally:
+            self.cancel()
@@ -0,0 +1,359 @@
+######
+# Project       : lollms
+# File          : ingestion.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Background ingestion of the files added to the discussions.
+# Uploads are turned into jobs: documents are parsed in a pool of processes while a single thread
+# transcribes audio files and writes the chunks in the vector stores, so the uploads return at once
+# and the files already indexed can be queried while the others are being ingested.
+# Parsed texts and transcriptions are cached by content hash, so a file that was already ingested
+# in any discussion is not parsed or transcribed again.
+######
+from ascii_colors import ASCIIColors, trace_exception
+from lollms.types import MSG_OPERATION_TYPE
+from concurrent.futures import ProcessPoolExecutor, Future
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, List
+import multiprocessing
+import threading
+import weakref
+import atexit
+import hashlib
+import sqlite3
+import queue
+import time
+import uuid
+
+
+AUDIO_EXTENSIONS = [".wav", ".mp3"]
+
+
+def parse_file(path:str) -> str:
+    """
+    Extracts the text of a document. Executed in the parsing processes.
+    """
+    from safe_store import parse_document
+    return parse_document(path)
+
+
+def file_sha256(path:Path) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(4*1024*1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class IngestionCache:
+    """
+    Texts extracted from the ingested files (parsed documents, transcriptions, image descriptions), by content hash.
+    """
+    def __init__(self, db_path:Path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS contents (
+                hash TEXT,
+                kind TEXT,
+                text TEXT,
+                created_at REAL,
+                PRIMARY KEY (hash, kind)
+            )
+        """)
+        self.conn.commit()
+
+    def get(self, content_hash:str, kind:str) -> str:
+        with self._lock:
+            row = self.conn.execute("SELECT text FROM contents WHERE hash=? AND kind=?", (content_hash, kind)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, content_hash:str, kind:str, text:str):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO contents (hash, kind, text, created_at) VALUES (?, ?, ?, ?)", (content_hash, kind, text, time.time()))
+            self.conn.commit()
+
+
+class IngestionJob:
+    """
+    A file waiting to be ingested in the vector store of a discussion.
+    """
+    QUEUED      = "queued"
+    PARSING     = "parsing"
+    INDEXING    = "indexing"
+    DONE        = "done"
+    FAILED      = "failed"
+    CANCELED    = "canceled"
+
+    def __init__(self, discussion, path:Path, kind:str, client_id=None, callback:Callable=None):
+        self.id             = uuid.uuid4().hex
+        self.discussion     = discussion
+        self.path           = Path(path)
+        self.kind           = kind
+        self.client_id      = client_id
+        self.callback       = callback
+        self.status         = IngestionJob.QUEUED
+        self.progress       = 0
+        self.error          = None
+        self.content_hash   = None
+        self.deduplicated   = False
+        self.created_at     = time.time()
+        self.text:Future    = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in [IngestionJob.DONE, IngestionJob.FAILED, IngestionJob.CANCELED]
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "discussion_id": self.discussion.discussion_id,
+            "filename": self.path.name,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.progress,
+            "error": self.error,
+            "deduplicated": self.deduplicated
+        }
+
+
+class IngestionQueue:
+    """
+    Ingests the discussion files in the background.
+
+    Documents are hashed when they are submitted. If their text is not in the cache, their parsing starts at once in
+    the processes pool, so that several files are parsed while the previous ones are being embedded. Transcriptions
+    and writes to the vector stores are done by a single thread, one job at a time, in submission order.
+    The progress of every job is sent to its client with the "ingestion_progress" socket event.
+
+    Args:
+        app: The lollms application (used for the configuration, the stt service and the notifications).
+        cache_path (Path): The sqlite file of the content cache.
+        parse_workers (int, optional): Number of parsing processes. 0 parses the documents in the ingestion thread. Defaults to 2.
+        max_finished_jobs (int, optional): Number of finished jobs kept for the status requests. Defaults to 256.
+    """
+    def __init__(self, app, cache_path:Path, parse_workers:int=2, max_finished_jobs:int=256):
+        self.app                = app
+        self.cache              = IngestionCache(cache_path)
+        self.parse_workers      = max(0, parse_workers)
+        self.max_finished_jobs  = max_finished_jobs
+
+        self._lock = threading.Lock()
+        self._jobs:OrderedDict = OrderedDict()
+        self._queue = queue.Queue()
+        self._executor = None
+        self._thread = None
+        atexit.register(IngestionQueue._shutdown_at_exit, weakref.ref(self))
+
+    # ---------------------------------------- Workers ----------------------------------------
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # must be called with the lock held
+        # spawned rather than forked: the server process holds models and threads
+        if self._executor is None and self.parse_workers > 0:
+            self._executor = ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="ingestion", daemon=True)
+            self._thread.start()
+
+    @staticmethod
+    def _shutdown_at_exit(queue_ref):
+        ingestion_queue = queue_ref()
+        if ingestion_queue is not None:
+            ingestion_queue.shutdown()
+
+    def shutdown(self):
+        """
+        Stops the ingestion thread after its current job and the parsing processes.
+        """
+        self._queue.put(None)
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    # ---------------------------------------- Jobs ----------------------------------------
+    def submit(self, discussion, path:Path, client_id=None, callback:Callable=None) -> IngestionJob:
+        """
+        Adds a file of the discussion to the queue and returns its job.
+        Audio files are transcribed into the text folder of the discussion, then the transcription is ingested.
+        """
+        path = Path(path)
+        job = IngestionJob(discussion, path, "audio" if path.suffix.lower() in AUDIO_EXTENSIONS else "text", client_id, callback)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        try:
+            job.content_hash = file_sha256(path)
+            cached = self.cache.get(job.content_hash, job.kind)
+            if cached is not None:
+                job.deduplicated = True
+                job.text = Future()
+                job.text.set_result(cached)
+            elif job.kind == "text":
+                with self._lock:
+                    executor = self._get_executor()
+                if executor is not None:
+                    job.text = executor.submit(parse_file, str(path))
+        except Exception as ex:
+            trace_exception(ex)
+            job.status = IngestionJob.FAILED
+            job.error = str(ex)
+            self._notify(job)
+            return job
+        self._notify(job)
+        self._queue.put(job)
+        self._ensure_thread()
+        return job
+
+    def is_submitted(self, discussion, path:Path) -> bool:
+        """
+        Tells if a file of the discussion is already handled: it has an unfinished job, or a job of the discussion
+        already ingested or failed on the same content.
+        The Discussion objects are rebuilt on every load, so the jobs are matched by discussion_id.
+        """
+        path = Path(path)
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if job.discussion.discussion_id == discussion.discussion_id and job.status != IngestionJob.CANCELED]
+        if any(job.path == path and not job.finished for job in jobs):
+            return True
+        hashes = {job.content_hash for job in jobs if job.status in [IngestionJob.DONE, IngestionJob.FAILED] and job.content_hash is not None}
+        if len(hashes) == 0:
+            return False
+        try:
+            return file_sha256(path) in hashes
+        except OSError:
+            return False
+
+    def cancel(self, discussion, path:Path=None):
+        """
+        Cancels the unfinished jobs of a discussion (or of one of its files).
+        """
+        with self._lock:
+            jobs = [
+                        job for job in self._jobs.values()
+                        if job.discussion.discussion_id == discussion.discussion_id and not job.finished and (path is None or job.path == Path(path))
+                    ]
+        for job in jobs:
+            job.status = IngestionJob.CANCELED
+            if job.text is not None:
+                job.text.cancel()
+            self._notify(job)
+
+    def get_jobs(self, discussion_id=None, client_id=None) -> List[dict]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [
+                    job.to_dict() for job in jobs
+                    if (discussion_id is None or job.discussion.discussion_id == discussion_id) and (client_id is None or job.client_id == client_id)
+                ]
+
+    def pending(self, discussion=None) -> int:
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job.finished and (discussion is None or job.discussion.discussion_id == discussion.discussion_id))
+
+    def _prune(self):
+        # must be called with the lock held
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+    def _notify(self, job:IngestionJob):
+        if job.client_id is None:
+            return
+        try:
+            self.app.schedule_task(self.app.emit_socket_io_info("ingestion_progress", job.to_dict(), job.client_id))
+        except Exception as ex:
+            trace_exception(ex)
+
+    def _set_status(self, job:IngestionJob, status:str, progress:int):
+        job.status = status
+        job.progress = progress
+        self._notify(job)
+
+    # ---------------------------------------- Ingestion ----------------------------------------
+    def _get_text(self, job:IngestionJob) -> str:
+        if job.text is not None:
+            return job.text.result()
+        if job.kind == "audio":
+            if self.app.stt is None:
+                raise Exception("Please select an stt engine in the services settings first")
+            return self.app.stt.transcribe(str(job.path))
+        return parse_file(str(job.path))
+
+    def _ingest(self, job:IngestionJob):
+        discussion = job.discussion
+        config = self.app.config
+        self._set_status(job, IngestionJob.PARSING, 10)
+        text = self._get_text(job)
+        if job.status == IngestionJob.CANCELED:
+            return
+        if not job.deduplicated:
+            self.cache.put(job.content_hash, job.kind, text)
+
+        document_path = job.path
+        if job.kind == "audio":
+            document_path = discussion.discussion_text_folder/(job.path.stem+".txt")
+            with open(document_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            if document_path not in discussion.text_files:
+                discussion.text_files.append(document_path)
+            self.app.info(f"Transcription saved to {document_path.name}", client_id=job.client_id)
+        elif not job.path.exists():
+            # removed from the discussion while it was waiting
+            job.status = IngestionJob.CANCELED
+            return
+
+        if not text or not text.strip():
+            raise Exception("Empty file")
+        self._set_status(job, IngestionJob.INDEXING, 50)
+        # serialized with the removal of the discussion files
+        with discussion._vectorizer_lock:
+            if job.status == IngestionJob.CANCELED:
+                return
+            vectorizer = discussion.get_vectorizer()
+            vectorizer.add_text(
+                                    str(document_path),
+                                    text,
+                                    config.rag_vectorizer,
+                                    chunk_size=config.rag_chunk_size,
+                                    chunk_overlap=config.rag_overlap,
+                                    metadata={"title":document_path.name, "content_hash":job.content_hash},
+                                    force_reindex=True
+                                )
+            if job.status == IngestionJob.CANCELED:
+                # removed while its chunks were being written
+                vectorizer.delete_document_by_path(str(document_path))
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            if job.status == IngestionJob.CANCELED:
+                continue
+            try:
+                self._ingest(job)
+                if job.status != IngestionJob.CANCELED:
+                    self._set_status(job, IngestionJob.DONE, 100)
+                    if job.callback is not None:
+                        job.callback(f"{job.path.name} added successfully", MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_INFO)
+                    if job.client_id is not None:
+                        self.app.schedule_task(self.app.refresh_files(job.client_id))
+            except Exception as ex:
+                trace_exception(ex)
+                ASCIIColors.error(f"Couldn't ingest {job.path.name}")
+                job.error = str(ex)
+                self.app.error(f"Couldn't add {job.path.name} to the discussion: {ex}", client_id=job.client_id)
+                self._set_status(job, IngestionJob.FAILED, 100)
+            finally:
+                # the texts of the finished jobs are in the cache
+                job.text = None
+                with self._lock:
+                    self._prune()
@@ -8,6 +8,11 @@ from freedom_search import InternetSearchEnhancer
 from scrapemaster import ScrapeMaster
 from pathlib import Path
 from safe_store import SafeStore
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+import threading
+import hashlib
+import sqlite3
 
 def get_favicon_url(url):
     import requests
@@ -282,15 +287,210 @@ def internet_search(query, internet_nb_search_pages, chromedriver_path=None, qui
 
     return search_results
 
-def internet_search_with_vectorization(query, chromedriver_path=None, internet_nb_search_pages=5, internet_vectorization_chunk_size=512, internet_vectorization_overlap_size=20, internet_vectorization_nb_chunks=4, model = None, quick_search:bool=False, vectorizer = "tfidf", vectorize=True, asses_using_llm=True, yes_no=None):
+class InternetSearchCache:
     """
+    Vector store of the web pages returned by the searches, shared between searches.
+
+    Pages are keyed by url and kept for ttl seconds: a page found again by a later (or related) search is neither
+    scraped nor vectorized again, and a refetched page is only vectorized again if its content hash changed.
+    Each search only reads back the chunks of its own result pages.
+    The pages are fetched concurrently, the vectorization is done in the calling thread.
     """
+    def __init__(self, db_path:str|Path=None, ttl:float=24*3600, max_workers:int=4, fetch_page:Callable=None, search:Callable=None):
+        """
+        Args:
+            db_path (str|Path, optional): The store database. Defaults to ~/internet_ss.db.
+            ttl (float, optional): Number of seconds a fetched page is reused. Defaults to one day.
+            max_workers (int, optional): Number of pages fetched at the same time. Defaults to 4.
+            fetch_page (Callable, optional): fetch_page(url) -> text. Defaults to scraping the page with ScrapeMaster.
+            search (Callable, optional): search(query, num_results) -> [{"title", "snippet", "url"}]. Defaults to InternetSearchEnhancer.
+        """
+        self.db_path = Path(db_path) if db_path is not None else Path.home() / "internet_ss.db"
+        self.ttl = ttl
+        self.max_workers = max(1, max_workers)
+        self.fetch_page = fetch_page if fetch_page is not None else InternetSearchCache.scrape_page
+        self.search = search if search is not None else lambda query, num_results: InternetSearchEnhancer().search(query, num_results=num_results)
+        self.vdb = SafeStore(self.db_path)
+        self.lock = threading.Lock()
+        conn = sqlite3.connect(str(self.db_path))
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS internet_pages (
+                url TEXT PRIMARY KEY,
+                title TEXT,
+                content_hash TEXT,
+                vectorizer TEXT,
+                full_page INTEGER,
+                fetched_at REAL
+            )
+        """)
+        conn.commit()
+        conn.close()
+
+    @staticmethod
+    def scrape_page(url:str) -> str:
+        result = ScrapeMaster(url).scrape_all()
+        return "\n".join(result["texts"])
+
+    def evict(self, conn):
+        """
+        Removes the pages older than the ttl from the store.
+        """
+        expired = [row[0] for row in conn.execute("SELECT url FROM internet_pages WHERE fetched_at < ?", (time.time() - self.ttl,))]
+        for url in expired:
+            try:
+                self.vdb.delete_document_by_path(url)
+            except Exception as ex:
+                trace_exception(ex)
+            conn.execute("DELETE FROM internet_pages WHERE url=?", (url,))
+        conn.commit()
+        return len(expired)
+
+    def _fetch_all(self, urls:list) -> dict:
+        def fetch(url):
+            try:
+                return self.fetch_page(url)
+            except Exception as ex:
+                ASCIIColors.warning(f"Couldn't fetch {url} ({ex})")
+                return None
+        if len(urls) <= 1 or self.max_workers == 1:
+            return {url: fetch(url) for url in urls}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls))) as executor:
+            return dict(zip(urls, executor.map(fetch, urls)))
+
+    def index_results(self, results:list, vectorizer_name:str, chunk_size:int, chunk_overlap:int, quick_search:bool=False) -> list:
+        """
+        Makes sure every search result page is in the store and returns the urls of the pages available.
+        The pages are fetched without holding the lock of the store, so that concurrent searches fetch at the same time.
+        """
+        urls = [r["url"] for r in results]
+        known_sql = f"SELECT url, content_hash, vectorizer, full_page FROM internet_pages WHERE url IN ({','.join('?'*len(urls))})"
+        with self.lock:
+            conn = sqlite3.connect(str(self.db_path))
+            try:
+                self.evict(conn)
+                known = {row[0]: row[1:] for row in conn.execute(known_sql, urls)}
+            finally:
+                conn.close()
+
+        reused = set()
+        texts = {}
+        to_fetch = []
+        for result in results:
+            url = result["url"]
+            page = known.get(url)
+            if page is not None and page[1] == vectorizer_name and (page[2] or quick_search):
+                # Fresh and at least as complete as what is asked
+                reused.add(url)
+            elif quick_search:
+                texts[url] = f"title: {result['title']}\nbrief: {result['snippet']}\nhref: {url}\n"
+            else:
+                to_fetch.append(url)
+        texts.update(self._fetch_all(to_fetch))
 
-    from selenium import webdriver
-    from selenium.webdriver.chrome.options import Options
-    from safe_store import SafeStore
+        with self.lock:
+            conn = sqlite3.connect(str(self.db_path))
+            try:
+                # another search may have indexed some of these pages while they were being fetched
+                known = {row[0]: row[1:] for row in conn.execute(known_sql, urls)}
+                available = []
+                for result in results:
+                    url = result["url"]
+                    if url in reused:
+                        available.append(url)
+                        continue
+                    page = known.get(url)
+                    if quick_search and page is not None and page[1] == vectorizer_name:
+                        # indexed by another search in the meantime, don't replace it with the snippet
+                        available.append(url)
+                        continue
+                    text = texts.get(url)
+                    if not text:
+                        # The page couldn't be fetched, use the previous version if there is one
+                        if url in known:
+                            available.append(url)
+                        continue
+                    content_hash = hashlib.sha256(text.encode("utf-8", errors="ignore")).hexdigest()
+                    if page is None or page[0] != content_hash or page[1] != vectorizer_name:
+                        ASCIIColors.orange(f"Vectorizing result:{result['title']}")
+                        self.vdb.add_text(
+                                            url,
+                                            text,
+                                            vectorizer_name,
+                                            chunk_size=chunk_size,
+                                            chunk_overlap=chunk_overlap,
+                                            metadata={"title":result["title"], "url":url},
+                                            force_reindex=True
+                                        )
+                    conn.execute(
+                        "INSERT OR REPLACE INTO internet_pages (url, title, content_hash, vectorizer, full_page, fetched_at) VALUES (?, ?, ?, ?, ?, ?)",
+                        (url, result["title"], content_hash, vectorizer_name, 0 if quick_search else 1, time.time())
+                    )
+                    available.append(url)
+                conn.commit()
+                return available
+            finally:
+                conn.close()
+
+    def query(self, query:str, urls:list, vectorizer_name:str, top_k:int) -> list:
+        """
+        Returns the top_k chunks of the given pages that best match the query.
+        """
+        urls = set(urls)
+        if len(urls) == 0 or top_k <= 0:
+            return []
+        # The store is shared between searches and its queries can't be restricted to some documents:
+        # the query is widened until top_k chunks of these pages are found or the whole store was ranked
+        n_chunks = top_k * len(urls)
+        while True:
+            chunks = self.vdb.query(query, vectorizer_name, top_k=n_chunks)
+            selected = [
+                            {
+                                "title": (chunk.get("metadata") or {}).get("title", chunk["file_path"]),
+                                "url": chunk["file_path"],
+                                "chunk_text": chunk["chunk_text"],
+                                "similarity": chunk.get("similarity")
+                            }
+                            for chunk in chunks if chunk["file_path"] in urls
+                        ]
+            if len(selected) >= top_k or len(chunks) < n_chunks:
+                return selected[:top_k]
+            n_chunks *= 4
+
+    def search_and_vectorize(self, query:str, nb_pages:int, vectorizer_name:str, chunk_size:int, chunk_overlap:int, nb_chunks:int, quick_search:bool=False) -> list:
+        results = self.search(query, nb_pages)[:nb_pages]
+        if len(results) == 0:
+            return []
+        urls = self.index_results(results, vectorizer_name, chunk_size, chunk_overlap, quick_search)
+        with self.lock:
+            return self.query(query, urls, vectorizer_name, nb_chunks)
+
+
+_internet_search_caches = {}
+_internet_search_caches_lock = threading.Lock()
+
+def get_internet_search_cache(db_path:str|Path=None, ttl:float=24*3600, max_workers:int=4) -> InternetSearchCache:
+    """
+    Returns the search cache of a database, creating it the first time.
+    """
+    key = str(db_path)
+    with _internet_search_caches_lock:
+        if key not in _internet_search_caches:
+            _internet_search_caches[key] = InternetSearchCache(db_path, ttl, max_workers)
+        cache = _internet_search_caches[key]
+    cache.ttl = ttl
+    cache.max_workers = max(1, max_workers)
+    return cache
 
-    from safe_store import SafeStore
+
+def internet_search_with_vectorization(query, chromedriver_path=None, internet_nb_search_pages=5, internet_vectorization_chunk_size=512, internet_vectorization_overlap_size=20, internet_vectorization_nb_chunks=4, model = None, quick_search:bool=False, vectorizer = "tfidf", vectorize=True, asses_using_llm=True, yes_no=None, cache_path:str|Path=None, cache_ttl:float=24*3600, max_workers:int=4, judge=None):
+    """
+    Searches the internet and returns the chunks of the result pages that are the most relevant to the query.
+    If asses_using_llm is True and a judge is given (judge(query, texts, min_relevant) -> indices of the useful texts,
+    see AIPersonality.verify_rag_entries), twice as many candidates are retrieved and only the ones judged useful are kept.
+
+    Returns:
+        list: dictionaries with the title, url, chunk_text and similarity of each chunk.
+    """
     # Vectorizer selection
     if vectorizer == "st":
         vectorizer_name = "st:all-MiniLM-L6-v2"
@@ -300,34 +500,20 @@ def internet_search_with_vectorization(query, chromedriver_path=None, internet_n
         vectorizer_name = "openai:text-embedding-3-small"
     elif vectorizer == "ollama":
         vectorizer_name = "ollama:bge-3m"
-    tmp_path = Path.home()
-    # Create database path and initialize VectorDatabase
-    db_path = tmp_path / f"internet_ss.db"
-    vdb = SafeStore(db_path)   
-    formatted_text = ""
-    nb_non_empty = 0
-    ise = InternetSearchEnhancer()
-    results = ise.search(query, num_results=internet_nb_search_pages)
-    
-    if len(results)>0:
-        for i, result in enumerate(results):
-            ASCIIColors.orange(f"Processing result:{result['title']}")
-            title = result["title"]
-            brief = result["snippet"]
-            href = result["url"]
-            formatted_text = f"""title: {title}
-brenf: {brief}
-href: {href}
-"""
-            if quick_search:
-                vdb.add_text(title, formatted_text,vectorizer_name, metadata={"title":title,"brenf":brief,"href":href})
-            else:
-                get_relevant_text_block(href, vectorizer, title)
-            nb_non_empty += 1
-            if nb_non_empty>=internet_nb_search_pages:
-                break
-        chunks = vdb.query(query,vectorizer_name, top_k= internet_vectorization_nb_chunks)
     else:
-        chunks = []
-
+        vectorizer_name = vectorizer
+    judged = asses_using_llm and judge is not None
+    cache = get_internet_search_cache(cache_path, cache_ttl, max_workers)
+    chunks = cache.search_and_vectorize(
+                                        query,
+                                        internet_nb_search_pages,
+                                        vectorizer_name,
+                                        internet_vectorization_chunk_size,
+                                        internet_vectorization_overlap_size,
+                                        2*internet_vectorization_nb_chunks if judged else internet_vectorization_nb_chunks,
+                                        quick_search
+                                    )
+    if judged and len(chunks) > 0:
+        relevant = judge(query, [chunk["chunk_text"] for chunk in chunks], internet_vectorization_nb_chunks)
+        chunks = [chunks[i] for i in relevant][:internet_vectorization_nb_chunks]
     return chunks
@@ -28,7 +28,13 @@ import subprocess
 import yaml
 from ascii_colors import ASCIIColors, trace_exception
 import time
+import threading
+import hashlib
+import sqlite3
 from lollms.types import MSG_OPERATION_TYPE, SUMMARY_MODE
+from lollms.summarization import MapReduceSummarizer, default_summary_mode, generate_isolated
+from lollms.relevance import RelevanceJudge
+from lollms.generation import StopSequenceMatcher
 import json
 from typing import Any, List, Optional, Type, Callable, Dict, Any, Union, Tuple
 
@@ -99,6 +105,13 @@ def fix_json(json_text):
         trace_exception(e)
 class AIPersonality:
 
+    # Persona data ingestion runs in the background, one personality at a time
+    persona_data_lock = threading.Lock()
+    PERSONA_DATA_EXTENSIONS = ['.asm', '.bat', '.c', '.cpp', '.cs', '.csproj', '.css',
+                '.csv', '.docx', '.h', '.hh', '.hpp', '.html', '.inc', '.ini', '.java', '.js', '.json', '.log',
+                '.lua', '.map', '.md', '.pas', '.pdf', '.php', '.pptx', '.ps1', '.py', '.rb', '.rtf', '.s', '.se', '.sh', '.sln',
+                '.snippet', '.snippets', '.sql', '.sym', '.ts', '.txt', '.xlsx', '.xml', '.yaml', '.yml', '.msg']
+
     # Extra
     def __init__(
                     self,
@@ -451,7 +464,11 @@ class AIPersonality:
                                                     model = self.model,
                                                     quick_search=quick_search,
                                                     asses_using_llm=asses_using_llm,
-                                                    yes_no = self.yes_no
+                                                    yes_no = self.yes_no,
+                                                    cache_path = self.lollms_paths.personal_data_path / "internet_search_cache.db",
+                                                    cache_ttl = float(self.config.get("internet_cache_ttl", 24*3600)),
+                                                    max_workers = int(self.config.get("internet_fetch_workers", 4)),
+                                                    judge = self.verify_rag_entries
                                                     )
 
     def sink(self, s=None,i=None,d=None):
@@ -1552,7 +1569,9 @@ Don't forget encapsulate the code inside a html code tag. This is mandatory.
             self.nb_received_tokens+=1
 
 
-        antiprompt = self.detect_antiprompt(bot_says)
+        # Only the new part of the answer is scanned
+        self._stop_sequence_matcher = self.stop_sequence_matcher(getattr(self, "_stop_sequence_matcher", None))
+        antiprompt = self._stop_sequence_matcher.scan(bot_says)
         if antiprompt:
             self.bot_says = remove_text_from_string(bot_says,antiprompt)
             ASCIIColors.warning(f"\n{antiprompt} detected. Stopping generation")
@@ -1563,6 +1582,15 @@ Don't forget encapsulate the code inside a html code tag. This is mandatory.
             self.bot_says = bot_says
             return True
 
+    def scheduled(self, generate_function:Callable) -> Callable:
+        """
+        Returns generate_function routed through the application generation queue (if any).
+        """
+        scheduler = getattr(self.app, "scheduler", None)
+        if scheduler is None:
+            return generate_function
+        return partial(scheduler.run, generate_function)
+
     def generate_with_images(self, prompt, images, max_size=None, temperature = None, top_k = None, top_p=None, repeat_penalty=None, repeat_last_n=None, callback=None, debug=False, show_progress=False ):
         ASCIIColors.info("Text generation started: Warming up")
         self.nb_received_tokens = 0
@@ -1573,11 +1601,11 @@ Don't forget encapsulate the code inside a html code tag. This is mandatory.
         if max_size is None:
             max_size = min(self.config.max_n_predict if self.config.max_n_predict else self.config.ctx_size-self.model.count_tokens(prompt), self.config.ctx_size-self.model.count_tokens(prompt))
 
-        self.model.generate_with_images(
+        self.scheduled(self.model.generate_with_images)(
                                 prompt,
                                 images,
                                 max_size,
-                                partial(self.process, callback=callback, show_progress=show_progress),
+                                callback=partial(self.process, callback=callback, show_progress=show_progress),
                                 temperature=self.model_temperature if temperature is None else temperature,
                                 top_k=self.model_top_k if top_k is None else top_k,
                                 top_p=self.model_top_p if top_p is None else top_p,
@@ -1594,10 +1622,10 @@ Don't forget encapsulate the code inside a html code tag. This is mandatory.
             self.print_prompt("gen",prompt)
         ntokens = self.model.count_tokens(prompt)
         
-        self.model.generate(
+        self.scheduled(self.model.generate)(
                                 prompt,
                                 max_size if max_size else min(self.config.ctx_size-ntokens,self.config.max_n_predict if self.config.max_n_predict else self.config.ctx_size-ntokens),
-                                partial(self.process, callback=callback, show_progress=show_progress),
+                                callback=partial(self.process, callback=callback, show_progress=show_progress),
                                 temperature=self.model_temperature if temperature is None else temperature,
                                 top_k=self.model_top_k if top_k is None else top_k,
                                 top_p=self.model_top_p if top_p is None else top_p,
@@ -1609,6 +1637,25 @@ Don't forget encapsulate the code inside a html code tag. This is mandatory.
         
         return self.bot_says
 
+    def generate_isolated(self, prompt, max_size=None, temperature = None, top_k = None, top_p=None, repeat_penalty=None, repeat_last_n=None):
+        """
+        Generates text without touching the shared generation state (bot_says, callback),
+        so that several generations can run at the same time (map reduce summarization for example).
+        Nothing is streamed to the user.
+        """
+        ntokens = self.model.count_tokens(prompt)
+        return generate_isolated(
+                                self.scheduled(self.model.generate),
+                                prompt,
+                                max_size if max_size else min(self.config.ctx_size-ntokens,self.config.max_n_predict if self.config.max_n_predict else self.config.ctx_size-ntokens),
+                                self.stop_sequence_matcher(),
+                                temperature=self.model_temperature if temperature is None else temperature,
+                                top_k=self.model_top_k if top_k is None else top_k,
+                                top_p=self.model_top_p if top_p is None else top_p,
+                                repeat_penalty=self.model_repeat_penalty if repeat_penalty is None else repeat_penalty,
+                                repeat_last_n = self.model_repeat_last_n if repeat_last_n is None else repeat_last_n,
+                                )
+
     def setCallback(self, callback: Callable[[str | list | None, MSG_OPERATION_TYPE, str, Any | None], bool]):
         self.callback = callback
         if self._processor:
@@ -1774,21 +1821,16 @@ Don't forget encapsulate the code inside a html code tag. This is mandatory.
         self.audio_samples = [f for f in self.audio_path.iterdir()]
 
         # Verify if the persona has a data folder
+        self.persona_data_ready = threading.Event()
         if self.data_path.exists():
             self.database_path = self.data_path / "db.db"
             self.persona_data_vectorizer = SafeStore(self.database_path)
-
-            files = [f for f in self.data_path.iterdir() if f.suffix.lower() in ['.asm', '.bat', '.c', '.cpp', '.cs', '.csproj', '.css',
-                '.csv', '.docx', '.h', '.hh', '.hpp', '.html', '.inc', '.ini', '.java', '.js', '.json', '.log',
-                '.lua', '.map', '.md', '.pas', '.pdf', '.php', '.pptx', '.ps1', '.py', '.rb', '.rtf', '.s', '.se', '.sh', '.sln',
-                '.snippet', '.snippets', '.sql', '.sym', '.ts', '.txt', '.xlsx', '.xml', '.yaml', '.yml', '.msg'] ]
-
-            for f in files:
-                self.persona_data_vectorizer.add_document(f, self.config.rag_vectorizer)
-
+            # Only new or modified files are vectorized, in the background so that mounting is not blocked
+            threading.Thread(target=self.vectorize_persona_data, name=f"persona_data_{self.personality_folder_name}", daemon=True).start()
         else:
             self.persona_data_vectorizer = None
             self._data = None
+            self.persona_data_ready.set()
 
         self.personality_output_folder = self.lollms_paths.personal_outputs_path/self.name
         self.personality_output_folder.mkdir(parents=True, exist_ok=True)
@@ -1817,6 +1859,65 @@ Don't forget encapsulate the code inside a html code tag. This is mandatory.
 
 
 
+    def vectorize_persona_data(self):
+        """
+        Brings the vector store of the data folder up to date.
+
+        The size, modification time and sha256 of the vectorized files are kept in the persona_data_files table
+        of the store database. Unchanged files are skipped without being read, files whose content changed are
+        vectorized again and files removed from the folder are removed from the store.
+        persona_data_ready is set once done.
+        """
+        try:
+            with AIPersonality.persona_data_lock:
+                conn = sqlite3.connect(str(self.database_path))
+                try:
+                    conn.execute("""
+                        CREATE TABLE IF NOT EXISTS persona_data_files (
+                            path TEXT PRIMARY KEY,
+                            size INTEGER,
+                            mtime REAL,
+                            hash TEXT,
+                            vectorizer TEXT
+                        )
+                    """)
+                    manifest = {row[0]: row[1:] for row in conn.execute("SELECT path, size, mtime, hash, vectorizer FROM persona_data_files")}
+                    vectorizer = self.config.rag_vectorizer
+                    files = [f for f in self.data_path.iterdir() if f.is_file() and f.suffix.lower() in AIPersonality.PERSONA_DATA_EXTENSIONS]
+                    n_vectorized = 0
+                    for f in files:
+                        stat = f.stat()
+                        known = manifest.pop(str(f), None)
+                        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime and known[3] == vectorizer:
+                            continue
+                        file_hash = hashlib.sha256(f.read_bytes()).hexdigest()
+                        if known is None or known[2] != file_hash or known[3] != vectorizer:
+                            ASCIIColors.info(f"Vectorizing persona data: {f.name}")
+                            self.persona_data_vectorizer.add_document(f, vectorizer)
+                            n_vectorized += 1
+                        conn.execute(
+                            "INSERT OR REPLACE INTO persona_data_files (path, size, mtime, hash, vectorizer) VALUES (?, ?, ?, ?, ?)",
+                            (str(f), stat.st_size, stat.st_mtime, file_hash, vectorizer)
+                        )
+                        conn.commit()
+                    # What is left in the manifest was removed from the folder
+                    for path in manifest:
+                        try:
+                            self.persona_data_vectorizer.delete_document_by_path(path)
+                        except Exception as ex:
+                            trace_exception(ex)
+                        conn.execute("DELETE FROM persona_data_files WHERE path=?", (path,))
+                    conn.commit()
+                    if n_vectorized > 0 or len(manifest) > 0:
+                        ASCIIColors.success(f"Persona data of {self.name}: {n_vectorized} file(s) vectorized, {len(manifest)} removed")
+                finally:
+                    conn.close()
+        except Exception as ex:
+            trace_exception(ex)
+            ASCIIColors.error(f"Couldn't vectorize the persona data of {self.name}")
+        finally:
+            self.persona_data_ready.set()
+
     def remove_file(self, file_name, callback=None):
         try:
             if any(file_name == entry.name for entry in self.text_files):
@@ -2630,22 +2731,82 @@ Don't forget encapsulate the code inside a html code tag. This is mandatory.
         Returns:
             bool: True if any antiprompt is found in the text (ignoring case), False otherwise.
         """
-        start_header_id_template        = self.config.start_header_id_template
-        start_user_header_id_template   = self.config.start_user_header_id_template
-        start_ai_header_id_template     = self.config.start_ai_header_id_template
+        text = text.lower()
+        for prompt in self.get_stop_sequences():
+            if prompt in text:
+                return prompt
+        return None
 
-        anti_prompts = [start_header_id_template, start_user_header_id_template, start_ai_header_id_template]
-        if self.app.config.separator_template!="\n":
-            anti_prompts.append(self.app.config.separator_template)
+    def get_stop_sequences(self) -> List[str]:
+        """
+        Returns the lowered antiprompts of the current templates.
+        The list is only rebuilt when the templates change.
+        """
+        key = (
+                self.config.start_header_id_template,
+                self.config.start_user_header_id_template,
+                self.config.start_ai_header_id_template,
+                self.app.config.separator_template
+            )
+        if getattr(self, "_stop_sequences_key", None) != key:
+            anti_prompts = [key[0], key[1], key[2]]
+            if key[3]!="\n":
+                anti_prompts.append(key[3])
+            self._stop_sequences = [prompt.lower() for prompt in anti_prompts if prompt]
+            self._stop_sequences_key = key
+        return self._stop_sequences
 
-        for prompt in anti_prompts:
-            if prompt.lower() in text.lower():
-                return prompt.lower()
-        return None
+    def stop_sequence_matcher(self, matcher:StopSequenceMatcher=None) -> StopSequenceMatcher:
+        """
+        Returns an incremental antiprompt detector for a streamed answer.
+        If matcher is given and still uses the current antiprompts it is returned as is (keeping its state).
+        """
+        stop_sequences = self.get_stop_sequences()
+        if matcher is None or matcher.stop_sequences != tuple(dict.fromkeys(stop_sequences)):
+            matcher = StopSequenceMatcher(stop_sequences)
+        return matcher
 
     def verify_rag_entry(self, query, rag_entry):
         return self.yes_no("Are there any useful information in the document chunk that can be used to answer the query?", self.app.system_custom_header("Query")+query+"\n"+self.app.system_custom_header("document chunk")+"\n"+rag_entry)
 
+    def verify_rag_entries(self, query:str, rag_entries:List[str], min_relevant:int=None, batch_size:int=None) -> List[int]:
+        """
+        Judges the relevance of several document chunks with as few generations as possible.
+        The chunks are numbered in batches judged by a single prompt, batches are judged concurrently
+        if the binding serves parallel requests (generation_max_parallel).
+
+        Args:
+            query (str): The query the chunks should help answering.
+            rag_entries (List[str]): The chunks, best candidates first.
+            min_relevant (int, optional): Stop judging once this number of relevant chunks is found.
+            batch_size (int, optional): Maximum number of chunks per prompt. Defaults to the relevance_judgement_batch_size configuration.
+
+        Returns:
+            List[int]: The indices of the relevant chunks.
+        """
+        def batch_prompt(query, chunks):
+            return "\n".join([
+                                self.system_full_header+"For each numbered document chunk, decide if it contains useful information that can be used to answer the query.",
+                                "Answer only with a json object listing the numbers of the useful chunks, for example {\"relevant\": [0, 2]}. Use an empty list if no chunk is useful.",
+                                self.system_custom_header("Query")+query,
+                            ]+[
+                                self.system_custom_header(f"document chunk {i}")+"\n"+chunk for i, chunk in enumerate(chunks)
+                            ]+[
+                                self.ai_custom_header("answer")
+                            ])
+
+        scheduler = getattr(self.app, "scheduler", None)
+        judge = RelevanceJudge(
+                                lambda prompt, max_size: self.generate_isolated(prompt, max_size, temperature=0),
+                                self.model.count_tokens,
+                                self.config.ctx_size,
+                                batch_prompt,
+                                batch_size=batch_size if batch_size is not None else int(self.config.get("relevance_judgement_batch_size", 8)),
+                                max_workers=int(self.config.get("generation_max_parallel", 1)),
+                                wrap_worker=scheduler.bind_to_current_request if scheduler is not None else None
+                            )
+        return judge.judge(query, rag_entries, min_relevant)
+
 
     def translate(self, text_chunk, output_language="french", max_generation_size=3000):
         start_header_id_template    = self.config.start_header_id_template
@@ -2666,6 +2827,59 @@ Don't forget encapsulate the code inside a html code tag. This is mandatory.
                                     max_generation_size=max_generation_size, callback=self.sink)
         return translated
     
+    def _map_reduce_memory(self, chunks:List[str], chunk_processing_prompt:str, chunk_processing_output_format:str, ctx_size:int, step_callback:Callable=None) -> str:
+        """
+        Builds the document analysis memory of sequential_summarize with a map reduce: each chunk is analysed alone,
+        then the analyses are merged level by level.
+        """
+        def extract_memory(output):
+            code = self.extract_code_blocks(output)
+            return code[0]["content"] if code else output
+
+        def map_prompt(chunk):
+            return "\n".join([
+                                self.system_full_header+"You are a structured text summary assistant that extracts the relevant information of a document chunk.",
+                                "Only add information explicitly present in the chunk, do not invent anything.",
+                                self.user_full_header+chunk_processing_prompt,
+                                "----",
+                                "# Text chunk:",
+                                "----",
+                                "```markdown",
+                                chunk,
+                                "```",
+                                f"Put the extracted information inside a {chunk_processing_output_format} markdown tag, without comments.",
+                                self.ai_full_header
+                            ])
+        def reduce_prompt(memories):
+            return "\n".join([
+                                self.system_full_header+"You are a structured text summary assistant that merges the analyses of consecutive chunks of a document.",
+                                "Retain all relevant information, do not invent anything.",
+                                self.user_full_header+chunk_processing_prompt,
+                            ]+[
+                                f"----\n# Analysis {i}:\n----\n```{chunk_processing_output_format}\n{memory}\n```" for i, memory in enumerate(memories)
+                            ]+[
+                                f"Merge these analyses, written in the document order, into a single one inside a {chunk_processing_output_format} markdown tag, without comments.",
+                                self.ai_full_header
+                            ])
+        def step(step_name, done, total):
+            if step_callback:
+                step_callback(step_name, done, total, "")
+
+        scheduler = getattr(self.app, "scheduler", None)
+        summarizer = MapReduceSummarizer(
+                                            [self.generate_isolated],
+                                            self.model.count_tokens,
+                                            ctx_size,
+                                            ctx_size//4,
+                                            map_prompt,
+                                            reduce_prompt,
+                                            max_workers=int(self.config.get("summarization_max_workers", 1)),
+                                            post_processing=extract_memory,
+                                            step_callback=step,
+                                            wrap_worker=scheduler.bind_to_current_request if scheduler is not None else None
+                                        )
+        return summarizer.summarize(chunks)
+
     def sequential_summarize(
                             self, 
                             text:str,
@@ -2679,7 +2893,8 @@ Don't forget encapsulate the code inside a html code tag. This is mandatory.
                             bootstrap_steps:int=None,
                             callback = None,
                             step_callback: Callable[[str, int, int, str], None] = None,
-                            debug:bool= False):
+                            debug:bool= False,
+                            summary_mode:SUMMARY_MODE=None):
         """
             This function processes a given text in chunks and generates a summary for each chunk.
             It then combines the summaries to create a final summary.
@@ -2694,6 +2909,7 @@ Don't forget encapsulate the code inside a html code tag. This is mandatory.
             chunk_size (int, optional): The size of each chunk. Defaults to None.
             callback (callable, optional): A function to be called after processing each chunk. Defaults to None.
             debug (bool, optional): A flag to enable debug mode. Defaults to False.
+            summary_mode (SUMMARY_MODE, optional): SUMMARY_MODE_MAP_REDUCE analyses the chunks in parallel and merges the analyses instead of updating the memory chunk after chunk. Defaults to map reduce if summarization_max_workers > 1.
 
             Returns:
             The final summary in the specified format.
@@ -2704,6 +2920,9 @@ Don't forget encapsulate the code inside a html code tag. This is mandatory.
         if chunk_size is None:
             chunk_size = ctx_size // 4
 
+        if summary_mode is None:
+            summary_mode = default_summary_mode(self.config)
+
         # Tokenize entire text
         all_tokens = self.model.tokenize(text)
         total_tokens = len(all_tokens)
@@ -2755,25 +2974,30 @@ Do not discuss the information inside the memory, just put the relevant informat
         static_tokens = self.model.count_tokens(example_prompt)
 
         # Process text in chunks
-        while start_token_idx < total_tokens:
-            # Calculate available tokens for chunk
-            current_memory_tokens = self.model.count_tokens(memory)
-            available_tokens = ctx_size - static_tokens - current_memory_tokens
-
-            if available_tokens <= 0:
-                raise ValueError("Memory too large - consider reducing chunk size or increasing context window")
-
-            # Get chunk tokens
-            if bootstrap_chunk_size is not None and chunk_id < bootstrap_steps:
-                end_token_idx = min(start_token_idx + bootstrap_chunk_size, total_tokens)
-            else:                
-                end_token_idx = min(start_token_idx + chunk_size, total_tokens)
-            chunk_tokens = all_tokens[start_token_idx:end_token_idx]
-            chunk = self.model.detokenize(chunk_tokens)
-            chunk_id += 1
-
-            # Generate memory update
-            prompt =  f"""{self.system_full_header}
+        if summary_mode==SUMMARY_MODE.SUMMARY_MODE_MAP_REDUCE:
+            # The chunks are analysed independently and in parallel, then the analyses are merged
+            chunks = [self.model.detokenize(all_tokens[i:i+chunk_size]) for i in range(0, total_tokens, chunk_size)]
+            memory = self._map_reduce_memory(chunks, chunk_processing_prompt, chunk_processing_output_format, ctx_size, step_callback)
+        else:
+            while start_token_idx < total_tokens:
+                # Calculate available tokens for chunk
+                current_memory_tokens = self.model.count_tokens(memory)
+                available_tokens = ctx_size - static_tokens - current_memory_tokens
+
+                if available_tokens <= 0:
+                    raise ValueError("Memory too large - consider reducing chunk size or increasing context window")
+
+                # Get chunk tokens
+                if bootstrap_chunk_size is not None and chunk_id < bootstrap_steps:
+                    end_token_idx = min(start_token_idx + bootstrap_chunk_size, total_tokens)
+                else:                
+                    end_token_idx = min(start_token_idx + chunk_size, total_tokens)
+                chunk_tokens = all_tokens[start_token_idx:end_token_idx]
+                chunk = self.model.detokenize(chunk_tokens)
+                chunk_id += 1
+
+                # Generate memory update
+                prompt =  f"""{self.system_full_header}
 You are a structured sequential text summary assistant that processes documents chunk by chunk, updating a memory of previously generated information at each step.
 
 Your goal is to extract and combine relevant information from each text chunk with the existing memory, ensuring no key details are omitted or invented.
@@ -2810,22 +3034,22 @@ Do not discuss the information inside the memory, just put the relevant informat
 ```
 {self.ai_full_header}
         """             
-            if debug:
-                ASCIIColors.yellow(f" ----- {chunk_id-1} ------")
-                ASCIIColors.red(prompt)
-            if step_callback:
-                step_callback("Memory creation", chunk_id, (total_tokens//chunk_size)+1, "")
-            memory = self.generate(prompt, max_size=ctx_size//4, callback=callback).strip()
-            code = self.extract_code_blocks(memory)
-            if code:
-                memory = code[0]["content"]
+                if debug:
+                    ASCIIColors.yellow(f" ----- {chunk_id-1} ------")
+                    ASCIIColors.red(prompt)
+                if step_callback:
+                    step_callback("Memory creation", chunk_id, (total_tokens//chunk_size)+1, "")
+                memory = self.generate(prompt, max_size=ctx_size//4, callback=callback).strip()
+                code = self.extract_code_blocks(memory)
+                if code:
+                    memory = code[0]["content"]
 
-            if debug:
-                ASCIIColors.yellow(f" ----- OUT ------")
-                ASCIIColors.yellow(memory)
-                ASCIIColors.yellow(" ----- ------")
-            # Move to next chunk
-            start_token_idx = end_token_idx
+                if debug:
+                    ASCIIColors.yellow(f" ----- OUT ------")
+                    ASCIIColors.yellow(memory)
+                    ASCIIColors.yellow(" ----- ------")
+                # Move to next chunk
+                start_token_idx = end_token_idx
 
         # Prepare final summary prompt
         final_prompt_template = f"""
@@ -2872,7 +3096,7 @@ The updated memory must be put in a {chunk_processing_output_format} markdown ta
                         max_summary_size=512,
                         callback=None,
                         chunk_summary_post_processing=None,
-                        summary_mode=SUMMARY_MODE.SUMMARY_MODE_SEQUENCIAL
+                        summary_mode:SUMMARY_MODE=None
                     ):
         tk = self.model.tokenize(text)
         prev_len = len(tk)
@@ -2910,7 +3134,7 @@ The updated memory must be put in a {chunk_processing_output_format} markdown ta
                                 max_summary_size=512,
                                 callback=None,
                                 chunk_summary_post_processing=None,
-                                summary_mode=SUMMARY_MODE.SUMMARY_MODE_SEQUENCIAL
+                                summary_mode:SUMMARY_MODE=None
                             ):
         tk = self.model.tokenize(text)
         prev_len = len(tk)
@@ -2955,12 +3179,15 @@ The updated memory must be put in a {chunk_processing_output_format} markdown ta
                             max_generation_size=3000,
                             callback=None,
                             chunk_summary_post_processing=None,
-                            summary_mode=SUMMARY_MODE.SUMMARY_MODE_SEQUENCIAL
+                            summary_mode:SUMMARY_MODE=None
                         ):
         start_header_id_template    = self.config.start_header_id_template
         end_header_id_template      = self.config.end_header_id_template
         system_message_template     = self.config.system_message_template
 
+        if summary_mode is None:
+            # map reduce when the chunks can be summarized in parallel
+            summary_mode = default_summary_mode(self.config)
         if summary_mode==SUMMARY_MODE.SUMMARY_MODE_SEQUENCIAL:
             summary = ""
             for i, chunk in enumerate(chunks):
@@ -2985,6 +3212,27 @@ The updated memory must be put in a {chunk_processing_output_format} markdown ta
                     summary = chunk_summary_post_processing(summary)
                 self.step_end(f" Summary of {doc_name} - Processing chunk : {i+1}/{len(chunks)}")
             return summary
+        elif summary_mode==SUMMARY_MODE.SUMMARY_MODE_MAP_REDUCE:
+            def step(step_name, done, total):
+                self.step(f" Summary of {doc_name} - {step_name} : {done}/{total}")
+
+            scheduler = getattr(self.app, "scheduler", None)
+            summarizer = MapReduceSummarizer.for_document(
+                                                            [self.generate_isolated],
+                                                            self.model.count_tokens,
+                                                            self.config,
+                                                            max_generation_size,
+                                                            summary_instruction,
+                                                            doc_name,
+                                                            answer_start,
+                                                            chunk_summary_post_processing=chunk_summary_post_processing,
+                                                            step_callback=step,
+                                                            wrap_worker=scheduler.bind_to_current_request if scheduler is not None else None
+                                                        )
+            self.step_start(f" Summary of {doc_name} - {len(chunks)} chunks")
+            summary = summarizer.summarize(chunks)
+            self.step_end(f" Summary of {doc_name} - {len(chunks)} chunks")
+            return summary
         else:
             summeries = []
             for i, chunk in enumerate(chunks):
@@ -3910,7 +4158,7 @@ class APScript(StateMachine):
                         max_summary_size=512,
                         callback=None,
                         chunk_summary_post_processing=None,
-                        summary_mode=SUMMARY_MODE.SUMMARY_MODE_SEQUENCIAL
+                        summary_mode:SUMMARY_MODE=None
                     ):
         tk = self.personality.model.tokenize(text)
         prev_len = len(tk)
@@ -3948,7 +4196,7 @@ class APScript(StateMachine):
                                 max_summary_size=512,
                                 callback=None,
                                 chunk_summary_post_processing=None,
-                                summary_mode=SUMMARY_MODE.SUMMARY_MODE_SEQUENCIAL
+                                summary_mode:SUMMARY_MODE=None
                             ):
         tk = self.personality.model.tokenize(text)
         prev_len = len(tk)
@@ -3993,12 +4241,15 @@ class APScript(StateMachine):
                             max_generation_size=3000,
                             callback=None,
                             chunk_summary_post_processing=None,
-                            summary_mode=SUMMARY_MODE.SUMMARY_MODE_SEQUENCIAL
+                            summary_mode:SUMMARY_MODE=None
                         ):
         start_header_id_template    = self.config.start_header_id_template
         end_header_id_template      = self.config.end_header_id_template
         system_message_template     = self.config.system_message_template
 
+        if summary_mode is None:
+            # map reduce when the chunks can be summarized in parallel
+            summary_mode = default_summary_mode(self.config)
         if summary_mode==SUMMARY_MODE.SUMMARY_MODE_SEQUENCIAL:
             summary = ""
             for i, chunk in enumerate(chunks):
@@ -4023,6 +4274,17 @@ class APScript(StateMachine):
                     summary = chunk_summary_post_processing(summary)
                 self.step_end(f" Summary of {doc_name} - Processing chunk : {i+1}/{len(chunks)}")
             return summary
+        elif summary_mode==SUMMARY_MODE.SUMMARY_MODE_MAP_REDUCE:
+            return self.personality.summarize_chunks(
+                                                        chunks,
+                                                        summary_instruction,
+                                                        doc_name,
+                                                        answer_start,
+                                                        max_generation_size,
+                                                        callback,
+                                                        chunk_summary_post_processing=chunk_summary_post_processing,
+                                                        summary_mode=summary_mode
+                                                    )
         else:
             summeries = []
             for i, chunk in enumerate(chunks):
@@ -5691,6 +5953,12 @@ fetch('/open_file', {
         self.personality.app.select_model(binding_name, model_name)
     def verify_rag_entry(self, query, rag_entry):
         return self.yes_no("Are there any useful information in the document chunk that can be used to answer the query?", self.app.system_custom_header("Query")+query+"\n"+self.app.system_custom_header("document chunk")+"\n"+rag_entry)
+
+    def verify_rag_entries(self, query:str, rag_entries:List[str], min_relevant:int=None, batch_size:int=None) -> List[int]:
+        """
+        Judges the relevance of several document chunks in batched prompts and returns the indices of the relevant ones.
+        """
+        return self.personality.verify_rag_entries(query, rag_entries, min_relevant=min_relevant, batch_size=batch_size)
     # Properties ===============================================
     @property
     def start_header_id_template(self) -> str:
@@ -5774,6 +6042,64 @@ fetch('/open_file', {
         return f"{self.start_ai_header_id_template}{ai_name}{self.end_ai_header_id_template}"
 
 
+class LazyPersonality:
+    """
+    Stands for a mounted personality that is only built the first time it is used.
+
+    The category and folder name are known without loading anything. Any other attribute access loads the
+    personality (through the loader given by the application) and is then forwarded to it. Models assigned
+    before loading are kept and given to the personality once built.
+    The loader returns (personality, failed): failed is set when the personality could not be built and
+    a fallback personality was returned instead.
+    """
+    def __init__(self, personality_path:str, loader:Callable[[str], Tuple[AIPersonality, bool]]):
+        parts = str(personality_path).split("/")
+        object.__setattr__(self, "personality_path", personality_path)
+        object.__setattr__(self, "category", parts[0])
+        object.__setattr__(self, "personality_folder_name", Path(parts[-1]).stem)
+        object.__setattr__(self, "_loader", loader)
+        object.__setattr__(self, "_personality", None)
+        object.__setattr__(self, "_pending", {})
+        object.__setattr__(self, "_lock", threading.Lock())
+        object.__setattr__(self, "load_time", None)
+        object.__setattr__(self, "failed", False)
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._personality is not None
+
+    def load(self) -> AIPersonality:
+        """
+        Builds the personality if needed and returns it.
+        """
+        if self._personality is None:
+            with self._lock:
+                if self._personality is None:
+                    start = time.perf_counter()
+                    personality, failed = self._loader(self.personality_path)
+                    for key, value in self._pending.items():
+                        setattr(personality, key, value)
+                    object.__setattr__(self, "load_time", time.perf_counter() - start)
+                    object.__setattr__(self, "failed", failed)
+                    object.__setattr__(self, "_personality", personality)
+                    ASCIIColors.info(f"Personality {self.personality_path} loaded in {self.load_time:.2f}s")
+        return self._personality
+
+    def __getattr__(self, key):
+        if key.startswith("__"):
+            raise AttributeError(key)
+        return getattr(self.load(), key)
+
+    def __setattr__(self, key, value):
+        if self._personality is None and key == "model":
+            self._pending[key] = value
+        else:
+            setattr(self.load(), key, value)
+
+    def __repr__(self):
+        return f"LazyPersonality({self.personality_path}, loaded={self.is_loaded})"
+
+
 class AIPersonalityInstaller:
     def __init__(self, personality:AIPersonality) -> None:
         self.personality = personality
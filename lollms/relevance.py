@@ -0,0 +1,163 @@
+######
+# Project       : lollms
+# File          : relevance.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Batched relevance judgement of retrieved chunks (RAG, internet search).
+# Instead of asking the model a yes/no question per chunk, several chunks are numbered in a single
+# prompt and the model answers with the list of the useful ones. Batches are judged concurrently
+# when the binding serves parallel requests, and judging stops as soon as enough relevant chunks are found.
+######
+from ascii_colors import ASCIIColors
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, List
+import json
+import re
+
+
+class RelevanceJudge:
+    """
+    Selects the chunks that are useful to answer a query.
+
+    Args:
+        generate (Callable): Generation function generate(prompt, max_size) -> str.
+            It must be safe to call from several threads if max_workers is above 1.
+        count_tokens (Callable): count_tokens(text) -> int.
+        ctx_size (int): The context size of the model.
+        batch_prompt (Callable): batch_prompt(query, chunks:List[str]) -> the prompt asking which of the
+            numbered chunks are useful, answered with a json object like {"relevant": [0, 2]}.
+        batch_size (int, optional): Maximum number of chunks judged in a single prompt. Defaults to 8.
+        max_workers (int, optional): Number of batches judged at the same time. Defaults to 1.
+        wrap_worker (Callable, optional): Wraps the functions executed in the worker threads
+            (used to attach them to the generation request of the calling thread).
+    """
+    def __init__(
+                    self,
+                    generate:Callable,
+                    count_tokens:Callable,
+                    ctx_size:int,
+                    batch_prompt:Callable,
+                    batch_size:int=8,
+                    max_workers:int=1,
+                    wrap_worker:Callable=None
+                ):
+        self.generate       = generate
+        self.count_tokens   = count_tokens
+        self.ctx_size       = ctx_size
+        self.batch_prompt   = batch_prompt
+        self.batch_size     = max(1, batch_size)
+        self.max_workers    = max(1, max_workers)
+        self.wrap_worker    = wrap_worker
+
+    @staticmethod
+    def answer_size(nb_chunks:int) -> int:
+        """
+        Number of tokens allowed for the answer of a batch.
+        """
+        return 32 + 4 * nb_chunks
+
+    def _batches(self, query:str, chunks:List[str]) -> List[List[int]]:
+        """
+        Packs consecutive chunks in batches of at most batch_size chunks whose prompt fits in the context.
+        With several workers, the chunks are spread so that every worker gets a batch.
+        """
+        batch_size = min(self.batch_size, -(-len(chunks) // self.max_workers))
+        budget = self.ctx_size - self.answer_size(batch_size) - self.count_tokens(self.batch_prompt(query, []))
+        batches = []
+        current = []
+        current_tokens = 0
+        for index, chunk in enumerate(chunks):
+            n_tokens = self.count_tokens(chunk)
+            if len(current) > 0 and (len(current) >= batch_size or current_tokens + n_tokens > budget):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append(index)
+            current_tokens += n_tokens
+        if len(current) > 0:
+            batches.append(current)
+        return batches
+
+    @staticmethod
+    def parse_answer(answer:str, nb_chunks:int) -> List[int]:
+        """
+        Extracts the indices of the relevant chunks from the answer of the model.
+        The answer must contain a json object {"relevant": [...]} or a json list. The only other answers understood
+        are an explicit "none" (no relevant chunk) and a bare list of numbers ("0, 2").
+        Returns None if the answer can't be understood: numbers found in free text are not trusted
+        ("chunk 2 is not useful").
+        """
+        match = re.search(r"\{.*\}|\[.*\]", answer, re.DOTALL)
+        if match:
+            try:
+                parsed = json.loads(match.group(0))
+            except json.JSONDecodeError:
+                parsed = None
+            if isinstance(parsed, dict):
+                parsed = parsed.get("relevant")
+            if isinstance(parsed, list) and all(isinstance(i, int) or (isinstance(i, str) and i.strip().isdigit()) for i in parsed):
+                return sorted(set(int(i) for i in parsed if 0 <= int(i) < nb_chunks))
+            return None
+
+        text = answer.strip().strip(".").strip().lower()
+        if re.fullmatch(r"none|nothing|no|no (chunk|document chunk)s? (is|are) (useful|relevant)", text):
+            return []
+        if re.fullmatch(r"\d+(\s*(,|;|and)\s*\d+)*", text):
+            return sorted(set(int(n) for n in re.findall(r"\d+", text) if 0 <= int(n) < nb_chunks))
+        return None
+
+    def _judge_batch(self, query:str, chunks:List[str], batch:List[int]) -> List[int]:
+        prompt = self.batch_prompt(query, [chunks[i] for i in batch])
+        relevant = self.parse_answer(self.generate(prompt, self.answer_size(len(batch))), len(batch))
+        if relevant is None:
+            # Ask once more, with the start of the json answer already written
+            answer_start = "{\"relevant\": ["
+            answer = self.generate(prompt+answer_start, self.answer_size(len(batch)))
+            relevant = self.parse_answer(answer_start+answer, len(batch))
+            if relevant is None:
+                relevant = self.parse_answer(answer, len(batch))
+        if relevant is None:
+            ASCIIColors.warning(f"Couldn't read the relevance judgement, the {len(batch)} chunks of the batch are not kept")
+            return []
+        return [batch[i] for i in relevant]
+
+    def judge(self, query:str, chunks:List[str], min_relevant:int=None) -> List[int]:
+        """
+        Returns the indices of the chunks that are useful to answer the query, in the order of the chunks.
+
+        Args:
+            query (str): The query.
+            chunks (List[str]): The candidate chunks, best candidates first.
+            min_relevant (int, optional): Stop judging once this number of relevant chunks is found.
+                Batches that already started are still collected.
+        """
+        if len(chunks) == 0:
+            return []
+        batches = self._batches(query, chunks)
+        relevant = []
+
+        if self.max_workers == 1 or len(batches) == 1:
+            for batch in batches:
+                relevant += self._judge_batch(query, chunks, batch)
+                if min_relevant is not None and len(relevant) >= min_relevant:
+                    break
+            return sorted(relevant)
+
+        work = self._judge_batch
+        if self.wrap_worker:
+            work = self.wrap_worker(work)
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+            pending = {executor.submit(work, query, chunks, batch) for batch in batches}
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    relevant += future.result()
+                if min_relevant is not None and len(relevant) >= min_relevant:
+                    for future in pending:
+                        future.cancel()
+                    pending = {future for future in pending if not future.cancelled()}
+                    for future in pending:
+                        relevant += future.result()
+                    break
+        return sorted(relevant)
@@ -0,0 +1,131 @@
+######
+# Project       : lollms
+# File          : retrieval.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Federated retrieval over several vector stores (mounted datalakes, persona data, discussion documents).
+# The stores are queried at the same time, each one with its own timeout, then their chunks are merged
+# by reciprocal rank fusion, de-duplicated and packed into a token budget.
+######
+from ascii_colors import ASCIIColors, trace_exception
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Callable, List, Tuple
+import time
+import re
+
+
+class RetrievalSource:
+    """
+    A store that can be queried by the federated retriever.
+
+    Args:
+        name (str): Name of the source, shown in the chunks and in the logs.
+        query (Callable): query(text, top_k) -> list of chunks (dictionaries with at least chunk_text and similarity,
+            as returned by SafeStore.query).
+        timeout (float, optional): Seconds allowed to this source. Defaults to the timeout of the retriever.
+    """
+    def __init__(self, name:str, query:Callable, timeout:float=None):
+        self.name       = name
+        self.query      = query
+        self.timeout    = timeout
+
+
+class FederatedRetriever:
+    """
+    Queries several sources concurrently and merges their chunks.
+
+    Similarities of different stores (and vectorizers) are not comparable, so the chunks are merged by reciprocal
+    rank fusion: each chunk scores sum(1/(rrf_k + rank)) over the rankings of the sources it appears in.
+    The absolute min_similarity floor is applied to every source before ranking, so a source with only weak
+    matches brings nothing instead of having its best chunk ranked with the best chunks of the other sources.
+    Chunks with the same text (ignoring case and spaces) are kept once. Equal scores are ordered by raw similarity.
+
+    Args:
+        count_tokens (Callable): count_tokens(text) -> int.
+        timeout (float, optional): Default number of seconds allowed to each source. Defaults to 2.
+        min_similarity (float, optional): Chunks under this raw similarity are ignored. Defaults to 0.
+        rrf_k (int, optional): Reciprocal rank fusion constant, higher values flatten the rank differences. Defaults to 60.
+    """
+    def __init__(self, count_tokens:Callable, timeout:float=2, min_similarity:float=0, rrf_k:int=60):
+        self.count_tokens   = count_tokens
+        self.timeout        = timeout
+        self.min_similarity = min_similarity
+        self.rrf_k          = rrf_k
+
+    def _query_all(self, sources:List[RetrievalSource], text:str, top_k:int) -> List[Tuple[RetrievalSource, list]]:
+        """
+        Runs the queries of all the sources at the same time. Sources that fail or time out return no chunks.
+        """
+        if len(sources) == 0:
+            return []
+        executor = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix="retrieval")
+        try:
+            start = time.monotonic()
+            futures = [(source, executor.submit(source.query, text, top_k)) for source in sources]
+            results = []
+            for source, future in futures:
+                timeout = source.timeout if source.timeout is not None else self.timeout
+                try:
+                    results.append((source, future.result(timeout=max(0, start + timeout - time.monotonic()))))
+                except TimeoutError:
+                    ASCIIColors.warning(f"RAG source {source.name} did not answer within {timeout}s, ignoring it")
+                except Exception as ex:
+                    trace_exception(ex)
+                    ASCIIColors.error(f"Couldn't recover information from {source.name}")
+            return results
+        finally:
+            # sources that timed out finish in the background
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _text_key(text:str) -> str:
+        return re.sub(r"\s+", " ", text).strip().lower()
+
+    def retrieve(self, sources:List[RetrievalSource], text:str, top_k:int, max_tokens:int=None) -> List[dict]:
+        """
+        Returns the best chunks of all the sources.
+
+        Args:
+            sources (List[RetrievalSource]): The sources to query.
+            text (str): The query.
+            top_k (int): Number of chunks requested from each source.
+            max_tokens (int, optional): Token budget of the returned chunks. The best chunks are kept until it is full.
+
+        Returns:
+            list: dictionaries with the source, title, chunk_text, similarity (raw) and score (fused) of the chunks, best first.
+        """
+        merged = {}
+        for source, chunks in self._query_all(sources, text, top_k):
+            chunks = [chunk for chunk in chunks if chunk["similarity"] >= self.min_similarity and chunk["chunk_text"]]
+            chunks.sort(key=lambda chunk: chunk["similarity"], reverse=True)
+            for rank, chunk in enumerate(chunks):
+                key = FederatedRetriever._text_key(chunk["chunk_text"])
+                score = 1/(self.rrf_k + rank + 1)
+                known = merged.get(key)
+                if known is not None:
+                    known["score"] += score
+                    if chunk["similarity"] <= known["similarity"]:
+                        continue
+                    score = known["score"]
+                metadata = chunk.get("metadata") or {}
+                merged[key] = {
+                    "source": source.name,
+                    "title": metadata.get("title") or str(chunk.get("file_path", "")),
+                    "chunk_text": chunk["chunk_text"],
+                    "similarity": chunk["similarity"],
+                    "score": score
+                }
+
+        ranked = sorted(merged.values(), key=lambda entry: (entry["score"], entry["similarity"]), reverse=True)
+        if max_tokens is None:
+            return ranked
+        packed = []
+        used = 0
+        for entry in ranked:
+            n_tokens = self.count_tokens(entry["chunk_text"])
+            if used + n_tokens > max_tokens:
+                continue
+            packed.append(entry)
+            used += n_tokens
+        return packed
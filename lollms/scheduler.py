@@ -0,0 +1,385 @@
+######
+# Project       : lollms
+# File          : scheduler.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Admission queue placed in front of the binding generation.
+# Every generation (socket.io chat, REST API, personality workflows) gets a request id,
+# waits in a bounded priority queue, and is served fairly between the request sources.
+# Each request can be cancelled individually.
+######
+from contextlib import contextmanager
+from collections import deque
+from typing import Callable, Dict, List
+import itertools
+import threading
+import heapq
+import time
+import uuid
+
+
+class GenerationQueueFull(Exception):
+    """Raised when the generation queue cannot accept more requests."""
+    pass
+
+
+class GenerationRequest:
+    """
+    A generation request waiting for, or holding, a generation slot.
+    """
+    def __init__(self, source:str="api", client_id:str=None, priority:int=0):
+        self.id             = uuid.uuid4().hex
+        self.source         = source
+        self.client_id      = client_id
+        self.priority       = priority
+        self.status         = "queued" # queued, running, done, failed, cancelled
+        self.created_at     = time.monotonic()
+        self.started_at     = None
+        self.finished_at    = None
+        self.executing      = False
+        self._cancelled     = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @property
+    def wait_time(self) -> float:
+        return (self.started_at if self.started_at is not None else time.monotonic()) - self.created_at
+
+    def cancel(self):
+        """
+        Cancels the request. A queued request never starts, a running one is stopped at its next chunk.
+        """
+        self._cancelled.set()
+
+    def wrap_callback(self, callback:Callable=None) -> Callable:
+        """
+        Returns a binding callback that stops the generation once the request is cancelled.
+        """
+        def wrapped(chunk, *args, **kwargs):
+            if self._cancelled.is_set():
+                return False
+            if callback is None:
+                return True
+            return callback(chunk, *args, **kwargs)
+        return wrapped
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "source": self.source,
+            "client_id": self.client_id,
+            "priority": self.priority,
+            "status": self.status,
+            "wait_time": self.wait_time
+        }
+
+
+class GenerationScheduler:
+    """
+    Bounded admission queue in front of LLMBinding.generate.
+
+    Requests are grouped by source ("socket" for interactive users, "api" for REST callers, ...).
+    When a slot frees up, sources are served in round robin so that a burst on one source cannot starve
+    the others, and inside a source the highest priority (then the oldest) request goes first.
+    Generations started from a thread that already holds a slot (personality workflows calling the model
+    several times) are considered part of the running request and do not queue again.
+    """
+    def __init__(self, max_queue_size:int=64, max_parallel:int=1):
+        self.max_queue_size = max_queue_size
+        self.max_parallel   = max_parallel
+
+        self._cond          = threading.Condition()
+        self._queues:Dict[str, List] = {}
+        self._sources       = deque()
+        self._running:Dict[str, GenerationRequest] = {}
+        self._queued:Dict[str, GenerationRequest] = {}
+        self._seq           = itertools.count()
+        self._local         = threading.local()
+
+        self._stats         = {}
+
+    # ---------------------------------------- Context ----------------------------------------
+    @contextmanager
+    def context(self, source:str, client_id:str=None):
+        """
+        Sets the default source and client of the generations started from the current thread.
+        """
+        previous = getattr(self._local, "context", None)
+        self._local.context = (source, client_id)
+        try:
+            yield
+        finally:
+            self._local.context = previous
+
+    def in_context(self, fn:Callable, source:str, client_id:str=None) -> Callable:
+        """
+        Wraps fn so that it runs with the given scheduler context (useful with run_in_executor).
+        """
+        def wrapped(*args, **kwargs):
+            with self.context(source, client_id):
+                return fn(*args, **kwargs)
+        return wrapped
+
+    def bind_to_current_request(self, fn:Callable) -> Callable:
+        """
+        Wraps fn so that the generations it starts from another thread (a worker pool for example)
+        are part of the request held by the calling thread instead of queuing behind it.
+        """
+        request = getattr(self._local, "request", None)
+        def wrapped(*args, **kwargs):
+            previous = getattr(self._local, "request", None)
+            self._local.request = request
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._local.request = previous
+        return wrapped
+
+    # ---------------------------------------- Queue ----------------------------------------
+    def _source_stats(self, source) -> dict:
+        if source not in self._stats:
+            self._stats[source] = {"admitted":0, "served":0, "failed":0, "cancelled":0, "rejected":0, "total_wait":0.0, "max_wait":0.0}
+        return self._stats[source]
+
+    def queue_depth(self) -> int:
+        return len(self._queued)
+
+    def submit(self, source:str=None, client_id:str=None, priority:int=0) -> GenerationRequest:
+        """
+        Registers a new request in the queue.
+
+        Raises:
+            GenerationQueueFull: if max_queue_size requests are already waiting.
+        """
+        context = getattr(self._local, "context", None)
+        if source is None:
+            source = context[0] if context else "api"
+        if client_id is None and context:
+            client_id = context[1]
+        return self.enqueue(GenerationRequest(source, client_id, priority))
+
+    def is_full(self) -> bool:
+        return len(self._queued) >= self.max_queue_size
+
+    def enqueue(self, request:GenerationRequest) -> GenerationRequest:
+        """
+        Puts an already built request in the queue.
+
+        Raises:
+            GenerationQueueFull: if max_queue_size requests are already waiting.
+        """
+        with self._cond:
+            if len(self._queued) >= self.max_queue_size:
+                self._source_stats(request.source)["rejected"] += 1
+                raise GenerationQueueFull(f"Generation queue is full ({self.max_queue_size} requests waiting)")
+            if request.source not in self._queues:
+                self._queues[request.source] = []
+                self._sources.append(request.source)
+            heapq.heappush(self._queues[request.source], (-request.priority, next(self._seq), request))
+            self._queued[request.id] = request
+            self._admit()
+        return request
+
+    def _admit(self):
+        # Must be called with the condition held
+        while len(self._running) < self.max_parallel and len(self._queued) > 0:
+            for i, source in enumerate(self._sources):
+                heap = self._queues[source]
+                while len(heap) > 0 and heap[0][2].id not in self._queued:
+                    heapq.heappop(heap)
+                if len(heap) > 0:
+                    _, _, request = heapq.heappop(heap)
+                    # the served source goes to the end of the round
+                    self._sources.rotate(-(i + 1))
+                    del self._queued[request.id]
+                    if request.cancelled:
+                        self._finish(request, "cancelled")
+                    else:
+                        request.status = "running"
+                        request.started_at = time.monotonic()
+                        self._running[request.id] = request
+                        stats = self._source_stats(request.source)
+                        stats["admitted"] += 1
+                        stats["total_wait"] += request.wait_time
+                        stats["max_wait"] = max(stats["max_wait"], request.wait_time)
+                    break
+            else:
+                break
+        self._cond.notify_all()
+
+    def _finish(self, request:GenerationRequest, status:str):
+        # Must be called with the condition held
+        request.status = status
+        request.finished_at = time.monotonic()
+        self._running.pop(request.id, None)
+        self._queued.pop(request.id, None)
+        self._source_stats(request.source)["served" if status=="done" else status] += 1
+
+    def _wait_admission(self, request:GenerationRequest) -> bool:
+        """
+        Waits until the request holds a slot. Returns False if it was cancelled or released before.
+        The request is queued first if it was built but not submitted yet.
+        """
+        with self._cond:
+            never_queued = request.status == "queued" and request.id not in self._queued
+        if never_queued:
+            self.enqueue(request)
+        with self._cond:
+            while request.status == "queued":
+                if request.cancelled:
+                    self._finish(request, "cancelled")
+                    self._admit()
+                    break
+                self._cond.wait(0.5)
+            if request.status != "running":
+                return False
+            request.executing = True
+            return True
+
+    def _release(self, request:GenerationRequest, failed:bool):
+        self._local.request = None
+        with self._cond:
+            self._finish(request, "failed" if failed else "cancelled" if request.cancelled else "done")
+            self._admit()
+
+    def execute(self, request:GenerationRequest, fn:Callable, *args, callback:Callable=None, **kwargs):
+        """
+        Waits until the request is admitted then runs fn(*args, callback=..., **kwargs) in the current thread.
+        Returns an empty string if the request was cancelled before starting.
+        The request is queued first if it was built but not submitted yet.
+        """
+        if not self._wait_admission(request):
+            return ""
+        self._local.request = request
+        failed = False
+        try:
+            return fn(*args, callback=request.wrap_callback(callback), **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._release(request, failed)
+
+    def release(self, request:GenerationRequest):
+        """
+        Gives back the place (or the slot) of a submitted request that will never be executed,
+        for example a streamed response closed before its generation started.
+        Does nothing if the request is executing or finished.
+        """
+        with self._cond:
+            if request.executing or request.status not in ["queued", "running"]:
+                return
+            self._finish(request, "cancelled")
+            self._admit()
+
+    def run(self, fn:Callable, *args, callback:Callable=None, source:str=None, client_id:str=None, priority:int=0, **kwargs):
+        """
+        Queues a generation and runs fn(*args, callback=callback, **kwargs) once it is admitted.
+        """
+        current = getattr(self._local, "request", None)
+        if current is not None:
+            # Nested generation: part of the request already holding the slot
+            return fn(*args, callback=current.wrap_callback(callback), **kwargs)
+        request = self.submit(source, client_id, priority)
+        return self.execute(request, fn, *args, callback=callback, **kwargs)
+
+    @contextmanager
+    def hold(self, source:str=None, client_id:str=None, priority:int=0):
+        """
+        Holds a single generation slot for the whole block (a chat turn and the workflow behind it):
+        the generations started inside the block don't queue again.
+        Yields the request, or None if it was cancelled before being admitted.
+
+        Raises:
+            GenerationQueueFull: if max_queue_size requests are already waiting.
+        """
+        current = getattr(self._local, "request", None)
+        if current is not None:
+            yield current
+            return
+        request = self.submit(source, client_id, priority)
+        if not self._wait_admission(request):
+            yield None
+            return
+        self._local.request = request
+        failed = False
+        try:
+            yield request
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._release(request, failed)
+
+    def in_request(self, fn:Callable, source:str, client_id:str=None) -> Callable:
+        """
+        Wraps fn so that it runs with the given scheduler context while holding a single generation slot.
+        fn is not called (and None is returned) if the request is cancelled before being admitted.
+        """
+        def wrapped(*args, **kwargs):
+            with self.context(source, client_id):
+                with self.hold() as request:
+                    if request is None:
+                        return None
+                    return fn(*args, **kwargs)
+        return wrapped
+
+    # ---------------------------------------- Cancellation ----------------------------------------
+    def _cancel(self, requests:List[GenerationRequest]) -> int:
+        for request in requests:
+            request.cancel()
+        with self._cond:
+            self._cond.notify_all()
+        return len(requests)
+
+    def cancel(self, request_id:str) -> bool:
+        """
+        Cancels a single request.
+        """
+        with self._cond:
+            request = self._running.get(request_id) or self._queued.get(request_id)
+        if request is None:
+            return False
+        self._cancel([request])
+        return True
+
+    def cancel_client(self, client_id:str) -> int:
+        """
+        Cancels every queued or running request of a client. Returns the number of cancelled requests.
+        """
+        with self._cond:
+            requests = [r for r in list(self._running.values())+list(self._queued.values()) if r.client_id == client_id]
+        return self._cancel(requests)
+
+    def cancel_source(self, source:str) -> int:
+        """
+        Cancels every queued or running request of a source. Returns the number of cancelled requests.
+        """
+        with self._cond:
+            requests = [r for r in list(self._running.values())+list(self._queued.values()) if r.source == source]
+        return self._cancel(requests)
+
+    # ---------------------------------------- Metrics ----------------------------------------
+    def get_stats(self) -> dict:
+        """
+        Returns the queue depth, the running and waiting requests and the per source wait time metrics.
+        """
+        with self._cond:
+            sources = {}
+            for source, stats in self._stats.items():
+                sources[source] = {
+                    **stats,
+                    "queued": len([r for r in self._queued.values() if r.source == source]),
+                    "average_wait": stats["total_wait"]/stats["admitted"] if stats["admitted"] > 0 else 0.0
+                }
+            return {
+                "queue_depth": len(self._queued),
+                "max_queue_size": self.max_queue_size,
+                "max_parallel": self.max_parallel,
+                "running": [r.to_dict() for r in self._running.values()],
+                "queued": [r.to_dict() for r in self._queued.values()],
+                "sources": sources
+            }
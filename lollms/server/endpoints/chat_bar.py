@@ -164,6 +164,7 @@ async def add_webpage(request: AddWebPageRequest):
             client.discussion.add_file(
                 file_path,
                 client,
+                lollmsElfServer.tasks_library,
                 partial(lollmsElfServer.process_data, client_id=request.client_id),
             )
             # File saved successfully
@@ -573,6 +573,8 @@ async def open_custom_function_calls_folder(request: ClientAuthentication):
         # Create a temporary file.
         root_folder = lollmsElfServer.lollms_paths.custom_function_calls_path
         root_folder.mkdir(parents=True, exist_ok=True)
+        # the user is about to edit the custom functions
+        lollmsElfServer.function_calls_catalog.invalidate()
         if platform.system() == "Windows":
             subprocess.Popen(f'explorer "{root_folder}"')
         elif platform.system() == "Linux":
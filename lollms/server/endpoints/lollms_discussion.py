@@ -16,7 +16,7 @@ from lollms.utilities import detect_antiprompt, remove_text_from_string, trace_e
 from lollms.security import sanitize_path, check_access
 from ascii_colors import ASCIIColors
 from lollms.databases.discussions_database import DiscussionsDB, Discussion
-from typing import List
+from typing import List, Optional
 import shutil
 import tqdm
 from pathlib import Path
@@ -68,6 +68,8 @@ def select_database(data:DatabaseSelectionParameters):
 
     print(f'Selecting database {data.name}')
     # Create database object
+    if getattr(lollmsElfServer, "db", None) is not None:
+        lollmsElfServer.db.close()
     lollmsElfServer.db = DiscussionsDB(lollmsElfServer, lollmsElfServer.lollms_paths, data.name)
     ASCIIColors.info("Checking discussions database... ",end="")
     lollmsElfServer.db.create_tables()
@@ -166,6 +168,34 @@ async def delete_discussion(discussion: DiscussionDelete):
         lollmsElfServer.error(ex)
         return {"status":False,"error":str(ex)}
     
+
+# ----------------------------- messages --------------------
+class DiscussionMessagesPage(BaseModel):
+    client_id: str
+    id: int
+    before_id: Optional[int] = None
+    limit: int = 50
+    include_ui: bool = True
+
+@router.post("/get_discussion_messages_page")
+def get_discussion_messages_page(page: DiscussionMessagesPage):
+    """
+    Returns a page of messages of a discussion, from the newest to the oldest.
+    Pass the returned next_cursor as before_id to get the previous page (null when there are no older messages).
+    """
+    client = check_access(lollmsElfServer, page.client_id)
+    try:
+        if client.discussion is not None and client.discussion.discussion_id == page.id:
+            discussion = client.discussion
+        else:
+            discussion = Discussion(lollmsElfServer, page.id, lollmsElfServer.db)
+        messages, next_cursor = discussion.get_messages_page(page.before_id, max(1, min(page.limit, 500)), page.include_ui)
+        return {"status":True, "messages":[m.to_json() for m in messages], "next_cursor":next_cursor}
+    except Exception as ex:
+        trace_exception(ex)
+        lollmsElfServer.error(ex)
+        return {"status":False,"error":str(ex)}
+
     
 # ----------------------------- import/export --------------------
 class DiscussionExport(BaseModel):
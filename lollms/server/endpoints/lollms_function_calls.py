@@ -12,14 +12,12 @@ from pydantic import BaseModel, Field
 import pkg_resources
 from lollms.server.elf_server import LOLLMSElfServer
 from lollms.binding import BindingBuilder, InstallOption
-from ascii_colors import ASCIIColors
 from lollms.utilities import load_config, trace_exception, gc
 from lollms.security import sanitize_path_from_endpoint, sanitize_path, check_access
 from lollms.security import check_access
 from pathlib import Path
-from typing import List, Any
+from typing import List, Any, Optional
 import json
-import yaml
 # ----------------------------------- Personal files -----------------------------------------
 
 class ClientAuthentication(BaseModel):
@@ -40,79 +38,29 @@ lollmsElfServer = LOLLMSElfServer.get_instance()
 
 # ----------------------------------- Endpoints -----------------------------------------
 
-from datetime import datetime
 from pathlib import Path
 
 @router.get("/list_function_calls")
-async def list_function_calls():
-    """List all available function calls in the functions zoo and custom functions zoo"""
-    functions_zoo_path = lollmsElfServer.lollms_paths.functions_zoo_path
-    custom_function_calls_path = lollmsElfServer.lollms_paths.custom_function_calls_path
-    function_calls = []
-    
-    # Helper function to process a directory and append function calls
-    def process_directory(directory, category_name):
-        for fn_dir in directory.iterdir():
-            if fn_dir.is_dir():
-                yaml_file = fn_dir / "config.yaml"
-                py_file = fn_dir / "function.py"
-                
-                if yaml_file.exists() and py_file.exists():
-                    try:
-                        with open(yaml_file, "r") as f:
-                            config = yaml.safe_load(f)
-                            
-                            # Ensure creation_date_time and last_update_date_time exist
-                            if "creation_date_time" not in config:
-                                config["creation_date_time"] = datetime.now().isoformat()
-                            if "last_update_date_time" not in config:
-                                config["last_update_date_time"] = datetime.now().isoformat()
-                            
-                            # Save the updated YAML file if changes were made
-                            with open(yaml_file, "w") as f:
-                                yaml.safe_dump(config, f)
-                            
-                            # Check if the function is mounted
-                            mounted = False
-                            selected = False
-                            try:
-                                for mounted_function in lollmsElfServer.config.mounted_function_calls:
-                                    if mounted_function["name"] == config.get("name", fn_dir.name):
-                                        mounted = True
-                                        selected = mounted_function.get("selected", False)
-                                        break
-                            except:
-                                pass
-                            function_info = {
-                                "name": config.get("function_name", fn_dir.name),
-                                "category":  config.get("name", fn_dir.parent.name),
-                                "description": config.get("description", ""),
-                                "parameters": config.get("parameters", {}),
-                                "returns": config.get("returns", {}),
-                                "examples": config.get("examples", []),
-                                "author": config.get("author", "Unknown"),
-                                "version": config.get("version", "1.0.0"),
-                                "category": category_name,
-                                "creation_date_time": config.get("creation_date_time"),
-                                "last_update_date_time": config.get("last_update_date_time"),
-                                "mounted": mounted,
-                                "selected": selected
-                            }
-                            function_calls.append(function_info)
-                    except Exception as e:
-                        trace_exception(e)
-                        ASCIIColors.error(f"Error loading function {fn_dir.name}: {e}")
-    
-    # Process the main functions zoo
-    for category_dir in functions_zoo_path.iterdir():
-        if category_dir.is_dir():
-            process_directory(category_dir, category_dir.name)
-    
-    # Process the custom functions zoo under the "custom" category
-    if custom_function_calls_path.exists():
-        process_directory(custom_function_calls_path, "custom")
-    
-    return {"function_calls": function_calls}
+async def list_function_calls(category:Optional[str]=None, search:Optional[str]=None, mounted:Optional[bool]=None, offset:int=0, limit:Optional[int]=None):
+    """
+    List the function calls available in the functions zoo and custom functions zoo ("custom" category).
+    Served from the function calls catalog (the zoo is only read when it changed).
+
+    :param category: Only list the functions of this category.
+    :param search: Only list the functions whose name or description contains this text.
+    :param mounted: Only list the mounted (true) or not mounted (false) functions.
+    :param offset: Index of the first function to return.
+    :param limit: Maximum number of functions to return.
+    :return: The page of function calls and the total number of functions matching the filters.
+    """
+    return lollmsElfServer.function_calls_catalog.query(
+                                                        lollmsElfServer.config.mounted_function_calls,
+                                                        category=category,
+                                                        search=search,
+                                                        mounted=mounted,
+                                                        offset=max(0, offset),
+                                                        limit=limit
+                                                    )
 
 @router.get("/list_mounted_function_calls")
 async def list_mounted_function_calls():
@@ -263,6 +211,9 @@ async def set_function_call_settings(request: Request):
                         fci["class"].static_parameters.update_template(settings)
                         fci["class"].static_parameters.config.save_config()
                         fci["class"].settings_updated()
+                        # the instances of the other clients reload the saved settings
+                        lollmsElfServer.function_calls_registry.invalidate(entry["dir"])
+                        lollmsElfServer.function_calls_catalog.invalidate()
                         return {'status':True}
                     else:
                         return {'status':False}
@@ -13,13 +13,14 @@ from fastapi.responses import PlainTextResponse
 from lollms.server.elf_server import LOLLMSElfServer
 from pydantic import BaseModel, ConfigDict
 from starlette.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from lollms.types import MSG_OPERATION_TYPE
-from lollms.utilities import detect_antiprompt, remove_text_from_string, trace_exception
-from lollms.generation import RECEPTION_MANAGER, ROLE_CHANGE_DECISION, ROLE_CHANGE_OURTPUT
+from lollms.utilities import remove_text_from_string, trace_exception
+from lollms.generation import RECEPTION_MANAGER, ROLE_CHANGE_DECISION, ROLE_CHANGE_OURTPUT, StreamBridge, StopSequenceMatcher
 from ascii_colors import ASCIIColors
 import time
 import re
-import threading
+import asyncio
 from typing import List, Optional, Union
 import random
 import string
@@ -46,6 +47,22 @@ elf_server = LOLLMSElfServer.get_instance()
 def get_generation_status():
     return {"status":elf_server.busy}
 
+@router.get("/get_generation_queue_status")
+def get_generation_queue_status():
+    """
+    Returns the generation queue depth, the running and waiting requests and the wait time metrics per source.
+    """
+    return elf_server.scheduler.get_stats()
+
+@router.get("/get_tokenization_cache_stats")
+def get_tokenization_cache_stats():
+    """
+    Returns the size and the hit/miss counters of the tokenization cache of the active binding.
+    """
+    if elf_server.binding is None or not hasattr(elf_server.binding, "tokenization_cache"):
+        return {"status":False, "error":"No binding loaded"}
+    return elf_server.binding.tokenization_cache.get_stats()
+
 
 # ----------------------------------- Generation -----------------------------------------
 class LollmsTokenizeRequest(BaseModel):
@@ -141,13 +158,12 @@ async def lollms_generate(request: LollmsGenerateRequest):
         stream = request.stream
         if elf_server.binding is not None:
             if stream:
-                new_output={"new_values":[]}
+                # The request takes its place in the queue before the response starts, so a full queue is reported to the caller
+                gen_request = elf_server.scheduler.submit("api")
                 async def generate_chunks():
-                    lk = threading.Lock()
+                    bridge = StreamBridge(on_cancel=gen_request.cancel)
 
                     def callback(chunk, chunk_type:MSG_OPERATION_TYPE=MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
-                        if elf_server.cancel_gen:
-                            return False
                         
                         if chunk is None:
                             return
@@ -161,22 +177,16 @@ async def lollms_generate(request: LollmsGenerateRequest):
                             else:
                                 chunk = chunk + rx.value
 
-                        # Yield each chunk of data
-                        lk.acquire()
-                        try:
-                            new_output["new_values"].append(reception_manager.chunk)
-                            lk.release()
-                            return True
-                        except Exception as ex:
-                            trace_exception(ex)
-                            lk.release()
-                            return False
+                        # Send the chunk to the consumer (waits if the client is too slow)
+                        return bridge.put(reception_manager.chunk)
                         
                     def chunks_builder():
                         if request.model_name in elf_server.binding.list_models() and elf_server.binding.model_name!=request.model_name:
                             elf_server.binding.build_model(request.model_name)    
 
-                        elf_server.binding.generate(
+                        elf_server.scheduler.execute(
+                                                gen_request,
+                                                elf_server.binding.generate,
                                                 prompt, 
                                                 n_predict, 
                                                 callback=callback, 
@@ -187,27 +197,20 @@ async def lollms_generate(request: LollmsGenerateRequest):
                                                 repeat_last_n=request.repeat_last_n or elf_server.config.repeat_last_n,
                                             )
                         reception_manager.done = True
-                    thread = threading.Thread(target=chunks_builder)
-                    thread.start()
+                    bridge.run_in_thread(chunks_builder)
                     current_index = 0
-                    while (not reception_manager.done and elf_server.cancel_gen == False):
-                        while (not reception_manager.done and len(new_output["new_values"])==0):
-                            time.sleep(0.001)
-                        lk.acquire()
-                        for i in range(len(new_output["new_values"])):
-                            current_index += 1                        
-                            yield (new_output["new_values"][i])
-                        new_output["new_values"]=[]
-                        lk.release()
-                    elf_server.cancel_gen = False         
-                return StreamingResponse(generate_chunks(), media_type="text/plain", headers=headers)
+                    async for chunk in bridge.chunks():
+                        current_index += 1
+                        yield chunk
+                return StreamingResponse(generate_chunks(), media_type="text/plain", headers={**headers, "X-Lollms-Request-Id":gen_request.id}, background=BackgroundTask(elf_server.scheduler.release, gen_request))
             else:
+                matcher = elf_server.personality.stop_sequence_matcher()
                 def callback(chunk, chunk_type:MSG_OPERATION_TYPE=MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
                     # Yield each chunk of data
                     if chunk is None:
                         return True
                     reception_manager.reception_buffer += chunk
-                    antiprompt = elf_server.personality.detect_antiprompt(reception_manager.reception_buffer)
+                    antiprompt = matcher.feed(chunk)
                     if antiprompt:
                         ASCIIColors.warning(f"\n{antiprompt} detected. Stopping generation")
                         reception_manager.reception_buffer = elf_server.remove_text_from_string(reception_manager.reception_buffer,antiprompt)
@@ -216,7 +219,9 @@ async def lollms_generate(request: LollmsGenerateRequest):
 
                     return True
                 
-                elf_server.binding.generate(
+                await asyncio.to_thread(
+                                                elf_server.scheduler.run,
+                                                elf_server.binding.generate,
                                                 prompt, 
                                                 n_predict, 
                                                 callback=callback,
@@ -331,13 +336,12 @@ async def lollms_generate_with_images(request: LollmsGenerateRequest):
                     image_file.write(base64.b64decode(padded_image))
                 image_files.append(image_path)            
             if stream:
-                new_output={"new_values":[]}
+                # The request takes its place in the queue before the response starts, so a full queue is reported to the caller
+                gen_request = elf_server.scheduler.submit("api")
                 async def generate_chunks():
-                    lk = threading.Lock()
+                    bridge = StreamBridge(on_cancel=gen_request.cancel)
 
                     def callback(chunk, chunk_type:MSG_OPERATION_TYPE=MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
-                        if elf_server.cancel_gen:
-                            return False
                         
                         if chunk is None:
                             return
@@ -351,22 +355,16 @@ async def lollms_generate_with_images(request: LollmsGenerateRequest):
                             else:
                                 chunk = chunk + rx.value
 
-                        # Yield each chunk of data
-                        lk.acquire()
-                        try:
-                            new_output["new_values"].append(reception_manager.chunk)
-                            lk.release()
-                            return True
-                        except Exception as ex:
-                            trace_exception(ex)
-                            lk.release()
-                            return False
+                        # Send the chunk to the consumer (waits if the client is too slow)
+                        return bridge.put(reception_manager.chunk)
                         
                     def chunks_builder():
                         if request.model_name in elf_server.binding.list_models() and elf_server.binding.model_name!=request.model_name:
                             elf_server.binding.build_model(request.model_name)    
 
-                        elf_server.binding.generate_with_images(
+                        elf_server.scheduler.execute(
+                                                gen_request,
+                                                elf_server.binding.generate_with_images,
                                                 prompt,
                                                 image_files,
                                                 n_predict, 
@@ -374,20 +372,12 @@ async def lollms_generate_with_images(request: LollmsGenerateRequest):
                                                 temperature=request.temperature or elf_server.config.temperature
                                             )
                         reception_manager.done = True
-                    thread = threading.Thread(target=chunks_builder)
-                    thread.start()
+                    bridge.run_in_thread(chunks_builder)
                     current_index = 0
-                    while (not reception_manager.done and elf_server.cancel_gen == False):
-                        while (not reception_manager.done and len(new_output["new_values"])==0):
-                            time.sleep(0.001)
-                        lk.acquire()
-                        for i in range(len(new_output["new_values"])):
-                            current_index += 1                        
-                            yield (new_output["new_values"][i])
-                        new_output["new_values"]=[]
-                        lk.release()
-                    elf_server.cancel_gen = False         
-                return StreamingResponse(generate_chunks(), media_type="text/plain", headers=headers)
+                    async for chunk in bridge.chunks():
+                        current_index += 1
+                        yield chunk
+                return StreamingResponse(generate_chunks(), media_type="text/plain", headers={**headers, "X-Lollms-Request-Id":gen_request.id}, background=BackgroundTask(elf_server.scheduler.release, gen_request))
             else:
                 def callback(chunk, chunk_type:MSG_OPERATION_TYPE=MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
                     # Yield each chunk of data
@@ -405,7 +395,9 @@ async def lollms_generate_with_images(request: LollmsGenerateRequest):
 
 
                     return True
-                elf_server.binding.generate_with_images(
+                await asyncio.to_thread(
+                                                elf_server.scheduler.run,
+                                                elf_server.binding.generate_with_images,
                                                 prompt,
                                                 image_files,
                                                 n_predict, 
@@ -535,13 +527,12 @@ async def v1_chat_completions(request: ChatGenerationRequest):
         prompt_tokens = len(elf_server.binding.tokenize(prompt))
         if elf_server.binding is not None:
             if stream:
-                new_output={"new_values":[]}
+                # The request takes its place in the queue before the response starts, so a full queue is reported to the caller
+                gen_request = elf_server.scheduler.submit("api")
                 async def generate_chunks():
-                    lk = threading.Lock()
+                    bridge = StreamBridge(on_cancel=gen_request.cancel)
 
                     def callback(chunk, chunk_type:MSG_OPERATION_TYPE=MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
-                        if elf_server.cancel_gen:
-                            return False
                         
                         if chunk is None:
                             return
@@ -555,47 +546,33 @@ async def v1_chat_completions(request: ChatGenerationRequest):
                             else:
                                 chunk = chunk + rx.value
 
-                        # Yield each chunk of data
-                        lk.acquire()
-                        try:
-                            new_output["new_values"].append(reception_manager.chunk)
-                            lk.release()
-                            return True
-                        except Exception as ex:
-                            trace_exception(ex)
-                            lk.release()
-                            return False
+                        # Send the chunk to the consumer (waits if the client is too slow)
+                        return bridge.put(reception_manager.chunk)
                         
                     def chunks_builder():
-                        elf_server.binding.generate(
+                        elf_server.scheduler.execute(
+                                                gen_request,
+                                                elf_server.binding.generate,
                                                 prompt, 
                                                 n_predict, 
                                                 callback=callback, 
                                                 temperature=temperature
                                             )
                         reception_manager.done = True
-                    thread = threading.Thread(target=chunks_builder)
-                    thread.start()
+                    bridge.run_in_thread(chunks_builder)
                     current_index = 0
-                    while (not reception_manager.done and elf_server.cancel_gen == False):
-                        while (not reception_manager.done and len(new_output["new_values"])==0):
-                            time.sleep(0.001)
-                        lk.acquire()
-                        for i in range(len(new_output["new_values"])):
-                            output_val = StreamingModelResponse(
-                                id = _generate_id(), 
-                                choices = [StreamingChoices(index= current_index, delta=Delta(content=new_output["new_values"][i]))], 
-                                created=int(time.time()),
-                                model=elf_server.config.model_name,
-                                object="chat.completion.chunk",
-                                usage=Usage(prompt_tokens= prompt_tokens, completion_tokens= 1)
-                                )
-                            current_index += 1                        
-                            yield (output_val.json() + '\n')
-                        new_output["new_values"]=[]
-                        lk.release()
-                    elf_server.cancel_gen = False         
-                return StreamingResponse(generate_chunks(), media_type="application/json")
+                    async for chunk in bridge.chunks():
+                        output_val = StreamingModelResponse(
+                            id = _generate_id(), 
+                            choices = [StreamingChoices(index= current_index, delta=Delta(content=chunk))], 
+                            created=int(time.time()),
+                            model=elf_server.config.model_name,
+                            object="chat.completion.chunk",
+                            usage=Usage(prompt_tokens= prompt_tokens, completion_tokens= 1)
+                            )
+                        current_index += 1
+                        yield (output_val.json() + '\n')
+                return StreamingResponse(generate_chunks(), media_type="application/json", headers={"X-Lollms-Request-Id":gen_request.id}, background=BackgroundTask(elf_server.scheduler.release, gen_request))
             else:
                 def callback(chunk, chunk_type:MSG_OPERATION_TYPE=MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
                     # Yield each chunk of data
@@ -613,7 +590,9 @@ async def v1_chat_completions(request: ChatGenerationRequest):
 
 
                     return True
-                elf_server.binding.generate(
+                await asyncio.to_thread(
+                                                elf_server.scheduler.run,
+                                                elf_server.binding.generate,
                                                 prompt, 
                                                 n_predict, 
                                                 callback=callback,
@@ -677,13 +656,12 @@ async def ollama_chat_completion(request: ChatGenerationRequest):
         prompt_tokens = len(elf_server.binding.tokenize(prompt))
         if elf_server.binding is not None:
             if stream:
-                new_output={"new_values":[]}
+                # The request takes its place in the queue before the response starts, so a full queue is reported to the caller
+                gen_request = elf_server.scheduler.submit("api")
                 async def generate_chunks():
-                    lk = threading.Lock()
+                    bridge = StreamBridge(on_cancel=gen_request.cancel)
 
                     def callback(chunk, chunk_type:MSG_OPERATION_TYPE=MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
-                        if elf_server.cancel_gen:
-                            return False
                         
                         if chunk is None:
                             return
@@ -697,47 +675,33 @@ async def ollama_chat_completion(request: ChatGenerationRequest):
                             else:
                                 chunk = chunk + rx.value
 
-                        # Yield each chunk of data
-                        lk.acquire()
-                        try:
-                            new_output["new_values"].append(reception_manager.chunk)
-                            lk.release()
-                            return True
-                        except Exception as ex:
-                            trace_exception(ex)
-                            lk.release()
-                            return False
+                        # Send the chunk to the consumer (waits if the client is too slow)
+                        return bridge.put(reception_manager.chunk)
                         
                     def chunks_builder():
-                        elf_server.binding.generate(
+                        elf_server.scheduler.execute(
+                                                gen_request,
+                                                elf_server.binding.generate,
                                                 prompt, 
                                                 n_predict, 
                                                 callback=callback, 
                                                 temperature=temperature
                                             )
                         reception_manager.done = True
-                    thread = threading.Thread(target=chunks_builder)
-                    thread.start()
+                    bridge.run_in_thread(chunks_builder)
                     current_index = 0
-                    while (not reception_manager.done and elf_server.cancel_gen == False):
-                        while (not reception_manager.done and len(new_output["new_values"])==0):
-                            time.sleep(0.001)
-                        lk.acquire()
-                        for i in range(len(new_output["new_values"])):
-                            output_val = StreamingModelResponse(
-                                id = _generate_id(), 
-                                choices = [StreamingChoices(index= current_index, delta=Delta(content=new_output["new_values"][i]))], 
-                                created=int(time.time()),
-                                model=elf_server.config.model_name,
-                                object="chat.completion.chunk",
-                                usage=Usage(prompt_tokens= prompt_tokens, completion_tokens= 1)
-                                )
-                            current_index += 1                        
-                            yield (output_val.json() + '\n')
-                        new_output["new_values"]=[]
-                        lk.release()
-                    elf_server.cancel_gen = False         
-                return StreamingResponse(generate_chunks(), media_type="application/json")
+                    async for chunk in bridge.chunks():
+                        output_val = StreamingModelResponse(
+                            id = _generate_id(), 
+                            choices = [StreamingChoices(index= current_index, delta=Delta(content=chunk))], 
+                            created=int(time.time()),
+                            model=elf_server.config.model_name,
+                            object="chat.completion.chunk",
+                            usage=Usage(prompt_tokens= prompt_tokens, completion_tokens= 1)
+                            )
+                        current_index += 1
+                        yield (output_val.json() + '\n')
+                return StreamingResponse(generate_chunks(), media_type="application/json", headers={"X-Lollms-Request-Id":gen_request.id}, background=BackgroundTask(elf_server.scheduler.release, gen_request))
             else:
                 def callback(chunk, chunk_type:MSG_OPERATION_TYPE=MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
                     # Yield each chunk of data
@@ -755,7 +719,9 @@ async def ollama_chat_completion(request: ChatGenerationRequest):
 
 
                     return True
-                elf_server.binding.generate(
+                await asyncio.to_thread(
+                                                elf_server.scheduler.run,
+                                                elf_server.binding.generate,
                                                 prompt, 
                                                 n_predict, 
                                                 callback=callback,
@@ -833,35 +799,46 @@ async def ollama_generate(request: CompletionGenerationRequest):
         ASCIIColors.cyan("> Processing ...")
         if elf_server.binding is not None:
             if stream:
+                # The request takes its place in the queue before the response starts, so a full queue is reported to the caller
+                gen_request = elf_server.scheduler.submit("api")
                 output = {"text":""}
-                def generate_chunks():
+                async def generate_chunks():
+                    bridge = StreamBridge(on_cancel=gen_request.cancel)
+                    matcher = StopSequenceMatcher([start_header_id_template, end_header_id_template])
                     def callback(chunk, chunk_type:MSG_OPERATION_TYPE=MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
+                        if chunk is None:
+                            return True
                         # Yield each chunk of data
                         output["text"] += chunk
-                        antiprompt = detect_antiprompt(output["text"], [start_header_id_template, end_header_id_template])
+                        antiprompt = matcher.feed(chunk)
                         if antiprompt:
                             ASCIIColors.warning(f"\n{antiprompt} detected. Stopping generation")
                             output["text"] = remove_text_from_string(output["text"],antiprompt)
                             return False
                         else:
-                            yield chunk
-                            return True
-                    return iter(elf_server.binding.generate(
-                                                text, 
-                                                n_predict, 
-                                                callback=callback, 
-                                                temperature=temperature,
-                            ))
+                            return bridge.put(chunk)
+                    bridge.run_in_thread(
+                                            elf_server.scheduler.execute,
+                                            gen_request,
+                                            elf_server.binding.generate,
+                                            text, 
+                                            n_predict, 
+                                            callback=callback, 
+                                            temperature=temperature,
+                                        )
+                    async for chunk in bridge.chunks():
+                        yield chunk
                 ASCIIColors.success("> Streaming ...")                
-                return StreamingResponse(generate_chunks())
+                return StreamingResponse(generate_chunks(), headers={"X-Lollms-Request-Id":gen_request.id}, background=BackgroundTask(elf_server.scheduler.release, gen_request))
             else:
                 output = {"text":""}
+                matcher = StopSequenceMatcher(["!@>"])
                 def callback(chunk, chunk_type:MSG_OPERATION_TYPE=MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
                     if chunk is None:
                         return
                     # Yield each chunk of data
                     output["text"] += chunk
-                    antiprompt = detect_antiprompt(output["text"])
+                    antiprompt = matcher.feed(chunk)
                     if antiprompt:
                         ASCIIColors.warning(f"\n{antiprompt} detected. Stopping generation")
                         output["text"] = remove_text_from_string(output["text"],antiprompt)
@@ -869,7 +846,9 @@ async def ollama_generate(request: CompletionGenerationRequest):
                         return False
                     else:
                         return True
-                elf_server.binding.generate(
+                await asyncio.to_thread(
+                                                elf_server.scheduler.run,
+                                                elf_server.binding.generate,
                                                 text, 
                                                 n_predict, 
                                                 callback=callback,
@@ -917,13 +896,12 @@ async def ollama_completion(request: CompletionGenerationRequest):
         
         if elf_server.binding is not None:
             if stream:
-                new_output={"new_values":[]}
+                # The request takes its place in the queue before the response starts, so a full queue is reported to the caller
+                gen_request = elf_server.scheduler.submit("api")
                 async def generate_chunks():
-                    lk = threading.Lock()
+                    bridge = StreamBridge(on_cancel=gen_request.cancel)
 
                     def callback(chunk, chunk_type:MSG_OPERATION_TYPE=MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
-                        if elf_server.cancel_gen:
-                            return False
                         
                         if chunk is None:
                             return
@@ -937,42 +915,28 @@ async def ollama_completion(request: CompletionGenerationRequest):
                             else:
                                 chunk = chunk + rx.value
 
-                        # Yield each chunk of data
-                        lk.acquire()
-                        try:
-                            new_output["new_values"].append(reception_manager.chunk)
-                            lk.release()
-                            return True
-                        except Exception as ex:
-                            trace_exception(ex)
-                            lk.release()
-                            return False
+                        # Send the chunk to the consumer (waits if the client is too slow)
+                        return bridge.put(reception_manager.chunk)
                         
                     def chunks_builder():
                         if request.model in elf_server.binding.list_models() and elf_server.binding.model_name!=request.model:
                             elf_server.binding.build_model(request.model)    
 
-                        elf_server.binding.generate(
+                        elf_server.scheduler.execute(
+                                                gen_request,
+                                                elf_server.binding.generate,
                                                 prompt, 
                                                 n_predict, 
                                                 callback=callback, 
                                                 temperature=temperature or elf_server.config.temperature
                                             )
                         reception_manager.done = True
-                    thread = threading.Thread(target=chunks_builder)
-                    thread.start()
+                    bridge.run_in_thread(chunks_builder)
                     current_index = 0
-                    while (not reception_manager.done and elf_server.cancel_gen == False):
-                        while (not reception_manager.done and len(new_output["new_values"])==0):
-                            time.sleep(0.001)
-                        lk.acquire()
-                        for i in range(len(new_output["new_values"])):
-                            current_index += 1                        
-                            yield {"response":new_output["new_values"][i]}
-                        new_output["new_values"]=[]
-                        lk.release()
-                    elf_server.cancel_gen = False         
-                return StreamingResponse(generate_chunks(), media_type="text/plain")
+                    async for chunk in bridge.chunks():
+                        current_index += 1
+                        yield json.dumps({"response":chunk}) + "\n"
+                return StreamingResponse(generate_chunks(), media_type="text/plain", headers={"X-Lollms-Request-Id":gen_request.id}, background=BackgroundTask(elf_server.scheduler.release, gen_request))
             else:
                 def callback(chunk, chunk_type:MSG_OPERATION_TYPE=MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
                     # Yield each chunk of data
@@ -990,7 +954,9 @@ async def ollama_completion(request: CompletionGenerationRequest):
 
 
                     return True
-                elf_server.binding.generate(
+                await asyncio.to_thread(
+                                                elf_server.scheduler.run,
+                                                elf_server.binding.generate,
                                                 prompt, 
                                                 n_predict, 
                                                 callback=callback,
@@ -1023,40 +989,53 @@ async def v1_completion(request: CompletionGenerationRequest):
         
         if elf_server.binding is not None:
             if stream:
+                # The request takes its place in the queue before the response starts, so a full queue is reported to the caller
+                gen_request = elf_server.scheduler.submit("api")
                 output = {"text":""}
-                def generate_chunks():
+                async def generate_chunks():
+                    bridge = StreamBridge(on_cancel=gen_request.cancel)
+                    matcher = StopSequenceMatcher(["!@>"])
                     def callback(chunk, chunk_type:MSG_OPERATION_TYPE=MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
+                        if chunk is None:
+                            return True
                         # Yield each chunk of data
                         output["text"] += chunk
-                        antiprompt = detect_antiprompt(output["text"])
+                        antiprompt = matcher.feed(chunk)
                         if antiprompt:
                             ASCIIColors.warning(f"\n{antiprompt} detected. Stopping generation")
                             output["text"] = remove_text_from_string(output["text"],antiprompt)
                             return False
                         else:
-                            yield chunk
-                            return True
-                    return iter(elf_server.binding.generate(
-                                                text, 
-                                                n_predict, 
-                                                callback=callback, 
-                                                temperature=temperature,
-                            ))
+                            return bridge.put(chunk)
+                    bridge.run_in_thread(
+                                            elf_server.scheduler.execute,
+                                            gen_request,
+                                            elf_server.binding.generate,
+                                            text, 
+                                            n_predict, 
+                                            callback=callback, 
+                                            temperature=temperature,
+                                        )
+                    async for chunk in bridge.chunks():
+                        yield chunk
                 
-                return StreamingResponse(generate_chunks())
+                return StreamingResponse(generate_chunks(), headers={"X-Lollms-Request-Id":gen_request.id}, background=BackgroundTask(elf_server.scheduler.release, gen_request))
             else:
                 output = {"text":""}
+                matcher = StopSequenceMatcher(["!@>"])
                 def callback(chunk, chunk_type:MSG_OPERATION_TYPE=MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
                     # Yield each chunk of data
                     output["text"] += chunk
-                    antiprompt = detect_antiprompt(output["text"])
+                    antiprompt = matcher.feed(chunk)
                     if antiprompt:
                         ASCIIColors.warning(f"\n{antiprompt} detected. Stopping generation")
                         output["text"] = remove_text_from_string(output["text"],antiprompt)
                         return False
                     else:
                         return True
-                elf_server.binding.generate(
+                await asyncio.to_thread(
+                                                elf_server.scheduler.run,
+                                                elf_server.binding.generate,
                                                 text, 
                                                 n_predict, 
                                                 callback=callback,
@@ -1071,7 +1050,18 @@ async def v1_completion(request: CompletionGenerationRequest):
         return {"status":False,"error":str(ex)}
 
 
+class StopGenerationRequest(BaseModel):
+    request_id: Optional[str] = None
+
 @router.post("/stop_gen")
-def stop_gen():
-    elf_server.cancel_gen = True
+def stop_gen(request: Optional[StopGenerationRequest] = None):
+    """
+    Stops generations.
+    If request_id is provided (it is sent back in the X-Lollms-Request-Id header of streamed responses),
+    only that generation is stopped. Otherwise every generation started through the API is stopped
+    (the generations of the socket.io clients are stopped by their own clients).
+    """
+    if request is not None and request.request_id:
+        return {"status": elf_server.scheduler.cancel(request.request_id)}
+    elf_server.scheduler.cancel_source("api")
     return {"status": True} 
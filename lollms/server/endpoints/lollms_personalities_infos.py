@@ -9,11 +9,12 @@ description:
 """
 from fastapi import APIRouter, Request
 from fastapi import HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 from pydantic import BaseModel, Field
 import pkg_resources
 from lollms.server.elf_server import LOLLMSElfServer
 from lollms.personality import AIPersonality, InstallOption
+from lollms.databases.personalities_catalog import get_avatar
 from ascii_colors import ASCIIColors
 from lollms.utilities import load_config, trace_exception, gc, show_yes_no_dialog
 from lollms.security import check_access, forbid_remote_access
@@ -41,69 +42,27 @@ lollmsElfServer = LOLLMSElfServer.get_instance()
 
 @router.get("/list_personalities_categories")
 def list_personalities_categories():
-    personalities_categories_dir = lollmsElfServer.lollms_paths.personalities_zoo_path  # replace with the actual path to the models folder
-    personalities_categories = ["custom_personalities"]+[f.stem for f in personalities_categories_dir.iterdir() if f.is_dir() and not f.name.startswith(".")]
-    return personalities_categories
+    return lollmsElfServer.personalities_catalog.get_categories()
 
 @router.get("/list_personalities")
 def list_personalities(category:str):
     category = sanitize_path(category)
     if not category:
         return []
-    try:
-        if category=="custom_personalities":
-            personalities_dir = lollmsElfServer.lollms_paths.custom_personalities_path  # replace with the actual path to the models folder
-        else:
-            personalities_dir = lollmsElfServer.lollms_paths.personalities_zoo_path/f'{category}'  # replace with the actual path to the models folder
-        personalities = [f.stem for f in personalities_dir.iterdir() if f.is_dir() and not f.name.startswith(".")]
-    except Exception as ex:
-        personalities=[]
-        ASCIIColors.error(f"No personalities found. Using default one {ex}")
+    personalities = lollmsElfServer.personalities_catalog.get_folders(category)
+    if len(personalities)==0:
+        ASCIIColors.error(f"No personalities found in category {category}")
     return personalities
 
 
-@router.get("/get_personality")
-def get_personality():
-    ASCIIColors.yellow("Getting current personality")
-    personality = lollmsElfServer.personality
-
+def get_mounted_personality_infos(personality:AIPersonality, category:str):
+    """
+    Builds the listing informations of a mounted personality from the personality itself.
+    """
     real_assets_path = lollmsElfServer.lollms_paths.personalities_zoo_path / personality.category / personality.personality_folder_name / 'assets'
-    assets_path = Path("personalities") / personality.category / personality.personality_folder_name / 'assets'
-    gif_logo_path = assets_path / 'logo.gif'
-    webp_logo_path = assets_path / 'logo.webp'
-    png_logo_path = assets_path / 'logo.png'
-    jpg_logo_path = assets_path / 'logo.jpg'
-    jpeg_logo_path = assets_path / 'logo.jpeg'
-    svg_logo_path = assets_path / 'logo.svg'
-    bmp_logo_path = assets_path / 'logo.bmp'
-
-    gif_logo_path_ = real_assets_path / 'logo.gif'
-    webp_logo_path_ = real_assets_path / 'logo.webp'
-    png_logo_path_ = real_assets_path / 'logo.png'
-    jpg_logo_path_ = real_assets_path / 'logo.jpg'
-    jpeg_logo_path_ = real_assets_path / 'logo.jpeg'
-    svg_logo_path_ = real_assets_path / 'logo.svg'
-    bmp_logo_path_ = real_assets_path / 'logo.bmp'
-        
-    has_logo = png_logo_path.is_file() or gif_logo_path.is_file()
-    
-    if gif_logo_path_.exists():
-        avatar = str(gif_logo_path).replace("\\","/")
-    elif webp_logo_path_.exists():
-        avatar = str(webp_logo_path).replace("\\","/")
-    elif png_logo_path_.exists():
-        avatar = str(png_logo_path).replace("\\","/")
-    elif jpg_logo_path_.exists():
-        avatar = str(jpg_logo_path).replace("\\","/")
-    elif jpeg_logo_path_.exists():
-        avatar = str(jpeg_logo_path).replace("\\","/")
-    elif svg_logo_path_.exists():
-        avatar = str(svg_logo_path).replace("\\","/")
-    elif bmp_logo_path_.exists():
-        avatar = str(bmp_logo_path).replace("\\","/")
-    else:
-        avatar = ""    
-    personality = {
+    assets_path = Path("personalities") / category / personality.personality_folder_name / 'assets'
+    avatar, has_logo = get_avatar(real_assets_path, assets_path)
+    return {
         "folder":personality.personality_folder_name,
         "has_scripts":personality.processor is not None,
         "name":personality.name,
@@ -121,169 +80,37 @@ def get_personality():
         "avatar":avatar,
         "has_logo":has_logo
     }
-    return personality
+
+@router.get("/get_personality")
+def get_personality():
+    ASCIIColors.yellow("Getting current personality")
+    personality = lollmsElfServer.personality
+    return get_mounted_personality_infos(personality, personality.category)
 
 @router.get("/get_all_personalities")
-def get_all_personalities():
+def get_all_personalities(request: Request):
+    """
+    Lists the personalities of the zoo grouped by category.
+    Served from the personalities catalog, with an ETag so that an unchanged listing is not sent again.
+    """
     ASCIIColors.yellow("Listing all personalities", end="")
-    personalities_folder = lollmsElfServer.lollms_paths.personalities_zoo_path
-    personalities = {}
+    catalog = lollmsElfServer.personalities_catalog
+    listing = catalog.get_all()
+    mounted = lollmsElfServer.personality
+    etag = f'"{catalog.revision}-{id(mounted)}"'
+    if request.headers.get("if-none-match") == etag:
+        ASCIIColors.green("OK")
+        return Response(status_code=304, headers={"ETag": etag})
 
-    for category_folder in  [lollmsElfServer.lollms_paths.custom_personalities_path] + list(personalities_folder.iterdir()):
-        cat = category_folder.stem
-        if category_folder.is_dir() and not category_folder.stem.startswith('.'):
-            personalities[cat if category_folder!=lollmsElfServer.lollms_paths.custom_personalities_path else "custom_personalities"] = []
-            for personality_folder in category_folder.iterdir():
-                pers = personality_folder.stem
-                if lollmsElfServer.personality.personality_folder_name==pers:
-                    personality = lollmsElfServer.personality
-                    lollmsElfServer.lollms_paths.custom_personalities_path
-                    real_assets_path = lollmsElfServer.lollms_paths.personalities_zoo_path / cat / personality.personality_folder_name / 'assets'
-                    category = personality.category if category_folder!=lollmsElfServer.lollms_paths.custom_personalities_path!=category_folder else "custom_personalities"
-                    assets_path = Path("personalities") / category / personality.personality_folder_name / 'assets'
-                    gif_logo_path = assets_path / 'logo.gif'
-                    webp_logo_path = assets_path / 'logo.webp'
-                    png_logo_path = assets_path / 'logo.png'
-                    jpg_logo_path = assets_path / 'logo.jpg'
-                    jpeg_logo_path = assets_path / 'logo.jpeg'
-                    svg_logo_path = assets_path / 'logo.svg'
-                    bmp_logo_path = assets_path / 'logo.bmp'
-
-                    gif_logo_path_ = real_assets_path / 'logo.gif'
-                    webp_logo_path_ = real_assets_path / 'logo.webp'
-                    png_logo_path_ = real_assets_path / 'logo.png'
-                    jpg_logo_path_ = real_assets_path / 'logo.jpg'
-                    jpeg_logo_path_ = real_assets_path / 'logo.jpeg'
-                    svg_logo_path_ = real_assets_path / 'logo.svg'
-                    bmp_logo_path_ = real_assets_path / 'logo.bmp'
-                        
-                    has_logo = png_logo_path.is_file() or gif_logo_path.is_file()
-                    
-                    if gif_logo_path_.exists():
-                        avatar = str(gif_logo_path).replace("\\","/")
-                    elif webp_logo_path_.exists():
-                        avatar = str(webp_logo_path).replace("\\","/")
-                    elif png_logo_path_.exists():
-                        avatar = str(png_logo_path).replace("\\","/")
-                    elif jpg_logo_path_.exists():
-                        avatar = str(jpg_logo_path).replace("\\","/")
-                    elif jpeg_logo_path_.exists():
-                        avatar = str(jpeg_logo_path).replace("\\","/")
-                    elif svg_logo_path_.exists():
-                        avatar = str(svg_logo_path).replace("\\","/")
-                    elif bmp_logo_path_.exists():
-                        avatar = str(bmp_logo_path).replace("\\","/")
-                    else:
-                        avatar = ""    
-                    personality = {
-                        "folder":personality.personality_folder_name,
-                        "has_scripts":personality.processor is not None,
-                        "name":personality.name,
-                        "description":personality.personality_description,
-                        "disclaimer":personality.disclaimer,
-                        "author":personality.author,
-                        "language":personality.language,
-                        "version":personality.version,
-                        "creation_date":personality.creation_date,
-                        "last_update_date":personality.last_update_date,
-                        "installed":True,
-                        "help":personality.help,
-                        "commands":personality.commands,
-                        "prompts_list":personality.prompts_list,
-                        "avatar":avatar,
-                        "has_logo":has_logo
-                    }
-                    personalities[cat if category_folder!=lollmsElfServer.lollms_paths.custom_personalities_path else "custom_personalities"].append(personality)
-                else:
-                    if personality_folder.is_dir() and not personality_folder.stem.startswith('.'):
-                        personality_info = {"folder":personality_folder.stem}
-                        config_path = personality_folder / 'config.yaml'
-                        if not config_path.exists():
-                            """
-                            try:
-                                shutil.rmtree(str(config_path.parent))
-                                ASCIIColors.warning(f"Deleted useless personality: {config_path.parent}")
-                            except Exception as ex:
-                                ASCIIColors.warning(f"Couldn't delete personality ({ex})")
-                            """
-                            continue                                    
-                        try:
-                            scripts_path = personality_folder / 'scripts'
-                            personality_info['has_scripts'] = scripts_path.exists()
-                            with open(config_path, "r", encoding="utf8") as config_file:
-                                config_data = yaml.load(config_file, Loader=yaml.FullLoader)
-                                personality_info['name'] = config_data.get('name',"No Name")
-                                personality_info['description'] = config_data.get('personality_description',"")
-                                personality_info['disclaimer'] = config_data.get('disclaimer',"")
-                                personality_info['author'] = config_data.get('author', 'ParisNeo')
-                                personality_info['language'] = config_data.get('language', 'english')
-                                personality_info['version'] = config_data.get('version', '1.0.0')
-                                personality_info['creation_date'] = config_data.get("creation_date",None)
-                                personality_info['last_update_date'] = config_data.get("last_update_date",None)
-                                personality_info['installed'] = (lollmsElfServer.lollms_paths.personal_configuration_path/f"personality_{personality_folder.stem}.yaml").exists() or personality_info['has_scripts']
-                                personality_info['help'] = config_data.get('help', '')
-                                personality_info['commands'] = config_data.get('commands', '')
-                                personality_info['prompts_list'] = config_data.get('prompts_list', [])
-
-
-                            try:
-                                help_path = personality_folder / 'README.md'
-                                if help_path.exists():
-                                    personality_info['help']=help_path.read_text()
-                            except:
-                                pass
-
-                            languages_path = personality_folder/ 'languages'
-
-                            real_assets_path = personality_folder/ 'assets'
-                            assets_path = Path("personalities") / cat / pers / 'assets'
-                            gif_logo_path = assets_path / 'logo.gif'
-                            webp_logo_path = assets_path / 'logo.webp'
-                            png_logo_path = assets_path / 'logo.png'
-                            jpg_logo_path = assets_path / 'logo.jpg'
-                            jpeg_logo_path = assets_path / 'logo.jpeg'
-                            svg_logo_path = assets_path / 'logo.svg'
-                            bmp_logo_path = assets_path / 'logo.bmp'
-
-                            gif_logo_path_ = real_assets_path / 'logo.gif'
-                            webp_logo_path_ = real_assets_path / 'logo.webp'
-                            png_logo_path_ = real_assets_path / 'logo.png'
-                            jpg_logo_path_ = real_assets_path / 'logo.jpg'
-                            jpeg_logo_path_ = real_assets_path / 'logo.jpeg'
-                            svg_logo_path_ = real_assets_path / 'logo.svg'
-                            bmp_logo_path_ = real_assets_path / 'logo.bmp'
-
-                            if languages_path.exists():
-                                personality_info['languages']= [""]+[f.stem for f in languages_path.iterdir() if f.suffix==".yaml"]
-                            else:
-                                personality_info['languages']=None
-                                
-                            personality_info['has_logo'] = png_logo_path.is_file() or gif_logo_path.is_file()
-                            
-                            if gif_logo_path_.exists():
-                                personality_info['avatar'] = str(gif_logo_path).replace("\\","/")
-                            elif webp_logo_path_.exists():
-                                personality_info['avatar'] = str(webp_logo_path).replace("\\","/")
-                            elif png_logo_path_.exists():
-                                personality_info['avatar'] = str(png_logo_path).replace("\\","/")
-                            elif jpg_logo_path_.exists():
-                                personality_info['avatar'] = str(jpg_logo_path).replace("\\","/")
-                            elif jpeg_logo_path_.exists():
-                                personality_info['avatar'] = str(jpeg_logo_path).replace("\\","/")
-                            elif svg_logo_path_.exists():
-                                personality_info['avatar'] = str(svg_logo_path).replace("\\","/")
-                            elif bmp_logo_path_.exists():
-                                personality_info['avatar'] = str(bmp_logo_path).replace("\\","/")
-                            else:
-                                personality_info['avatar'] = ""
-                            
-                            personalities[cat if category_folder!=lollmsElfServer.lollms_paths.custom_personalities_path else "custom_personalities"].append(personality_info)
-                        except Exception as ex:
-                            ASCIIColors.warning(f"Couldn't load personality from {personality_folder} [{ex}]")
-                            trace_exception(ex)
+    personalities = {}
+    for category, category_personalities in listing.items():
+        if mounted is not None and any(p["folder"]==mounted.personality_folder_name for p in category_personalities):
+            mounted_category = mounted.category if category!="custom_personalities" else "custom_personalities"
+            category_personalities = [get_mounted_personality_infos(mounted, mounted_category) if p["folder"]==mounted.personality_folder_name else p for p in category_personalities]
+        personalities[category] = category_personalities
     ASCIIColors.green("OK")
 
-    return personalities
+    return JSONResponse(content=personalities, headers={"ETag": etag})
 
 
 @router.get("/list_mounted_personalities")
@@ -344,6 +171,7 @@ async def reinstall_personality(personality_in: PersonalityIn):
                                         model=lollmsElfServer.model,
                                         app=lollmsElfServer,
                                         run_scripts=True,installation_option=InstallOption.FORCE_INSTALL)
+            lollmsElfServer.personalities_catalog.invalidate()
             return {"status":True}
         except Exception as ex:
             trace_exception(ex)
@@ -572,7 +400,7 @@ def mount_personality(data:PersonalityMountingInfos):
     else:
         pth = str(config_file).replace('\\','/')
         ASCIIColors.error(f"nok : Personality not found @ {pth}")            
-        ASCIIColors.yellow(f"Available personalities: {[p.name for p in lollmsElfServer.mounted_personalities]}")
+        ASCIIColors.yellow(f"Available personalities: {lollmsElfServer.config['personalities']}")
         return {"status": False, "error":f"Personality not found @ {pth}"}
 
 
@@ -627,7 +455,7 @@ def remount_personality(data:PersonalityMountingInfos):
     else:
         pth = str(config_file).replace('\\','/')
         ASCIIColors.error(f"nok : Personality not found @ {pth}")
-        ASCIIColors.yellow(f"Available personalities: {[p.name for p in lollmsElfServer.mounted_personalities]}")
+        ASCIIColors.yellow(f"Available personalities: {lollmsElfServer.config['personalities']}")
         return {"status": False, "error":f"Personality not found @ {pth}"}  
     
 
@@ -674,7 +502,7 @@ def unmount_personality(data:PersonalityMountingInfos):
         else:
             ASCIIColors.error(f"nok : Personality not found @ {category}/{name}")
             
-        ASCIIColors.yellow(f"Available personalities: {[p.name for p in lollmsElfServer.mounted_personalities if p is not None]}")
+        ASCIIColors.yellow(f"Available personalities: {lollmsElfServer.config['personalities']}")
         return {"status": False, "error":"Couldn't unmount personality"}
     
 
@@ -701,10 +529,12 @@ def select_personality(data:PersonalitySelectionInfos):
     ASCIIColors.info(f"Selecting personality : {lollmsElfServer.mounted_personalities[data.id]}")
     id = data.id
     if id<len(lollmsElfServer.mounted_personalities):
-        lollmsElfServer.config["active_personality_id"]=id
-        lollmsElfServer.personality:AIPersonality = lollmsElfServer.mounted_personalities[lollmsElfServer.config["active_personality_id"]]
-        if lollmsElfServer.personality is None:
+        # None if a lazily mounted personality fails to build (it is unmounted)
+        personality:AIPersonality = lollmsElfServer.get_mounted_personality(id)
+        if personality is None:
             return {"status": False, "error":"Something is wrong with the personality"}
+        lollmsElfServer.config["active_personality_id"]=id
+        lollmsElfServer.personality = personality
         if lollmsElfServer.personality.processor:
             lollmsElfServer.personality.processor.selected()
         ASCIIColors.success("ok")
@@ -836,6 +666,7 @@ async def copy_to_custom_personas(data: PersonalityInfos):
         personality_folder = lollmsElfServer.lollms_paths.personalities_zoo_path/f"{category}"/f"{name}"
         destination_folder = lollmsElfServer.lollms_paths.custom_personalities_path
         shutil.copytree(personality_folder, destination_folder/f"{name}")
+        lollmsElfServer.personalities_catalog.invalidate()
         return {"status":True}
 
 # ------------------------------------------- Interaction with personas ------------------------------------------------
@@ -173,6 +173,7 @@ async def restart_program(data: Identification):
     lollmsElfServer.ShowBlockingMessage("Restarting program.\nPlease stand by...")
     # Stop the socketIO server
     run_async(lollmsElfServer.sio.shutdown)
+    lollmsElfServer.ingestion_queue.shutdown()
     # Sleep for 1 second before rebooting
     time.sleep(1)
     lollmsElfServer.HideBlockingMessage()
@@ -228,6 +229,7 @@ async def update_software(data: Identification):
     ASCIIColors.info("")
     # Stop the socketIO server
     await lollmsElfServer.sio.shutdown()
+    lollmsElfServer.ingestion_queue.shutdown()
     # Sleep for 1 second before rebooting
     time.sleep(1)
 
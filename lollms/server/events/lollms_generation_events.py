@@ -33,7 +33,8 @@ def add_events(sio:socketio):
     async def cancel_generation(sid):
         client_id = sid
         client = lollmsElfServer.session.get_client(client_id)
-        lollmsElfServer.cancel_gen = True
+        # Only stop the generations of this client
+        lollmsElfServer.scheduler.cancel_client(client_id)
         #kill thread
         ASCIIColors.error(f'Client {sid} requested cancelling generation')
         client.generation_routine.cancel()
@@ -49,6 +50,7 @@ def add_events(sio:socketio):
         client_id = sid
         client = lollmsElfServer.session.get_client(client_id)
         client.requested_stop=True
+        lollmsElfServer.scheduler.cancel_client(client_id)
         print(f"Client {client_id} requested canceling generation")
         lollmsElfServer.sio.emit("generation_canceled", {"message":"Generation is canceled."}, to=client_id)
         lollmsElfServer.busy = False
@@ -115,7 +117,9 @@ def add_events(sio:socketio):
                     try:
                         ASCIIColors.print("warming up", ASCIIColors.color_bright_cyan)
                         
-                        generated_text = model.generate(fd, 
+                        generated_text = lollmsElfServer.scheduler.run(
+                                                        model.generate,
+                                                        fd, 
                                                         n_predict=n_predicts, 
                                                         callback=callback,
                                                         temperature = parameters["temperature"],
@@ -124,6 +128,8 @@ def add_events(sio:socketio):
                                                         repeat_penalty = parameters["repeat_penalty"],
                                                         repeat_last_n = parameters["repeat_last_n"],
                                                         seed = parameters["seed"],                                           
+                                                        source = "socket",
+                                                        client_id = client_id
                                                         )
                         ASCIIColors.success(f"\ndone")
 
@@ -192,10 +198,13 @@ def add_events(sio:socketio):
                             generated_text = personality.processor.run_workflow(context_details, client=client, callback=callback)
                         else:
                             ASCIIColors.info("generating...")
-                            generated_text = personality.model.generate(
+                            generated_text = lollmsElfServer.scheduler.run(
+                                                                        personality.model.generate,
                                                                         personality.personality_conditioning+fd, 
                                                                         n_predict=n_predicts, 
-                                                                        callback=callback)
+                                                                        callback=callback,
+                                                                        source="socket",
+                                                                        client_id=client_id)
 
                         if personality.processor is not None and personality.processor_cfg["process_model_output"]: 
                             generated_text = personality.processor.process_model_output(generated_text)
@@ -108,7 +108,9 @@ def add_events(sio:socketio):
         if is_last_chunk:
             lollmsElfServer.success('File received and saved successfully')
             lollmsElfServer.HideBlockingMessage()
-            lollmsElfServer.ShowBlockingMessage(f"File received {file_path.name}.\nProcessing the file ...")
+            # documents and audio files are ingested in the background (see ingestion_progress), images are described here
+            if path == client.discussion.discussion_images_folder:
+                lollmsElfServer.ShowBlockingMessage(f"File received {file_path.name}.\nProcessing the file ...")
 
             if lollmsElfServer.personality.processor:
                 result = client.discussion.add_file(file_path, client, lollmsElfServer.tasks_library, partial(lollmsElfServer.process_data, client_id=client_id))
@@ -122,6 +124,15 @@ def add_events(sio:socketio):
             run_async(partial(sio.emit,'request_next_chunk', {'offset': offset + len(chunk)}))
 
 
+    @sio.on('get_ingestion_jobs')
+    def get_ingestion_jobs(sid, data=None):
+        client_id = sid
+        client = check_access(lollmsElfServer, client_id)
+        discussion_id = client.discussion.discussion_id if client.discussion is not None else None
+        # without a discussion, get_jobs would return the jobs of every discussion
+        jobs = lollmsElfServer.ingestion_queue.get_jobs(discussion_id=discussion_id) if discussion_id is not None else []
+        run_async(partial(sio.emit,'ingestion_jobs', {'discussion_id': discussion_id, 'jobs': jobs}, to=client_id))
+
     @sio.on('execute_command')
     def execute_command(sid, data):
         client_id = sid
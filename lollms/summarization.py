@@ -0,0 +1,233 @@
+######
+# Project       : lollms
+# File          : summarization.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Map reduce summarization engine.
+# The summaries of the chunks of a document do not depend on each other, so they are generated
+# concurrently (on one or several generation functions). They are then merged group by group,
+# each group fitting in the context, until a single summary remains.
+######
+from ascii_colors import ASCIIColors
+from lollms.types import MSG_OPERATION_TYPE, SUMMARY_MODE
+from lollms.utilities import remove_text_from_string
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+import threading
+
+
+def default_summary_mode(config) -> SUMMARY_MODE:
+    """
+    The summary mode used when the caller does not choose one: map reduce if the chunks can be summarized
+    in parallel (summarization_max_workers > 1), the sequential cumulative summary otherwise.
+    """
+    if int(config.get("summarization_max_workers", 1)) > 1:
+        return SUMMARY_MODE.SUMMARY_MODE_MAP_REDUCE
+    return SUMMARY_MODE.SUMMARY_MODE_SEQUENCIAL
+
+
+def generate_isolated(generate:Callable, prompt:str, max_size:int, stop_sequence_matcher, **generation_parameters) -> str:
+    """
+    Runs generate(prompt, max_size, callback=..., **generation_parameters) and returns the generated text.
+    The text is collected in a local buffer instead of the shared generation state (bot_says, callback),
+    so that several generations can run at the same time. Nothing is streamed to the user.
+    """
+    output = [""]
+    def receive(text, message_type, *args, **kwargs):
+        if text is None:
+            return True
+        if message_type==MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK:
+            output[0] += text
+        elif message_type==MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_SET_CONTENT:
+            output[0] = text
+        antiprompt = stop_sequence_matcher.scan(output[0])
+        if antiprompt:
+            output[0] = remove_text_from_string(output[0], antiprompt)
+            return False
+        return True
+
+    generate(prompt, max_size, callback=receive, **generation_parameters)
+    return output[0].strip().replace("</s>", "").replace("<s>", "")
+
+
+class MapReduceSummarizer:
+    """
+    Summarizes a list of chunks with a parallel map step and a hierarchical, token budget aware, reduce step.
+
+    Args:
+        generators (List[Callable]): Generation functions generate(prompt, max_size) -> str.
+            They must be safe to call from several threads. Requests are spread over them in round robin,
+            so several bindings (or servers) can share the work.
+        count_tokens (Callable): count_tokens(text) -> int.
+        ctx_size (int): The context size of the model.
+        max_generation_size (int): The maximum size of each generated summary.
+        map_prompt (Callable): map_prompt(chunk) -> the prompt summarizing one chunk.
+        reduce_prompt (Callable): reduce_prompt(summaries:List[str]) -> the prompt merging several summaries.
+        max_workers (int, optional): Number of generations running at the same time. Defaults to 1.
+        post_processing (Callable, optional): Applied to each generated summary.
+        step_callback (Callable, optional): step_callback(step_name, done, total) called as generations complete.
+        wrap_worker (Callable, optional): Wraps the functions executed in the worker threads
+            (used to attach them to the generation request of the calling thread).
+    """
+    def __init__(
+                    self,
+                    generators:List[Callable],
+                    count_tokens:Callable,
+                    ctx_size:int,
+                    max_generation_size:int,
+                    map_prompt:Callable,
+                    reduce_prompt:Callable,
+                    max_workers:int=1,
+                    post_processing:Callable=None,
+                    step_callback:Callable=None,
+                    wrap_worker:Callable=None
+                ):
+        if len(generators)==0:
+            raise ValueError("At least one generation function is needed")
+        self.generators             = generators
+        self.count_tokens           = count_tokens
+        self.ctx_size               = ctx_size
+        self.max_generation_size    = max_generation_size
+        self.map_prompt             = map_prompt
+        self.reduce_prompt          = reduce_prompt
+        self.max_workers            = max(1, max_workers)
+        self.post_processing        = post_processing
+        self.step_callback          = step_callback
+        self.wrap_worker            = wrap_worker
+
+    def _generate_all(self, prompts:List[str], step_name:str) -> List[str]:
+        """
+        Generates the answers of all the prompts, keeping their order.
+        """
+        total = len(prompts)
+        done = [0]
+        lock = threading.Lock()
+
+        def work(index):
+            output = self.generators[index % len(self.generators)](prompts[index], self.max_generation_size)
+            if self.post_processing:
+                output = self.post_processing(output)
+            with lock:
+                done[0] += 1
+                if self.step_callback:
+                    self.step_callback(step_name, done[0], total)
+            return output
+
+        if self.max_workers == 1 or total <= 1:
+            return [work(i) for i in range(total)]
+
+        if self.wrap_worker:
+            work = self.wrap_worker(work)
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, total)) as executor:
+            return list(executor.map(work, range(total)))
+
+    def map(self, chunks:List[str]) -> List[str]:
+        """
+        Summarizes each chunk independently.
+        """
+        return self._generate_all([self.map_prompt(chunk) for chunk in chunks], "Summarizing chunks")
+
+    def _group(self, summaries:List[str]) -> List[List[str]]:
+        """
+        Packs consecutive summaries in groups whose merge prompt fits in the context.
+        """
+        budget = self.ctx_size - self.max_generation_size - self.count_tokens(self.reduce_prompt([]))
+        groups = []
+        current = []
+        current_tokens = 0
+        for summary in summaries:
+            n_tokens = self.count_tokens(summary)
+            if len(current) > 0 and current_tokens + n_tokens > budget:
+                groups.append(current)
+                current = []
+                current_tokens = 0
+            current.append(summary)
+            current_tokens += n_tokens
+        if len(current) > 0:
+            groups.append(current)
+
+        if len(groups) == len(summaries) and len(summaries) > 1:
+            # Every summary fills the budget alone, merge them two by two to keep converging
+            ASCIIColors.warning("Summaries are too big for the context, merging them two by two")
+            groups = [summaries[i:i+2] for i in range(0, len(summaries), 2)]
+        return groups
+
+    def reduce(self, summaries:List[str]) -> str:
+        """
+        Merges the summaries level by level until a single one remains.
+        """
+        if len(summaries) == 0:
+            return ""
+        level = 0
+        while len(summaries) > 1:
+            level += 1
+            groups = self._group(summaries)
+            merged = self._generate_all([self.reduce_prompt(group) for group in groups if len(group) > 1], f"Merging summaries (level {level})")
+            merged = iter(merged)
+            summaries = [next(merged) if len(group) > 1 else group[0] for group in groups]
+        return summaries[0]
+
+    @classmethod
+    def for_document(
+                        cls,
+                        generators:List[Callable],
+                        count_tokens:Callable,
+                        config,
+                        max_generation_size:int,
+                        summary_instruction:str,
+                        doc_name:str="chunk",
+                        answer_start:str="",
+                        chunk_summary_post_processing:Callable=None,
+                        step_callback:Callable=None,
+                        wrap_worker:Callable=None
+                    ) -> "MapReduceSummarizer":
+        """
+        Builds the summarizer of the chunks of a document, with the prompts used by summarize_chunks.
+        The context size, the prompt templates and the number of workers are read from the configuration.
+        """
+        start_header_id_template    = config.start_header_id_template
+        end_header_id_template      = config.end_header_id_template
+        system_message_template     = config.system_message_template
+
+        def map_prompt(chunk):
+            return "\n".join([
+                            f"{start_header_id_template}Document_chunk [{doc_name}]{end_header_id_template}",
+                            f"{chunk}",
+                            f"{start_header_id_template}{system_message_template}{end_header_id_template}{summary_instruction}",
+                            f"Answer directly with the summary with no extra comments.",
+                            f"{start_header_id_template}summary{end_header_id_template}",
+                            f"{answer_start}"
+                            ])
+        def reduce_prompt(summaries):
+            return "\n".join([
+                            f"{start_header_id_template}Partial summaries of [{doc_name}]{end_header_id_template}",
+                            "\n\n".join(summaries),
+                            f"{start_header_id_template}{system_message_template}{end_header_id_template}Merge these partial summaries, written in the document order, into a single one.",
+                            summary_instruction,
+                            f"Keep all relevant information, do not invent information and do not add any extra comments.",
+                            f"{start_header_id_template}summary{end_header_id_template}",
+                            f"{answer_start}"
+                            ])
+        def post_processing(summary):
+            summary = f"{answer_start}"+summary
+            return chunk_summary_post_processing(summary) if chunk_summary_post_processing else summary
+
+        return cls(
+                    generators,
+                    count_tokens,
+                    config.ctx_size,
+                    max_generation_size,
+                    map_prompt,
+                    reduce_prompt,
+                    max_workers=int(config.get("summarization_max_workers", 1)),
+                    post_processing=post_processing,
+                    step_callback=step_callback,
+                    wrap_worker=wrap_worker
+                )
+
+    def summarize(self, chunks:List[str]) -> str:
+        """
+        Map then reduce: returns a single summary of all the chunks.
+        """
+        return self.reduce(self.map(chunks))
@@ -5,6 +5,8 @@ from functools import partial
 from datetime import datetime
 from ascii_colors import ASCIIColors
 from lollms.types import MSG_OPERATION_TYPE, SUMMARY_MODE
+from lollms.summarization import MapReduceSummarizer, default_summary_mode, generate_isolated
+from lollms.generation import StopSequenceMatcher
 from lollms.com import LoLLMsCom
 from lollms.utilities import PromptReshaper, remove_text_from_string, process_ai_output
 
@@ -39,11 +41,22 @@ class TasksLibrary:
         Returns:
             bool: True if any antiprompt is found in the text (ignoring case), False otherwise.
         """
+        text = text.lower()
         for prompt in self.anti_prompts:
-            if prompt.lower() in text.lower():
+            if prompt.lower() in text:
                 return prompt.lower()
         return None
 
+    def stop_sequence_matcher(self, matcher:StopSequenceMatcher=None) -> StopSequenceMatcher:
+        """
+        Returns an incremental antiprompt detector for a streamed answer.
+        If matcher is given and still uses the current antiprompts it is returned as is (keeping its state).
+        """
+        stop_sequences = tuple(dict.fromkeys(prompt.lower() for prompt in self.anti_prompts if prompt))
+        if matcher is None or matcher.stop_sequences != stop_sequences:
+            matcher = StopSequenceMatcher(stop_sequences)
+        return matcher
+
     def process(self, text:str, message_type:MSG_OPERATION_TYPE, callback=None, show_progress=False):
         if callback is None:
             callback = self.callback
@@ -67,7 +80,9 @@ class TasksLibrary:
             self.nb_received_tokens+=1
 
 
-        antiprompt = self.detect_antiprompt(bot_says)
+        # Only the new part of the answer is scanned
+        self._stop_sequence_matcher = self.stop_sequence_matcher(getattr(self, "_stop_sequence_matcher", None))
+        antiprompt = self._stop_sequence_matcher.scan(bot_says)
         if antiprompt:
             self.bot_says = remove_text_from_string(bot_says,antiprompt)
             ASCIIColors.warning(f"\n{antiprompt} detected. Stopping generation")
@@ -85,10 +100,11 @@ class TasksLibrary:
         if debug:
             self.print_prompt("gen",prompt)
         ntokens = len(self.lollms.model.tokenize(prompt))
-        self.lollms.model.generate(
+        self.lollms.scheduler.run(
+                                self.lollms.model.generate,
                                 prompt,
                                 max_size if max_size else min(self.lollms.config.ctx_size-ntokens,self.lollms.config.max_n_predict),
-                                partial(self.process, callback=callback, show_progress=show_progress),
+                                callback=partial(self.process, callback=callback, show_progress=show_progress),
                                 temperature= temperature if temperature is not None else self.lollms.config.temperature if self.lollms.config.override_personality_model_parameters else self.lollms.personality.model_temperature,
                                 top_k= top_k if top_k is not None else self.lollms.config.top_k if self.lollms.config.override_personality_model_parameters else self.lollms.personality.model_top_k,
                                 top_p= top_p if top_p is not None else self.lollms.config.top_p if self.lollms.config.override_personality_model_parameters else self.lollms.personality.model_top_p,
@@ -97,6 +113,25 @@ class TasksLibrary:
                                 ).strip()
         return self.bot_says
 
+    def generate_isolated(self, prompt, max_size=None, temperature = None, top_k = None, top_p=None, repeat_penalty=None, repeat_last_n=None):
+        """
+        Generates text without touching the shared generation state (bot_says, callback),
+        so that several generations can run at the same time (map reduce summarization for example).
+        Nothing is streamed to the user.
+        """
+        ntokens = len(self.lollms.model.tokenize(prompt))
+        return generate_isolated(
+                                partial(self.lollms.scheduler.run, self.lollms.model.generate),
+                                prompt,
+                                max_size if max_size else min(self.lollms.config.ctx_size-ntokens,self.lollms.config.max_n_predict),
+                                self.stop_sequence_matcher(),
+                                temperature= temperature if temperature is not None else self.lollms.config.temperature if self.lollms.config.override_personality_model_parameters else self.lollms.personality.model_temperature,
+                                top_k= top_k if top_k is not None else self.lollms.config.top_k if self.lollms.config.override_personality_model_parameters else self.lollms.personality.model_top_k,
+                                top_p= top_p if top_p is not None else self.lollms.config.top_p if self.lollms.config.override_personality_model_parameters else self.lollms.personality.model_top_p,
+                                repeat_penalty= repeat_penalty if repeat_penalty is not None else self.lollms.config.repeat_penalty if self.lollms.config.override_personality_model_parameters else self.lollms.personality.model_repeat_penalty,
+                                repeat_last_n= repeat_last_n if repeat_last_n is not None else self.lollms.config.repeat_last_n if self.lollms.config.override_personality_model_parameters else self.lollms.personality.model_repeat_last_n,
+                                )
+
     def generate_with_images(self, prompt, images, max_size, temperature = None, top_k = None, top_p=None, repeat_penalty=None, repeat_last_n=None, callback=None, debug=False, show_progress=False ):
         ASCIIColors.info("Text generation started: Warming up")
         self.nb_received_tokens = 0
@@ -104,11 +139,12 @@ class TasksLibrary:
         if debug:
             self.print_prompt("gen",prompt)
 
-        self.lollms.model.generate_with_images(
+        self.lollms.scheduler.run(
+                                self.lollms.model.generate_with_images,
                                 prompt,
                                 images,
                                 max_size,
-                                partial(self.process, callback=callback, show_progress=show_progress),
+                                callback=partial(self.process, callback=callback, show_progress=show_progress),
                                 temperature=self.lollms.config.model_temperature if temperature is None else temperature,
                                 top_k=self.lollms.config.model_top_k if top_k is None else top_k,
                                 top_p=self.lollms.config.model_top_p if top_p is None else top_p,
@@ -547,7 +583,7 @@ class TasksLibrary:
                         max_summary_size=512,
                         callback=None,
                         chunk_summary_post_processing=None,
-                        summary_mode=SUMMARY_MODE.SUMMARY_MODE_SEQUENCIAL
+                        summary_mode:SUMMARY_MODE=None
                     ):
         depth=0
         tk = self.lollms.model.tokenize(text)
@@ -591,7 +627,7 @@ class TasksLibrary:
                                 max_summary_size=512,
                                 callback=None,
                                 chunk_summary_post_processing=None,
-                                summary_mode=SUMMARY_MODE.SUMMARY_MODE_SEQUENCIAL
+                                summary_mode:SUMMARY_MODE=None
                             ):
         tk = self.lollms.model.tokenize(text)
         prev_len = len(tk)
@@ -637,12 +673,15 @@ class TasksLibrary:
                             max_generation_size=3000,
                             callback=None,
                             chunk_summary_post_processing=None,
-                            summary_mode=SUMMARY_MODE.SUMMARY_MODE_SEQUENCIAL
+                            summary_mode:SUMMARY_MODE=None
                         ):
         start_header_id_template    = self.config.start_header_id_template
         end_header_id_template      = self.config.end_header_id_template
         system_message_template     = self.config.system_message_template
         separator_template          = self.config.separator_template        
+        if summary_mode is None:
+            # map reduce when the chunks can be summarized in parallel
+            summary_mode = default_summary_mode(self.config)
         if summary_mode==SUMMARY_MODE.SUMMARY_MODE_SEQUENCIAL:
             summary = ""
             for i, chunk in enumerate(chunks):
@@ -681,6 +720,26 @@ class TasksLibrary:
                     summary = chunk_summary_post_processing(summary)
                 self.step_end(f" Summary of {doc_name} - Processing chunk : {i+1}/{len(chunks)}")
             return summary
+        elif summary_mode==SUMMARY_MODE.SUMMARY_MODE_MAP_REDUCE:
+            def step(step_name, done, total):
+                self.step(f" Summary of {doc_name} - {step_name} : {done}/{total}")
+
+            summarizer = MapReduceSummarizer.for_document(
+                                                            [self.generate_isolated],
+                                                            self.lollms.model.count_tokens,
+                                                            self.config,
+                                                            max_generation_size,
+                                                            summary_instruction,
+                                                            doc_name,
+                                                            answer_start,
+                                                            chunk_summary_post_processing=chunk_summary_post_processing,
+                                                            step_callback=step,
+                                                            wrap_worker=self.lollms.scheduler.bind_to_current_request
+                                                        )
+            self.step_start(f" Summary of {doc_name} - {len(chunks)} chunks")
+            summary = summarizer.summarize(chunks)
+            self.step_end(f" Summary of {doc_name} - {len(chunks)} chunks")
+            return summary
         else:
             summeries = []
             for i, chunk in enumerate(chunks):
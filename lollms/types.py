@@ -83,4 +83,8 @@ class BindingType(Enum):
 
 class SUMMARY_MODE(Enum):
     SUMMARY_MODE_SEQUENCIAL        = 0
-    SUMMARY_MODE_HIERARCHICAL      = 0
\ No newline at end of file
+    """Each chunk is summarized with the summary of the previous chunks (memory)."""
+    SUMMARY_MODE_HIERARCHICAL      = 1
+    """Each chunk is summarized independently, the summaries are concatenated."""
+    SUMMARY_MODE_MAP_REDUCE        = 2
+    """Chunks are summarized concurrently then the summaries are merged until a single one remains."""
\ No newline at end of file
@@ -141,20 +141,24 @@ import tqdm # Use tqdm for progress bar if available
 
 # ... (other utility functions like get_torch_device, etc.)
 
-def download_file(url: str, destination_path: Union[str, Path], progress_callback: Optional[Callable[[str], None]] = None, chunk_size=8192) -> bool:
+def download_file(url: str, destination_path: Union[str, Path], progress_callback: Optional[Callable[[str], None]] = None, chunk_size=8192, expected_sha256: str = None, connections: int = 4) -> bool:
     """
     Downloads a file from a URL to a destination path with progress reporting.
+    Uses parallel range requests when the server supports them and resumes interrupted downloads (see lollms.downloader).
 
     Args:
         url: The URL of the file to download.
         destination_path: The local path (string or Path object) where the file should be saved.
         progress_callback: An optional function to call with progress messages (e.g., percentage).
                            Takes a single string argument.
-        chunk_size: The chunk size for downloading data.
+        chunk_size: Kept for compatibility, the download engine uses its own buffers.
+        expected_sha256: An optional sha256 the downloaded file must have.
+        connections: Number of parallel connections.
 
     Returns:
         True if the download was successful, False otherwise.
     """
+    from lollms.downloader import ChunkedDownloader, DownloadError
     dest_path = Path(destination_path)
     # Ensure the destination directory exists
     try:
@@ -165,80 +169,36 @@ def download_file(url: str, destination_path: Union[str, Path], progress_callbac
         print(f"Error creating directory {dest_path.parent}: {e}") # Also print to console
         return False
 
+    progress_bar = None
+    def report(downloaded_size, total_size_in_bytes):
+        if progress_bar is not None:
+            progress_bar.total = total_size_in_bytes or None
+            progress_bar.update(downloaded_size - progress_bar.n)
+        elif progress_callback:
+            if total_size_in_bytes > 0:
+                progress = (downloaded_size / total_size_in_bytes) * 100
+                progress_callback(f"Downloading {dest_path.name}: {progress:.1f}% ({downloaded_size/1024/1024:.2f}MB / {total_size_in_bytes/1024/1024:.2f}MB)")
+            else:
+                progress_callback(f"Downloading {dest_path.name}: {downloaded_size/1024/1024:.2f}MB downloaded (total size unknown)")
+
     try:
-        # Use a session for potential connection pooling benefits
-        with requests.Session() as session:
-            response = session.get(url, stream=True, timeout=30) # Add timeout
-            response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-
-            total_size_in_bytes = int(response.headers.get('content-length', 0))
-            downloaded_size = 0
-
-            if progress_callback:
-                progress_callback(f"Starting download of {dest_path.name} from {url}")
-
-            # Use tqdm for a visual progress bar if available and no callback is provided
-            progress_bar = None
-            if not progress_callback and PackageManager.check_package_installed("tqdm"):
-                 try:
-                     progress_bar = tqdm.tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True, desc=f"Downloading {dest_path.name}")
-                 except Exception:
-                     progress_bar = None # Fallback if tqdm fails
-
-
-            with open(dest_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    if chunk:  # filter out keep-alive new chunks
-                        chunk_len = len(chunk)
-                        f.write(chunk)
-                        downloaded_size += chunk_len
-
-                        if progress_bar:
-                             progress_bar.update(chunk_len)
-                        elif progress_callback:
-                            if total_size_in_bytes > 0:
-                                progress = (downloaded_size / total_size_in_bytes) * 100
-                                # Report progress less frequently to avoid flooding logs/UI
-                                if downloaded_size % (chunk_size * 10) == 0 or downloaded_size == total_size_in_bytes:
-                                    progress_callback(f"Downloading {dest_path.name}: {progress:.1f}% ({downloaded_size/1024/1024:.2f}MB / {total_size_in_bytes/1024/1024:.2f}MB)")
-                            else:
-                                # Report progress based on downloaded size if total unknown
-                                if downloaded_size % (chunk_size * 50) == 0: # Report every ~400KB
-                                     progress_callback(f"Downloading {dest_path.name}: {downloaded_size/1024/1024:.2f}MB downloaded (total size unknown)")
-
-            if progress_bar:
-                 progress_bar.close()
-
-            if total_size_in_bytes != 0 and downloaded_size != total_size_in_bytes:
-                if progress_callback:
-                    progress_callback(f"Error: Download finished, but size mismatch! Expected {total_size_in_bytes}, got {downloaded_size}")
-                print(f"Error: Download size mismatch for {dest_path.name}")
-                # Optional: Delete incomplete file?
-                # dest_path.unlink(missing_ok=True)
-                # return False # Consider this a failure
-                return True # Or consider it success but log warning
-
-            if progress_callback:
-                progress_callback(f"Successfully downloaded {dest_path.name}")
-            return True
+        if progress_callback:
+            progress_callback(f"Starting download of {dest_path.name} from {url}")
+        # Use tqdm for a visual progress bar if available and no callback is provided
+        elif PackageManager.check_package_installed("tqdm"):
+            try:
+                progress_bar = tqdm.tqdm(unit='iB', unit_scale=True, desc=f"Downloading {dest_path.name}")
+            except Exception:
+                progress_bar = None # Fallback if tqdm fails
 
-    except requests.exceptions.HTTPError as http_err:
-        error_msg = f"HTTP Error during download: {http_err}"
-        if progress_callback: progress_callback(error_msg)
-        print(error_msg) # Also print
-        return False
-    except requests.exceptions.ConnectionError as conn_err:
-        error_msg = f"Connection Error during download: {conn_err}"
-        if progress_callback: progress_callback(error_msg)
-        print(error_msg)
-        return False
-    except requests.exceptions.Timeout as timeout_err:
-        error_msg = f"Timeout Error during download: {timeout_err}"
-        if progress_callback: progress_callback(error_msg)
-        print(error_msg)
-        return False
-    except requests.exceptions.RequestException as req_err:
-        error_msg = f"Error during download request: {req_err}"
+        ChunkedDownloader(connections=connections).download(url, dest_path, expected_sha256, report)
+
+        if progress_callback:
+            progress_callback(f"Successfully downloaded {dest_path.name}")
+        return True
+
+    except DownloadError as e:
+        error_msg = f"Error during download: {e}"
         if progress_callback: progress_callback(error_msg)
         print(error_msg)
         return False
@@ -246,10 +206,10 @@ def download_file(url: str, destination_path: Union[str, Path], progress_callbac
         error_msg = f"An unexpected error occurred during download: {e}"
         if progress_callback: progress_callback(error_msg)
         print(error_msg)
-        # You might want to re-import trace_exception here if needed
-        # from lollms.helpers import trace_exception
-        # trace_exception(e)
         return False
+    finally:
+        if progress_bar is not None:
+            progress_bar.close()
 
 
 def run_with_current_interpreter(
@@ -1776,6 +1736,16 @@ class File64BitsManager:
         return filename
     
 class PromptReshaper:
+    """
+    Fills the {{placeholder}} fields of a prompt template while keeping it under a token budget.
+
+    The template and the placeholder values are tokenized once each. When the prompt does not fit, the
+    sacrificable placeholders are cropped: the first placeholder of the sacrifice list is the first to lose
+    tokens, the last one keeps its text as long as possible.
+    """
+    # Put between the two kept ends of a text cropped in the middle
+    MIDDLE_SEPARATOR = "\n...\n"
+
     def __init__(self, template:str):
         self.template = template
     def replace(self, placeholders:dict)->str:
@@ -1784,41 +1754,95 @@ class PromptReshaper:
         for placeholder, text in placeholders.items():
             template = template.replace(placeholder, text)
         return template
-    def build(self, placeholders:dict, tokenize, detokenize, max_nb_tokens:int, place_holders_to_sacrifice:list=[])->str:
-        # Tokenize the template without placeholders
-        template_text = self.template
-        template_tokens = tokenize(template_text)
-        
-        # Calculate the number of tokens in the template without placeholders
-        template_tokens_count = len(template_tokens)
-        
-        # Calculate the number of tokens for each placeholder
-        placeholder_tokens_count = {}
-        all_count = template_tokens_count
-        for placeholder, text in placeholders.items():
-            text_tokens = tokenize(text)
-            placeholder_tokens_count[placeholder] = len(text_tokens)
-            all_count += placeholder_tokens_count[placeholder]
-
-        def fill_template(template, data):
-            for key, value in data.items():
-                placeholder = "{{" + key + "}}"
-                n_text_tokens = len(tokenize(template))
-                if key in place_holders_to_sacrifice:
-                    n_remaining = max_nb_tokens - n_text_tokens
-                    t_value = tokenize(value)
-                    n_value = len(t_value)
-                    if n_value<n_remaining:
-                        template = template.replace(placeholder, value)
-                    else:
-                        value = detokenize(t_value[-n_remaining:])
-                        template = template.replace(placeholder, value)
-                        
-                else:
-                    template = template.replace(placeholder, value)
-            return template
-        
-        return fill_template(self.template, placeholders)
+
+    @staticmethod
+    def crop_tokens(tokens:list, n_tokens:int, sacrifice_from:str="head")->list:
+        """
+        Keeps n_tokens of a token list.
+
+        Args:
+            tokens (list): The tokens to crop.
+            n_tokens (int): The number of tokens to keep.
+            sacrifice_from (str, optional): Where the tokens are removed: "head" keeps the end of the text,
+                "tail" keeps its beginning and "middle" keeps both ends. Defaults to "head".
+
+        Returns:
+            list: a list of token lists (two parts when cropping the middle)
+        """
+        if n_tokens <= 0:
+            return [[]]
+        if n_tokens >= len(tokens):
+            return [tokens]
+        if sacrifice_from == "head":
+            return [tokens[-n_tokens:]]
+        elif sacrifice_from == "tail":
+            return [tokens[:n_tokens]]
+        elif sacrifice_from == "middle":
+            n_head = n_tokens // 2
+            return [tokens[:n_head], tokens[len(tokens)-(n_tokens-n_head):]]
+        else:
+            raise ValueError(f"Unknown sacrifice side '{sacrifice_from}', expected head, tail or middle")
+
+    def build(self, placeholders:dict, tokenize, detokenize, max_nb_tokens:int, place_holders_to_sacrifice:list=[], sacrifice_from:str|dict="head")->str:
+        """
+        Builds the prompt.
+
+        Args:
+            placeholders (dict): The values of the placeholders ({"name": value} fills {{name}}).
+            tokenize (Callable): The tokenizer.
+            detokenize (Callable): The detokenizer.
+            max_nb_tokens (int): The maximum number of tokens of the prompt.
+            place_holders_to_sacrifice (list, optional): The placeholders that can be cropped, in sacrifice order.
+            sacrifice_from (str|dict, optional): "head", "tail" or "middle", or a dict giving it per placeholder.
+                Defaults to "head" (the end of the text is kept). With "middle", both ends are kept, separated by MIDDLE_SEPARATOR.
+
+        Returns:
+            str: The prompt.
+        """
+        parts = re.split(r"\{\{(.*?)\}\}", self.template)
+        # parts alternates literal text and placeholder names
+        names = parts[1::2]
+        sacrificable = [name for name in place_holders_to_sacrifice if name in placeholders and name in names]
+
+        def value_of(name):
+            return placeholders[name] if name in placeholders else "{{"+name+"}}"
+
+        if len(sacrificable) == 0:
+            return "".join(part if i % 2 == 0 else value_of(part) for i, part in enumerate(parts))
+
+        # Tokenize the sacrificable values once each, and all the fixed text at once
+        sacrificable_tokens = {name: tokenize(placeholders[name]) for name in sacrificable}
+        occurrences = {name: names.count(name) for name in sacrificable}
+        fixed_text = "".join(part if i % 2 == 0 else value_of(part) for i, part in enumerate(parts) if i % 2 == 0 or part not in sacrificable_tokens)
+        fixed_count = len(tokenize(fixed_text))
+
+        # Share the remaining budget, the last placeholders of the sacrifice list are served first
+        budget = max_nb_tokens - fixed_count
+        allowed = {}
+        for name in reversed(sacrificable):
+            needed = len(sacrificable_tokens[name]) * occurrences[name]
+            granted = max(0, min(needed, budget))
+            allowed[name] = granted // occurrences[name]
+            budget -= allowed[name] * occurrences[name]
+
+        values = {}
+        for name in sacrificable:
+            tokens = sacrificable_tokens[name]
+            if allowed[name] >= len(tokens):
+                values[name] = placeholders[name]
+            else:
+                side = sacrifice_from.get(name, "head") if isinstance(sacrifice_from, dict) else sacrifice_from
+                if side == "middle":
+                    # the separator marking the removed part is paid from the placeholder budget
+                    separator_count = len(tokenize(self.MIDDLE_SEPARATOR))
+                    if allowed[name] > separator_count + 1:
+                        head, tail = self.crop_tokens(tokens, allowed[name] - separator_count, side)
+                        values[name] = detokenize(head) + self.MIDDLE_SEPARATOR + detokenize(tail)
+                        continue
+                    side = "head"
+                values[name] = "".join(detokenize(chunk) if len(chunk) > 0 else "" for chunk in self.crop_tokens(tokens, allowed[name], side))
+
+        return "".join(part if i % 2 == 0 else (values[part] if part in values else value_of(part)) for i, part in enumerate(parts))
 
 
 
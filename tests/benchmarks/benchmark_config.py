@@ -0,0 +1,45 @@
+"""
+project: lollms
+file: benchmark_config.py
+author: ParisNeo
+description:
+    Cost of the attribute reads and writes of the configurations (the main configuration is read on every generation step).
+    TypedConfig writes are compared with the former write path, that converted and synced every template entry again.
+"""
+import argparse
+import timeit
+
+from lollms.config import BaseConfig, ConfigTemplate, TypedConfig
+
+
+def ns_per_op(fn, number:int) -> float:
+    return timeit.timeit(fn, number=number)/number*1e9
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Configuration attribute access cost')
+    parser.add_argument('--keys', type=int, default=300, help='Number of configuration entries')
+    parser.add_argument('--number', type=int, default=200000, help='Number of operations measured')
+    args = parser.parse_args()
+
+    values = {f"k{i}": i for i in range(args.keys)}
+    key = f"k{args.keys//2}"
+    config = BaseConfig(["file_path", "config", "lollms_paths"], dict(values))
+    template = ConfigTemplate([{"name": name, "value": value, "type": "int", "min": 0, "max": 1000} for name, value in values.items()])
+    typed = TypedConfig(template, BaseConfig(config={}))
+
+    def former_typed_write():
+        typed.config[key] = 3
+        typed.sync()
+
+    print(f"dict read                : {ns_per_op(lambda: values[key], args.number):7.0f} ns")
+    print(f"BaseConfig read          : {ns_per_op(lambda: getattr(config, key), args.number):7.0f} ns")
+    print(f"BaseConfig write         : {ns_per_op(lambda: setattr(config, key, 3), args.number):7.0f} ns")
+    print(f"TypedConfig read         : {ns_per_op(lambda: getattr(typed, key), args.number):7.0f} ns")
+    print(f"TypedConfig write        : {ns_per_op(lambda: setattr(typed, key, 3), args.number):7.0f} ns")
+    print(f"TypedConfig write (full) : {ns_per_op(former_typed_write, args.number//100):7.0f} ns")
+
+    # the index of the template entries follows the template updates
+    typed.update_template([{"name": name, "value": value, "type": "int", "min": 0, "max": 10} for name, value in values.items()])
+    setattr(typed, key, 500)
+    assert template[key]["value"] == 10
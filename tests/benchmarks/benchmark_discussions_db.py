@@ -0,0 +1,66 @@
+"""
+project: lollms
+file: benchmark_discussions_db.py
+author: ParisNeo
+description:
+    Statement throughput of the discussions database.
+    Compares the pooled WAL connections of DiscussionsDB with opening a sqlite connection per statement,
+    then checks that several threads can write and read at the same time.
+"""
+import argparse
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from lollms.databases.discussions_database import DiscussionsDB
+
+
+def benchmark(n_operations:int, n_threads:int):
+    db = DiscussionsDB(None, SimpleNamespace(personal_discussions_path=Path(tempfile.mkdtemp())))
+    db.create_tables()
+    db.add_missing_columns()
+    discussion_id = db.insert("INSERT INTO discussion (title) VALUES (?)", ("benchmark",))
+    message_id = db.insert("INSERT INTO message (sender, content, message_type, discussion_id) VALUES (?, ?, ?, ?)", ("user", "", 0, discussion_id))
+
+    start = time.perf_counter()
+    for i in range(n_operations):
+        db.update("UPDATE message SET content=? WHERE id=?", (str(i), message_id))
+        db.select("SELECT content FROM message WHERE id=?", (message_id,), False)
+    pooled = n_operations / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(n_operations):
+        with sqlite3.connect(db.discussion_db_file_path) as conn:
+            conn.execute("UPDATE message SET content=? WHERE id=?", (str(i), message_id))
+            conn.commit()
+        with sqlite3.connect(db.discussion_db_file_path) as conn:
+            conn.execute("SELECT content FROM message WHERE id=?", (message_id,)).fetchone()
+    per_call = n_operations / (time.perf_counter() - start)
+
+    print(f"update+select, connection per statement : {per_call:8.0f} ops/s")
+    print(f"update+select, pooled WAL connections   : {pooled:8.0f} ops/s")
+
+    def worker():
+        for i in range(n_operations // n_threads):
+            db.update("UPDATE message SET content=? WHERE id=?", (str(i), message_id))
+            db.select("SELECT content FROM message WHERE id=?", (message_id,), False)
+
+    threads = [threading.Thread(target=worker) for _ in range(n_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f"{n_threads} threads, pooled WAL connections    : {n_operations / (time.perf_counter() - start):8.0f} ops/s")
+    db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Discussions database statement throughput')
+    parser.add_argument('--operations', type=int, default=2000, help='Number of update+select pairs')
+    parser.add_argument('--threads', type=int, default=8, help='Number of threads of the concurrent run')
+    args = parser.parse_args()
+    benchmark(args.operations, args.threads)
@@ -0,0 +1,87 @@
+"""
+project: lollms
+file: benchmark_format_discussion.py
+author: ParisNeo
+description:
+    Formatting time of a long discussion into a token budget.
+    Compares Discussion.format_discussion with the former loop that tokenized the whole
+    accumulated text again for every message.
+"""
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from lollms.databases.discussions_database import DiscussionsDB, Discussion
+
+
+class WhitespaceTokenizer:
+    def tokenize(self, text):
+        return text.split(" ")
+
+    def detokenize(self, tokens):
+        return " ".join(tokens)
+
+    def count_tokens(self, text):
+        return len(self.tokenize(text))
+
+
+class Config(dict):
+    __getattr__ = dict.get
+
+
+def former_format_discussion(discussion, max_allowed_tokens):
+    splitter_text = discussion.lollms.config.discussion_prompt_separator
+    formatted_text = ""
+    for message in reversed(discussion.messages):
+        formatted_message = f"{splitter_text}{message.sender.replace(':','').replace(splitter_text,'')}:\n{message.content}\n"
+        if len(discussion.lollms.model.tokenize(formatted_message)) + len(discussion.lollms.model.tokenize(formatted_text)) <= max_allowed_tokens:
+            formatted_text = formatted_message + formatted_text
+        else:
+            break
+    return formatted_text
+
+
+def build_discussion(n_messages:int):
+    lollms = SimpleNamespace(
+                                model=WhitespaceTokenizer(),
+                                config=Config(discussion_prompt_separator="!@>", binding_name="benchmark", model_name="whitespace")
+                            )
+    db = DiscussionsDB(lollms, SimpleNamespace(personal_discussions_path=Path(tempfile.mkdtemp())))
+    db.create_tables()
+    db.add_missing_columns()
+    discussion_id = db.insert("INSERT INTO discussion (title) VALUES (?)", ("benchmark",))
+    random.seed(0)
+    db.update_many(
+        "INSERT INTO message (sender, content, message_type, discussion_id) VALUES (?, ?, ?, ?)",
+        [("user" if i%2 else "assistant", " ".join(["word"]*random.randint(20, 100)), 0, discussion_id) for i in range(n_messages)]
+    )
+    discussion = Discussion.__new__(Discussion)
+    discussion.lollms = lollms
+    discussion.discussions_db = db
+    discussion.discussion_id = discussion_id
+    discussion.get_messages()
+    return discussion
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Discussion formatting benchmark')
+    parser.add_argument('--messages', type=int, default=1000, help='Number of messages of the discussion')
+    parser.add_argument('--budgets', type=int, nargs='+', default=[4096, 100000], help='Token budgets to test')
+    args = parser.parse_args()
+
+    discussion = build_discussion(args.messages)
+    # the first call stores the token counts of the messages
+    start = time.perf_counter()
+    discussion.format_discussion(args.budgets[0])
+    print(f"first call (counts the {args.messages} messages): {(time.perf_counter()-start)*1000:8.1f} ms")
+    for budget in args.budgets:
+        start = time.perf_counter()
+        former_format_discussion(discussion, budget)
+        former = time.perf_counter() - start
+        start = time.perf_counter()
+        text = discussion.format_discussion(budget)
+        current = time.perf_counter() - start
+        print(f"budget {budget:6} tokens: former {former*1000:8.1f} ms, format_discussion {current*1000:6.1f} ms ({text.count('!@>')} messages)")
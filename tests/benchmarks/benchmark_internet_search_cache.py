@@ -0,0 +1,51 @@
+"""
+project: lollms
+file: benchmark_internet_search_cache.py
+author: ParisNeo
+description:
+    Wall time of repeated internet searches through the shared InternetSearchCache, with pages that take a fixed
+    time to fetch (injected fetch_page and search hooks, nothing is downloaded).
+    The store is first filled with unrelated pages, to check that each search only gets the chunks of its own pages.
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from lollms.internet import InternetSearchCache
+
+
+def page_text(url:str) -> str:
+    topic = url.rsplit("/", 1)[-1]
+    return "\n".join(f"{topic} paragraph {i}: " + f"{topic} " * 60 for i in range(20))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Internet search cache wall time')
+    parser.add_argument('--pages', type=int, default=5, help='Number of result pages per search')
+    parser.add_argument('--latency', type=float, default=0.5, help='Seconds to fetch a page')
+    parser.add_argument('--unrelated', type=int, default=50, help='Number of unrelated pages already in the store')
+    parser.add_argument('--workers', type=int, default=4, help='Number of pages fetched at the same time')
+    args = parser.parse_args()
+
+    fetched = []
+    def fetch_page(url):
+        time.sleep(args.latency)
+        fetched.append(url)
+        return page_text(url)
+
+    def search(query, num_results):
+        return [{"title": f"{query} {i}", "snippet": query, "url": f"https://example.com/{query}/{query}{i}"} for i in range(num_results)]
+
+    db_path = Path(tempfile.mkdtemp())/"internet_ss.db"
+    cache = InternetSearchCache(db_path, max_workers=args.workers, fetch_page=lambda url: page_text(url), search=search)
+    # unrelated pages that match the query better than the pages of the search
+    cache.index_results(search("python python", args.unrelated), "tfidf:standard", 512, 20)
+
+    cache.fetch_page = fetch_page
+    for run in ["first search", "same search", "same search"]:
+        fetched.clear()
+        start = time.perf_counter()
+        chunks = cache.search_and_vectorize("python", args.pages, "tfidf:standard", 512, 20, 4)
+        print(f"{run:12}: {time.perf_counter()-start:6.2f} s, {len(fetched)} pages fetched, {len(chunks)} chunks")
+        assert len(chunks) > 0 and all("/python/" in chunk["url"] for chunk in chunks)
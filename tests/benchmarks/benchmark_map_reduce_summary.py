@@ -0,0 +1,76 @@
+"""
+project: lollms
+file: benchmark_map_reduce_summary.py
+author: ParisNeo
+description:
+    Wall time of the summary of a long document with a mock binding that takes a fixed time per generation.
+    Compares the sequential cumulative summary (one generation per chunk, each one waiting for the previous summary)
+    with the map reduce summarizer used by summarize_chunks and sequential_summarize.
+"""
+import argparse
+import time
+
+from lollms.generation import StopSequenceMatcher
+from lollms.scheduler import GenerationScheduler
+from lollms.summarization import MapReduceSummarizer, generate_isolated
+from lollms.types import MSG_OPERATION_TYPE
+
+
+class Config(dict):
+    __getattr__ = dict.get
+
+
+def mock_binding(latency:float):
+    # a model that answers after latency seconds, with a short summary of the prompt
+    def generate(prompt, n_predict, callback=None, **kwargs):
+        time.sleep(latency)
+        output = f"summary of {len(prompt.split())} words"
+        callback(output, MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK)
+        return output
+    return generate
+
+
+def count_tokens(text:str) -> int:
+    return len(text.split())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Map reduce summary wall time')
+    parser.add_argument('--chunks', type=int, default=120, help='Number of chunks of the document')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds per generation')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8, 16], help='summarization_max_workers values to measure')
+    args = parser.parse_args()
+
+    scheduler = GenerationScheduler(64, 1)
+    model_generate = mock_binding(args.latency)
+    chunks = ["word "*2000]*args.chunks
+
+    def generate(prompt, max_size):
+        return generate_isolated(lambda *a, **kw: scheduler.run(model_generate, *a, **kw), prompt, max_size, StopSequenceMatcher(["!@>"]))
+
+    start = time.perf_counter()
+    summary = ""
+    for chunk in chunks:
+        summary = generate(summary+"\n"+chunk, 512)
+    print(f"sequential          : {time.perf_counter()-start:6.2f} s")
+
+    for workers in args.workers:
+        config = Config(
+                            ctx_size=4096,
+                            summarization_max_workers=workers,
+                            start_header_id_template="!@>",
+                            end_header_id_template=": ",
+                            system_message_template="system"
+                        )
+        summarizer = MapReduceSummarizer.for_document(
+                                                        [generate],
+                                                        count_tokens,
+                                                        config,
+                                                        512,
+                                                        "summarize",
+                                                        wrap_worker=scheduler.bind_to_current_request
+                                                    )
+        start = time.perf_counter()
+        # the whole summary holds one generation slot, as a chat turn does
+        scheduler.run(lambda callback=None: summarizer.summarize(chunks))
+        print(f"map reduce, {workers:2} workers: {time.perf_counter()-start:6.2f} s")
@@ -0,0 +1,66 @@
+"""
+project: lollms
+file: benchmark_skills_query.py
+author: ParisNeo
+description:
+    Query time of the skills library, with its real vector store.
+    Compares the hybrid SkillsLibrary.query (bm25 full text index + vectors, fused by reciprocal rank)
+    with the former LIKE scan of the skills table.
+"""
+import argparse
+import random
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+from lollms.databases.skills_database import SkillsLibrary
+
+
+class Config(dict):
+    __getattr__ = dict.get
+
+
+TOPICS = ["python", "docker", "sqlite", "vue", "fastapi", "git", "numpy", "linux", "css", "regex"]
+WORDS = ["install", "configure", "debug", "optimize", "deploy", "test", "parse", "index", "cache", "stream", "build", "query"]
+
+
+def skill_content(rng:random.Random, topic:str) -> str:
+    return " ".join(rng.choice(WORDS+[topic]) for _ in range(120))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Skills library query time')
+    parser.add_argument('--skills', type=int, default=2000, help='Number of skills in the library')
+    parser.add_argument('--queries', type=int, default=50, help='Number of queries measured')
+    parser.add_argument('--vectorizer', type=str, default="tfidf:standard", help='Vectorizer of the store')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    db_path = Path(tempfile.mkdtemp())/"skills.db"
+    library = SkillsLibrary(str(db_path), config=Config(rag_vectorizer=args.vectorizer, rag_chunk_size=512, rag_overlap=0))
+    start = time.perf_counter()
+    for i in range(args.skills):
+        topic = rng.choice(TOPICS)
+        library.add_entry(1, topic, f"{topic} skill {i}", skill_content(rng, topic))
+    print(f"indexing            : {time.perf_counter()-start:7.2f} s for {args.skills} skills")
+
+    queries = [f"how to {rng.choice(WORDS)} a {rng.choice(TOPICS)} project" for _ in range(args.queries)]
+
+    conn = sqlite3.connect(str(db_path))
+    start = time.perf_counter()
+    for query in queries:
+        words = [word for word in query.split() if word in TOPICS]
+        conn.execute("SELECT * FROM skills_library WHERE content LIKE ?", (f"%{words[0]}%",)).fetchall()
+    conn.close()
+    print(f"LIKE scan           : {(time.perf_counter()-start)/len(queries)*1000:7.2f} ms per query")
+
+    start = time.perf_counter()
+    for query in queries:
+        results = library.query(query, top_k=3)
+    print(f"hybrid query        : {(time.perf_counter()-start)/len(queries)*1000:7.2f} ms per query ({sum(r['similarity'] is not None for r in results)}/{len(results)} with a vector match)")
+
+    start = time.perf_counter()
+    for query in queries:
+        library.query(query, top_k=3, category="python")
+    print(f"hybrid, by category : {(time.perf_counter()-start)/len(queries)*1000:7.2f} ms per query")
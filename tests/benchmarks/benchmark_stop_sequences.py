@@ -0,0 +1,50 @@
+"""
+project: lollms
+file: benchmark_stop_sequences.py
+author: ParisNeo
+description:
+    Cost of the stop sequences (antiprompts) detection over a long streamed answer.
+    Compares the StopSequenceMatcher used by the generation callbacks with the former check
+    that lowered and searched the whole answer again for every received token.
+"""
+import argparse
+import time
+
+from lollms.generation import StopSequenceMatcher
+from lollms.utilities import detect_antiprompt
+
+
+STOP_SEQUENCES = ["!@>", "<|end|>", "<|im_end|>", "\n### user:"]
+
+
+def full_rescan(tokens):
+    answer = ""
+    for token in tokens:
+        answer += token
+        if detect_antiprompt(answer, STOP_SEQUENCES):
+            return answer
+    return answer
+
+
+def incremental(tokens):
+    matcher = StopSequenceMatcher(STOP_SEQUENCES)
+    answer = ""
+    for token in tokens:
+        answer += token
+        if matcher.scan(answer):
+            return answer
+    return answer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stop sequences detection cost')
+    parser.add_argument('--tokens', type=int, default=16000, help='Number of streamed tokens')
+    args = parser.parse_args()
+
+    tokens = [f"word{i%97} " for i in range(args.tokens)]
+    results = {}
+    for name, scan in [("full rescan", full_rescan), ("incremental", incremental)]:
+        start = time.perf_counter()
+        results[name] = scan(tokens)
+        print(f"{name:12}: {time.perf_counter()-start:6.3f} s for {args.tokens} tokens")
+    assert results["full rescan"] == results["incremental"]
@@ -0,0 +1,70 @@
+"""
+project: lollms
+file: benchmark_stream_bridge.py
+author: ParisNeo
+description:
+    Time to first byte and CPU usage of a streamed generation.
+    Compares the StreamBridge used by the generator endpoints with the former consumer
+    that polled a shared list every millisecond while the binding was idle between chunks.
+"""
+import argparse
+import asyncio
+import threading
+import time
+
+from lollms.generation import StreamBridge
+
+
+def fake_binding(put, n_chunks:int, delay:float):
+    # a model that takes delay seconds per chunk
+    time.sleep(0.05)
+    for i in range(n_chunks):
+        put(f"chunk {i} ")
+        time.sleep(delay)
+
+
+async def bridge_consumer(n_chunks:int, delay:float):
+    bridge = StreamBridge()
+    start = time.perf_counter()
+    first = None
+    bridge.run_in_thread(fake_binding, bridge.put, n_chunks, delay)
+    async for _ in bridge.chunks():
+        if first is None:
+            first = time.perf_counter() - start
+    return first
+
+
+async def polling_consumer(n_chunks:int, delay:float):
+    lock = threading.Lock()
+    chunks = []
+    done = [False]
+    start = time.perf_counter()
+    first = None
+    def put(chunk):
+        with lock:
+            chunks.append(chunk)
+    def work():
+        fake_binding(put, n_chunks, delay)
+        done[0] = True
+    threading.Thread(target=work).start()
+    while not done[0]:
+        while not done[0] and len(chunks) == 0:
+            time.sleep(0.001)
+        with lock:
+            if len(chunks) > 0 and first is None:
+                first = time.perf_counter() - start
+            chunks.clear()
+    return first
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Streaming time to first byte and idle CPU')
+    parser.add_argument('--chunks', type=int, default=5, help='Number of chunks generated')
+    parser.add_argument('--delay', type=float, default=0.4, help='Seconds between two chunks')
+    args = parser.parse_args()
+
+    for name, consumer in [("polling", polling_consumer), ("bridge", bridge_consumer)]:
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        ttfb = asyncio.run(consumer(args.chunks, args.delay))
+        print(f"{name:8}: time to first byte {ttfb*1000:6.1f} ms, cpu {(time.process_time()-cpu_start)*1000:6.1f} ms, wall {(time.perf_counter()-wall_start)*1000:6.0f} ms")
@@ -0,0 +1,151 @@
+"""
+project: lollms
+file: test_downloader.py
+author: ParisNeo
+description:
+    Tests of the chunked download engine against a local HTTP server that serves a file with range requests.
+    The server can refuse HEAD requests, ignore ranges and drop the connection in the middle of a segment.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import threading
+import hashlib
+import json
+import os
+
+import pytest
+
+from lollms.downloader import ChunkedDownloader, DownloadIntegrityError
+from lollms.utilities import download_file
+
+
+CONTENT = os.urandom(1024*1024 + 123)
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    server_version = "TestServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        if self.server.refuse_head:
+            self.send_response(405)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(CONTENT)))
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        if range_header is not None and self.server.ranges:
+            start, end = range_header.split("=")[1].split("-")
+            start, end = int(start), int(end)
+            body = CONTENT[start:end+1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(CONTENT)}")
+        else:
+            body = CONTENT
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        with self.server.lock:
+            drop = self.server.drops > 0 and len(body) > 1
+            if drop:
+                self.server.drops -= 1
+        if drop:
+            # half of the body, then the connection is closed
+            self.wfile.write(body[:len(body)//2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.served += len(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FileHandler)
+    httpd.refuse_head = False
+    httpd.ranges = True
+    httpd.drops = 0
+    httpd.served = 0
+    httpd.lock = threading.Lock()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/model.gguf"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_parallel_segments(server, tmp_path:Path):
+    downloader = ChunkedDownloader(connections=4, segment_size=128*1024)
+    destination = downloader.download(server.url, tmp_path/"model.gguf", SHA256)
+    assert destination.read_bytes() == CONTENT
+    assert not (tmp_path/"model.gguf.part").exists()
+    assert not (tmp_path/"model.gguf.part.json").exists()
+
+
+def test_resume_from_part(server, tmp_path:Path):
+    downloader = ChunkedDownloader(connections=2, segment_size=128*1024)
+    half = len(CONTENT)//2
+    segments = downloader._segments(len(CONTENT))
+    # the first segment is complete, the second one stopped after 1000 bytes
+    segments[0]["done"] = segments[0]["end"]
+    segments[1]["done"] = 1000
+    part = bytearray(len(CONTENT))
+    part[:half] = CONTENT[:half]
+    part[segments[1]["start"]:segments[1]["start"]+1000] = CONTENT[segments[1]["start"]:segments[1]["start"]+1000]
+    (tmp_path/"model.gguf.part").write_bytes(bytes(part))
+    (tmp_path/"model.gguf.part.json").write_text(json.dumps({"url":server.url, "size":len(CONTENT), "etag":"", "segments":segments}))
+
+    downloader.download(server.url, tmp_path/"model.gguf", SHA256)
+    assert (tmp_path/"model.gguf").read_bytes() == CONTENT
+    assert server.served == segments[1]["end"] - segments[1]["start"] - 1000
+
+
+def test_server_ignoring_ranges(server, tmp_path:Path):
+    server.ranges = False
+    downloader = ChunkedDownloader(connections=4, segment_size=128*1024)
+    downloader.download(server.url, tmp_path/"model.gguf", SHA256)
+    assert (tmp_path/"model.gguf").read_bytes() == CONTENT
+
+
+def test_server_refusing_head(server, tmp_path:Path):
+    server.refuse_head = True
+    downloader = ChunkedDownloader(connections=4, segment_size=128*1024)
+    assert downloader.probe(server.url)["ranges"]
+    downloader.download(server.url, tmp_path/"model.gguf", SHA256)
+    assert (tmp_path/"model.gguf").read_bytes() == CONTENT
+
+
+def test_sha256_mismatch_removes_part(server, tmp_path:Path):
+    downloader = ChunkedDownloader(connections=4, segment_size=128*1024)
+    with pytest.raises(DownloadIntegrityError):
+        downloader.download(server.url, tmp_path/"model.gguf", "0"*64)
+    assert not (tmp_path/"model.gguf").exists()
+    assert not (tmp_path/"model.gguf.part").exists()
+    assert not (tmp_path/"model.gguf.part.json").exists()
+
+
+def test_segment_retry_after_dropped_connection(server, tmp_path:Path):
+    server.drops = 1
+    downloader = ChunkedDownloader(connections=4, segment_size=128*1024)
+    downloader.download(server.url, tmp_path/"model.gguf", SHA256)
+    assert (tmp_path/"model.gguf").read_bytes() == CONTENT
+    assert server.drops == 0
+
+
+def test_download_file(server, tmp_path:Path):
+    messages = []
+    assert download_file(server.url, tmp_path/"model.gguf", messages.append, expected_sha256=SHA256)
+    assert (tmp_path/"model.gguf").read_bytes() == CONTENT
+    assert not download_file(server.url, tmp_path/"other.gguf", messages.append, expected_sha256="0"*64)
+    assert not (tmp_path/"other.gguf").exists()